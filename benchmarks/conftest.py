@@ -0,0 +1,198 @@
+"""
+A small pytest-benchmark-style harness for the microbenchmarks in this directory, which run offline
+on synthetic data, e.g.
+
+    pytest benchmarks --benchmark-rows 10000,100000,1000000 --benchmark-json results/micro.json
+
+Benchmarks are parametrized by `num_rows`. The `benchmark` fixture runs the code under test once to
+count the memory blocks it leaves allocated, e.g. in its result, once under `tracemalloc` for its
+peak memory, and then times it over `--benchmark-rounds` rounds.
+"""
+
+from dataclasses import asdict, dataclass
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+import numpy as np
+import pytest
+
+from benchmarks.corpus import BYTE_LEVEL_MODEL_DIR, CorpusConfig, synthetic_prepared_batches, synthetic_rows
+from birr.batch_inference.data_models import ChatMessage, CompletionOutput, PreparedBatch, RawInputItem
+from birr.batch_inference.generate_io_processor import GenerateIOProcessor
+from birr.batch_inference.serializer import default_serializer
+from birr.batch_inference.utils import flatten_and_sort
+from birr.core.config import FormatConfig, LLMModelConfig
+
+T = TypeVar("T")
+
+DEFAULT_ROWS = "10000,100000"
+# The default `PipelineConfig.tokenization_batch_size`
+TOKENIZATION_BATCH_SIZE = 3000
+# Short prompts, where the CPU-side work per row matters most
+CORPUS_CONFIG = CorpusConfig(median_words=30, chat_fraction=0.2)
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    num_rows: int
+    rounds: int
+    min_seconds: float
+    median_seconds: float
+    peak_bytes: int
+    allocated_blocks: int
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.num_rows / self.min_seconds if self.min_seconds else float("inf")
+
+
+_results: List[BenchmarkResult] = []
+
+
+class Benchmark:
+    def __init__(self, name: str, num_rows: int, rounds: int) -> None:
+        self.name = name
+        self.num_rows = num_rows
+        self.rounds = rounds
+
+    def __call__(self, fn: Callable[[], T]) -> T:
+        """Measures `fn`, and returns the result of its first call."""
+        gc.collect()
+        blocks_before = sys.getallocatedblocks()
+        result = fn()
+        allocated_blocks = sys.getallocatedblocks() - blocks_before
+
+        gc.collect()
+        tracemalloc.start()
+        fn()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        seconds = []
+        for _ in range(self.rounds):
+            started = time.perf_counter()
+            fn()
+            seconds.append(time.perf_counter() - started)
+
+        _results.append(
+            BenchmarkResult(
+                name=self.name,
+                num_rows=self.num_rows,
+                rounds=self.rounds,
+                min_seconds=min(seconds),
+                median_seconds=float(np.median(seconds)),
+                peak_bytes=peak_bytes,
+                allocated_blocks=allocated_blocks,
+            )
+        )
+        return result
+
+
+def _rows_id(num_rows: int) -> str:
+    for divisor, suffix in [(1_000_000, "M"), (1_000, "k")]:
+        if num_rows >= divisor and num_rows % divisor == 0:
+            return f"{num_rows // divisor}{suffix}"
+    return str(num_rows)
+
+
+def pytest_addoption(parser: Any) -> None:
+    group = parser.getgroup("benchmark")
+    group.addoption(
+        "--benchmark-rows", default=DEFAULT_ROWS, help="Comma separated numbers of rows to benchmark with."
+    )
+    group.addoption("--benchmark-rounds", type=int, default=5, help="How many timed rounds to run.")
+    group.addoption("--benchmark-json", default=None, help="Path to write the results to as JSON.")
+
+
+def pytest_generate_tests(metafunc: Any) -> None:
+    if "num_rows" in metafunc.fixturenames:
+        sizes = [int(size) for size in metafunc.config.getoption("benchmark_rows").split(",")]
+        # Session scoped, so the data for each size is only generated once
+        metafunc.parametrize("num_rows", sizes, ids=[_rows_id(size) for size in sizes], scope="session")
+
+
+def pytest_terminal_summary(terminalreporter: Any, config: Any) -> None:
+    if not _results:
+        return
+
+    terminalreporter.section("benchmarks")
+    terminalreporter.write_line(
+        f"{'name':<50} {'rows':>9} {'min s':>9} {'median s':>9} {'rows/s':>12} {'peak MB':>9} {'blocks':>10}"
+    )
+    for result in _results:
+        terminalreporter.write_line(
+            f"{result.name:<50} {result.num_rows:>9} {result.min_seconds:>9.4f} {result.median_seconds:>9.4f} "
+            f"{result.rows_per_second:>12.0f} {result.peak_bytes / 2**20:>9.1f} {result.allocated_blocks:>10}"
+        )
+
+    path: Optional[str] = config.getoption("benchmark_json")
+    if path:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(
+                [dict(asdict(result), rows_per_second=result.rows_per_second) for result in _results], f, indent=2
+            )
+
+
+@pytest.fixture
+def benchmark(request: Any, num_rows: int) -> Benchmark:
+    return Benchmark(request.node.name, num_rows, request.config.getoption("benchmark_rounds"))
+
+
+@pytest.fixture(scope="session")
+def rows(num_rows: int) -> List[Dict[str, Any]]:
+    return synthetic_rows(CORPUS_CONFIG, num_rows, seed=0)
+
+
+@pytest.fixture(scope="session")
+def raw_items(rows: List[Dict[str, Any]]) -> List[RawInputItem]:
+    return [
+        (
+            RawInputItem.from_text(index, row["text"])
+            if "text" in row
+            else RawInputItem.from_message_dicts(index, row["chat_messages"])
+        )
+        for index, row in enumerate(rows)
+    ]
+
+
+@pytest.fixture(scope="session")
+def chat_messages(raw_items: List[RawInputItem]) -> List[ChatMessage]:
+    return [message for item in raw_items for message in item.messages]
+
+
+@pytest.fixture(scope="session")
+def completions(rows: List[Dict[str, Any]]) -> List[List[CompletionOutput]]:
+    # Each row's completion echoes its prompt, with a token per word
+    completions = []
+    for row in rows:
+        text = row["text"] if "text" in row else row["chat_messages"][-1]["content"]
+        token_ids = np.arange(text.count(" ") + 1, dtype=np.int32)
+        completions.append([CompletionOutput(index=0, text=text, token_ids=token_ids, finish_reason="stop")])
+    return completions
+
+
+@pytest.fixture(scope="session")
+def serialized_rows(rows: List[Dict[str, Any]], completions: List[List[CompletionOutput]]) -> List[Dict[str, Any]]:
+    return [default_serializer(row, outputs, None) for row, outputs in zip(rows, completions)]
+
+
+@pytest.fixture(scope="session")
+def prepared_batches(num_rows: int) -> List[PreparedBatch]:
+    return synthetic_prepared_batches(num_rows, TOKENIZATION_BATCH_SIZE)
+
+
+@pytest.fixture(scope="session")
+def sorted_batch(prepared_batches: List[PreparedBatch]) -> PreparedBatch:
+    return flatten_and_sort(prepared_batches)
+
+
+@pytest.fixture(scope="session")
+def io_processor() -> GenerateIOProcessor:
+    return GenerateIOProcessor(LLMModelConfig(name_or_path=BYTE_LEVEL_MODEL_DIR), FormatConfig())
@@ -0,0 +1,126 @@
+"""
+Synthetic JSONL corpora for benchmarks, shaped like real inputs: prompts of pseudo-words whose
+lengths follow a log-normal distribution, passthrough metadata, and optionally chat rows, some
+with an inline base64 image drawn from a small pool, so repeated images are as common as in real data.
+"""
+
+import base64
+from dataclasses import dataclass
+from io import BytesIO
+import json
+import math
+import os
+import random
+import string
+from typing import Any, Dict, List
+
+import numpy as np
+from PIL import Image
+
+from birr.batch_inference.data_models import PreparedBatch
+
+# A byte-level BPE tokenizer without merges (one token per UTF-8 byte) and a chat template that renders
+# images, so benchmarks run offline with prompt lengths that don't depend on the vocabulary
+BYTE_LEVEL_MODEL_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fixtures", "byte_level_model")
+
+
+@dataclass
+class CorpusConfig:
+    num_files: int = 4
+    rows_per_file: int = 2500
+    # Prompt lengths in words follow a log-normal distribution with this median; 0 sigma fixes them
+    median_words: int = 100
+    length_sigma: float = 0.8
+    max_words: int = 4000
+    # Fraction of text-only rows given as `chat_messages` rather than `text`
+    chat_fraction: float = 0.0
+    multimodal_fraction: float = 0.0
+    num_distinct_images: int = 16
+    image_size: int = 256
+    seed: int = 0
+
+
+def _vocabulary(rng: random.Random, size: int = 5000) -> List[str]:
+    return ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10))) for _ in range(size)]
+
+
+def _image_data_url(rng: random.Random, size: int) -> str:
+    # Noise, so the PNG is about as large as a photo of the same size
+    num_bytes = size * size * 3
+    image = Image.frombytes("RGB", (size, size), rng.getrandbits(num_bytes * 8).to_bytes(num_bytes, "little"))
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def synthetic_rows(config: CorpusConfig, num_rows: int, seed: int) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    vocabulary = _vocabulary(random.Random(config.seed))
+    images = (
+        [_image_data_url(rng, config.image_size) for _ in range(config.num_distinct_images)]
+        if config.multimodal_fraction
+        else []
+    )
+
+    rows = []
+    for index in range(num_rows):
+        num_words = int(config.median_words * math.exp(rng.gauss(0, config.length_sigma)))
+        text = " ".join(rng.choices(vocabulary, k=max(1, min(config.max_words, num_words))))
+        row: Dict[str, Any] = dict(
+            id=f"row-{seed}-{index}",
+            metadata=dict(source="synthetic", url=f"https://example.com/{seed}/{index}", score=rng.random()),
+        )
+
+        if images and rng.random() < config.multimodal_fraction:
+            row["chat_messages"] = [
+                dict(
+                    role="user",
+                    content=[
+                        dict(type="image_url", image_url=dict(url=rng.choice(images))),
+                        dict(type="text", text=text),
+                    ],
+                )
+            ]
+        elif config.chat_fraction and rng.random() < config.chat_fraction:
+            row["chat_messages"] = [dict(role="user", content=text)]
+        else:
+            row["text"] = text
+
+        rows.append(row)
+
+    return rows
+
+
+def write_corpus(directory: str, config: CorpusConfig) -> List[str]:
+    """Writes `config.num_files` JSONL files to `directory`, and returns their paths."""
+    os.makedirs(directory, exist_ok=True)
+
+    paths = []
+    for file_index in range(config.num_files):
+        path = os.path.join(directory, f"part-{file_index:05d}.jsonl")
+        with open(path, "w") as f:
+            for row in synthetic_rows(config, config.rows_per_file, seed=config.seed * 1_000_003 + file_index):
+                f.write(json.dumps(row) + "\n")
+        paths.append(path)
+
+    return paths
+
+
+def synthetic_prepared_batches(
+    num_rows: int, batch_size: int = 3000, median_tokens: int = 60, seed: int = 0
+) -> List[PreparedBatch]:
+    """
+    Prepared batches as tokenizers return them, of `batch_size` rows each, with log-normal prompt
+    lengths and random token ids, for benchmarking what happens to them after tokenization.
+    """
+    rng = np.random.default_rng(seed)
+    batches = []
+    for start in range(0, num_rows, batch_size):
+        stop = min(num_rows, start + batch_size)
+        lengths = np.clip((median_tokens * rng.lognormal(0, 0.8, stop - start)).astype(np.int64), 1, 32768)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        token_ids = rng.integers(0, 32000, int(offsets[-1]), dtype=np.int32)
+        batches.append(PreparedBatch(np.arange(start, stop, dtype=np.int64), token_ids, offsets))
+
+    return batches
@@ -0,0 +1,187 @@
+"""
+End-to-end CPU benchmark of the Ray pipeline: queue, tokenizers, workers, decoding and writing, with
+`DummyPredictor`s echoing prompts back in place of vLLM, so no GPU is needed and regressions in the
+orchestration around generation show up directly.
+
+Reports rows per second, time spent per stage (from the spans of `birr.batch_inference.tracing`) and
+the peak RSS of every actor, as JSON, to compare commits, e.g.
+
+    python -m benchmarks.pipeline --num-files 8 --rows-per-file 25000 --output results/$(git rev-parse --short HEAD).json
+"""
+
+from collections import defaultdict
+from dataclasses import asdict
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import click
+import ray
+
+from benchmarks.corpus import BYTE_LEVEL_MODEL_DIR, CorpusConfig, write_corpus
+from birr.batch_inference.queue.dummy_predictor import DummyPredictor
+from birr.batch_inference.runner import start_pipeline
+from birr.batch_inference.settings import Settings
+from birr.batch_inference.tracing import TRACE_DIR_ENV_VAR, merge_traces
+from birr.core.config import GenerateConfig, LLMModelConfig, PipelineConfig
+
+logger = logging.getLogger(__name__)
+
+
+def _peak_rss_bytes(_actor: Any) -> int:
+    # Kilobytes on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _stage_times(trace_path: str) -> Dict[str, Dict[str, float]]:
+    """Number of spans and total seconds spent per stage, keyed by `<role>/<stage>`."""
+    with open(trace_path, "r") as f:
+        events = json.load(f)["traceEvents"]
+
+    stages: Dict[str, Dict[str, float]] = defaultdict(lambda: dict(count=0, seconds=0.0))
+    for event in events:
+        if event["ph"] == "X":
+            stage = stages[f"{event['cat']}/{event['name']}"]
+            stage["count"] += 1
+            stage["seconds"] += event["dur"] / 1e6
+
+    return dict(sorted(stages.items()))
+
+
+def run_benchmark(
+    corpus_config: CorpusConfig, pipeline_overrides: Dict[str, Any], num_predictors: int, work_dir: str
+) -> Dict[str, Any]:
+    input_dir, output_dir, trace_dir = [os.path.join(work_dir, name) for name in ("input", "output", "trace")]
+    write_corpus(input_dir, corpus_config)
+    os.makedirs(output_dir)
+
+    pipeline_config = PipelineConfig(
+        input_file_dir=input_dir,
+        output_file_dir=output_dir,
+        num_gpus=num_predictors,
+        **{"generation_batch_size": 256, **pipeline_overrides},
+    )
+    settings = Settings(
+        llm_model_config=LLMModelConfig(
+            name_or_path=BYTE_LEVEL_MODEL_DIR, vlm=bool(corpus_config.multimodal_fraction)
+        ),
+        generate_config=GenerateConfig(),
+        pipeline_config=pipeline_config,
+    )
+
+    ray.init(
+        # Enough logical CPUs to place every actor, even if that oversubscribes a small machine
+        num_cpus=max(
+            os.cpu_count() or 1, pipeline_config.num_tokenizers + pipeline_config.num_workers + num_predictors + 1
+        ),
+        # Predictors are placed on logical GPUs, which only need to be declared
+        num_gpus=num_predictors,
+        include_dashboard=False,
+        runtime_env=dict(env_vars={TRACE_DIR_ENV_VAR: trace_dir}),
+    )
+    try:
+        pipeline = start_pipeline(settings, predictor_class=DummyPredictor)
+        actors = [pipeline.queue, *pipeline.tokenizers, *pipeline.predictors, *pipeline.workers]
+        # Actors are constructed before the clock starts, so loading tokenizers isn't measured
+        ray.get([actor.__ray_ready__.remote() for actor in actors])
+
+        started = time.perf_counter()
+        ray.get([worker.run.remote() for worker in pipeline.workers])
+        seconds = time.perf_counter() - started
+
+        peak_rss_bytes: Dict[str, List[int]] = {
+            role: ray.get([actor.__ray_call__.remote(_peak_rss_bytes) for actor in role_actors])
+            for role, role_actors in [
+                ("queue", [pipeline.queue]),
+                ("tokenizers", pipeline.tokenizers),
+                ("predictors", pipeline.predictors),
+                ("workers", pipeline.workers),
+            ]
+        }
+    finally:
+        ray.shutdown()
+
+    num_rows = 0
+    for file_name in os.listdir(output_dir):
+        with open(os.path.join(output_dir, file_name), "r") as f:
+            num_rows += sum(1 for _ in f)
+    expected_rows = corpus_config.num_files * corpus_config.rows_per_file
+    if num_rows != expected_rows:
+        raise RuntimeError(f"Expected {expected_rows} output rows, found {num_rows}")
+
+    return dict(
+        git_commit=_git_commit(),
+        timestamp=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        corpus=asdict(corpus_config),
+        pipeline=pipeline_config.model_dump(exclude={"input_file_dir", "output_file_dir"}),
+        num_predictors=num_predictors,
+        rows=num_rows,
+        seconds=seconds,
+        rows_per_second=num_rows / seconds,
+        stages=_stage_times(merge_traces(trace_dir)),
+        peak_rss_bytes=peak_rss_bytes,
+    )
+
+
+@click.command()
+@click.option("--num-files", default=4, help="How many input files to generate.")
+@click.option("--rows-per-file", default=2500, help="How many rows each input file has.")
+@click.option("--median-words", default=100, help="Median prompt length, in words.")
+@click.option("--length-sigma", default=0.8, help="Sigma of the log-normal prompt lengths; 0 fixes them.")
+@click.option("--multimodal-fraction", default=0.0, help="Fraction of rows that are chats with an image.")
+@click.option("--num-predictors", default=2, help="How many `DummyPredictor`s to run.")
+@click.option(
+    "--pipeline-config",
+    "pipeline_config_json",
+    default="{}",
+    help='JSON of `PipelineConfig` fields to override, e.g. \'{"num_workers": 2, "num_tokenizers": 4}\'.',
+)
+@click.option("--seed", default=0, help="Seed of the synthetic corpus.")
+@click.option("--output", default=None, help="Path to write the results JSON to, besides printing it.")
+def cli(
+    num_files: int,
+    rows_per_file: int,
+    median_words: int,
+    length_sigma: float,
+    multimodal_fraction: float,
+    num_predictors: int,
+    pipeline_config_json: str,
+    seed: int,
+    output: Optional[str],
+) -> None:
+    corpus_config = CorpusConfig(
+        num_files=num_files,
+        rows_per_file=rows_per_file,
+        median_words=median_words,
+        length_sigma=length_sigma,
+        multimodal_fraction=multimodal_fraction,
+        seed=seed,
+    )
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = run_benchmark(corpus_config, json.loads(pipeline_config_json), num_predictors, work_dir)
+
+    results_json = json.dumps(results, indent=2)
+    print(results_json)
+    if output:
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w") as f:
+            f.write(results_json + "\n")
+
+
+if __name__ == "__main__":
+    cli()
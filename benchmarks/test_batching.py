@@ -0,0 +1,37 @@
+from typing import Any, Dict, List
+
+from benchmarks.conftest import TOKENIZATION_BATCH_SIZE, Benchmark
+from birr.batch_inference.data_models import PreparedBatch
+from birr.batch_inference.utils import flatten_and_sort, prediction_batches, simple_chunks, token_budget_batches
+
+GENERATION_BATCH_SIZE = [(128, 512), (512, 256), (2048, 64), (32768, 16)]
+
+
+def test__simple_chunks_of_rows(benchmark: Benchmark, rows: List[Dict[str, Any]]) -> None:
+    chunks = benchmark(lambda: list(simple_chunks(rows, TOKENIZATION_BATCH_SIZE)))
+    assert sum(len(chunk) for chunk in chunks) == len(rows)
+
+
+def test__simple_chunks_of_prepared_batch(benchmark: Benchmark, sorted_batch: PreparedBatch) -> None:
+    chunks = benchmark(lambda: list(simple_chunks(sorted_batch, 256)))
+    assert sum(len(chunk) for chunk in chunks) == len(sorted_batch)
+
+
+def test__prediction_batches(benchmark: Benchmark, sorted_batch: PreparedBatch) -> None:
+    batches = benchmark(lambda: list(prediction_batches(sorted_batch, GENERATION_BATCH_SIZE)))
+    assert sum(len(batch) for batch in batches) == len(sorted_batch)
+
+
+def test__token_budget_batches(benchmark: Benchmark, sorted_batch: PreparedBatch) -> None:
+    batches = benchmark(lambda: list(token_budget_batches(sorted_batch, 65536, max_tokens=256)))
+    assert sum(len(batch) for batch in batches) == len(sorted_batch)
+
+
+def test__flatten_and_sort(benchmark: Benchmark, prepared_batches: List[PreparedBatch]) -> None:
+    sorted_batch = benchmark(lambda: flatten_and_sort(prepared_batches))
+    assert len(sorted_batch) == sum(len(batch) for batch in prepared_batches)
+
+
+def test__flatten_and_sort_by_prefix(benchmark: Benchmark, prepared_batches: List[PreparedBatch]) -> None:
+    sorted_batch = benchmark(lambda: flatten_and_sort(prepared_batches, prefix_bucket_size=16))
+    assert len(sorted_batch) == sum(len(batch) for batch in prepared_batches)
@@ -0,0 +1,46 @@
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+import pytest
+
+from benchmarks.conftest import Benchmark
+from birr.batch_inference.utils import (
+    load_instances_from_local_file,
+    open_for_writing,
+    write_predictions_to_local_file,
+)
+
+COMPRESSIONS = [None, "zstd"]
+SUFFIXES = {None: ".jsonl", "zstd": ".jsonl.zst"}
+
+
+@pytest.fixture(scope="session")
+def input_files(rows: List[Dict[str, Any]], tmp_path_factory: Any) -> Dict[Optional[str], str]:
+    directory = tmp_path_factory.mktemp("input")
+    data = "\n".join(json.dumps(row) for row in rows).encode("utf-8")
+
+    paths = {}
+    for compression in COMPRESSIONS:
+        path = os.path.join(directory, f"rows{SUFFIXES[compression]}")
+        with open_for_writing(path, compression) as f:
+            f.write(data)
+        paths[compression] = path
+    return paths
+
+
+@pytest.mark.parametrize("compression", COMPRESSIONS, ids=["plain", "zstd"])
+def test__load_instances_from_local_file(
+    benchmark: Benchmark, input_files: Dict[Optional[str], str], compression: Optional[str]
+) -> None:
+    instances = benchmark(lambda: load_instances_from_local_file(input_files[compression]))
+    assert len(instances) == benchmark.num_rows
+
+
+@pytest.mark.parametrize("compression", COMPRESSIONS, ids=["plain", "zstd"])
+def test__write_predictions_to_local_file(
+    benchmark: Benchmark, serialized_rows: List[Dict[str, Any]], tmp_path: Any, compression: Optional[str]
+) -> None:
+    input_file_path = os.path.join("input", f"rows{SUFFIXES[compression]}")
+    benchmark(lambda: write_predictions_to_local_file(serialized_rows, input_file_path, str(tmp_path)))
+    assert os.listdir(tmp_path) == [os.path.basename(input_file_path)]
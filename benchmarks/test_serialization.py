@@ -0,0 +1,78 @@
+import json
+from typing import Any, Dict, List
+
+import pytest
+
+from benchmarks.conftest import Benchmark
+from birr.batch_inference.data_models import ChatMessage, CompletionOutput, InputRow, RawInputItem
+from birr.batch_inference.json_codec import decode_input_row, encode_output_row, encode_output_rows
+from birr.batch_inference.serializer import default_serializer
+
+
+@pytest.fixture(scope="session")
+def lines(rows: List[Dict[str, Any]]) -> List[bytes]:
+    return [json.dumps(row).encode("utf-8") for row in rows]
+
+
+@pytest.fixture(scope="session")
+def input_rows(lines: List[bytes]) -> List[InputRow]:
+    return [decode_input_row(line) for line in lines]
+
+
+def test__raw_input_items_from_rows(benchmark: Benchmark, rows: List[Dict[str, Any]]) -> None:
+    # As the worker does before tokenization
+    items = benchmark(
+        lambda: [
+            (
+                RawInputItem.from_text(index, row["text"])
+                if "text" in row
+                else RawInputItem.from_message_dicts(index, row["chat_messages"])
+            )
+            for index, row in enumerate(rows)
+        ]
+    )
+    assert len(items) == len(rows)
+
+
+def test__chat_message_from_dict(benchmark: Benchmark, chat_messages: List[ChatMessage]) -> None:
+    message_dicts = [message.to_dict() for message in chat_messages]
+    messages = benchmark(lambda: [ChatMessage.from_dict(message_dict) for message_dict in message_dicts])
+    assert messages == chat_messages
+
+
+def test__chat_message_copy(benchmark: Benchmark, chat_messages: List[ChatMessage]) -> None:
+    copies = benchmark(lambda: [message.copy() for message in chat_messages])
+    assert copies == chat_messages
+
+
+def test__default_serializer(
+    benchmark: Benchmark, rows: List[Dict[str, Any]], completions: List[List[CompletionOutput]]
+) -> None:
+    serialized = benchmark(
+        lambda: [default_serializer(row, outputs, None) for row, outputs in zip(rows, completions)]
+    )
+    assert len(serialized) == len(rows)
+
+
+def test__decode_lines(benchmark: Benchmark, lines: List[bytes]) -> None:
+    instances = benchmark(lambda: [json.loads(line) for line in lines])
+    assert len(instances) == len(lines)
+
+
+def test__decode_input_rows(benchmark: Benchmark, lines: List[bytes]) -> None:
+    input_rows = benchmark(lambda: [decode_input_row(line) for line in lines])
+    assert len(input_rows) == len(lines)
+
+
+def test__encode_serialized_rows(benchmark: Benchmark, serialized_rows: List[Dict[str, Any]]) -> None:
+    encoded = benchmark(lambda: encode_output_rows(serialized_rows))
+    assert len(encoded) == len(serialized_rows)
+
+
+def test__encode_output_rows(
+    benchmark: Benchmark, input_rows: List[InputRow], completions: List[List[CompletionOutput]]
+) -> None:
+    encoded = benchmark(
+        lambda: [encode_output_row(row, outputs, None) for row, outputs in zip(input_rows, completions)]
+    )
+    assert len(encoded) == len(input_rows)
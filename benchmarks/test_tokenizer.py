@@ -0,0 +1,63 @@
+from typing import List
+
+import numpy as np
+import pytest
+
+from benchmarks.conftest import TOKENIZATION_BATCH_SIZE, Benchmark
+from birr.batch_inference.data_models import CompletedBatch, RawInputItem
+from birr.batch_inference.generate_io_processor import GenerateIOProcessor
+from birr.batch_inference.utils import simple_chunks
+
+# Tokenizers only ever see one batch at a time, so more rows add time but no insight
+MAX_ROWS = 100_000
+
+
+@pytest.fixture(scope="session")
+def raw_item_batches(raw_items: List[RawInputItem]) -> List[List[RawInputItem]]:
+    if len(raw_items) > MAX_ROWS:
+        pytest.skip(f"Tokenizer benchmarks run on at most {MAX_ROWS} rows")
+    return list(simple_chunks(raw_items, TOKENIZATION_BATCH_SIZE))
+
+
+@pytest.fixture(scope="session")
+def completed_batches(
+    io_processor: GenerateIOProcessor, raw_item_batches: List[List[RawInputItem]]
+) -> List[CompletedBatch]:
+    # Completions echoing the prompts, so they decode to real text
+    completed_batches = []
+    for batch in raw_item_batches:
+        prepared = io_processor.prepare_inputs(batch)
+        completed_batches.append(
+            CompletedBatch(
+                indices=prepared.indices,
+                output_indices=np.zeros(len(prepared), dtype=np.int64),
+                token_ids=prepared.token_ids,
+                offsets=prepared.offsets,
+                finish_reasons=["stop"] * len(prepared),
+                stop_reasons=[None] * len(prepared),
+                errors=[None] * len(prepared),
+                texts=[""] * len(prepared),
+            )
+        )
+    return completed_batches
+
+
+def test__tokenize(
+    benchmark: Benchmark, io_processor: GenerateIOProcessor, raw_item_batches: List[List[RawInputItem]]
+) -> None:
+    tokenized = benchmark(lambda: [io_processor.tokenize(batch) for batch in raw_item_batches])
+    assert sum(len(batch) for batch in tokenized) == benchmark.num_rows
+
+
+def test__prepare_inputs(
+    benchmark: Benchmark, io_processor: GenerateIOProcessor, raw_item_batches: List[List[RawInputItem]]
+) -> None:
+    prepared = benchmark(lambda: [io_processor.prepare_inputs(batch) for batch in raw_item_batches])
+    assert sum(len(batch) for batch in prepared) == benchmark.num_rows
+
+
+def test__decode(
+    benchmark: Benchmark, io_processor: GenerateIOProcessor, completed_batches: List[CompletedBatch]
+) -> None:
+    decoded = benchmark(lambda: [io_processor.decode(batch) for batch in completed_batches])
+    assert all(text for batch in decoded for text in batch.texts)
@@ -0,0 +1,105 @@
+"""
+Online tuning of generation batch sizes from how predictors fare on the batches they are sent.
+
+Each length bracket of `PipelineConfig.generation_batch_size` (or the single flat size) gets its
+own batch size, adjusted after every full batch: it shrinks when vLLM had to preempt sequences,
+which means the KV cache overflowed, grows while throughput in tokens per second keeps up with
+the best seen so far, and backs off a little once throughput falls behind it.
+"""
+
+import logging
+from typing import Iterator, List, Optional, Tuple, Union
+
+from birr.batch_inference.data_models import BatchStats, PreparedBatch
+from birr.batch_inference.utils import token_lengths
+
+logger = logging.getLogger(__name__)
+
+
+GROWTH_FACTOR = 1.25
+PREEMPTION_BACKOFF_FACTOR = 0.7
+SLOWDOWN_BACKOFF_FACTOR = 0.9
+# Throughput this much below the best seen counts as a slowdown rather than noise
+SLOWDOWN_TOLERANCE = 0.05
+# Batches smaller than this fraction of the current size, e.g. a file's last one, say little about it
+MIN_FILL_TO_RECORD = 0.5
+
+
+class BatchSizeController:
+    def __init__(
+        self,
+        generation_batch_size: Union[int, List[Tuple[int, int]]],
+        min_batch_size: int,
+        max_batch_size: int,
+        sequences_per_prompt: int = 1,
+    ) -> None:
+        brackets: List[Tuple[Optional[int], int]] = (
+            [(None, generation_batch_size)]
+            if isinstance(generation_batch_size, int)
+            else [(threshold, batch_size) for threshold, batch_size in generation_batch_size]
+        )
+        # Upper bounds on the prompt length of each bracket; the last bracket takes everything longer
+        self._thresholds: List[Optional[int]] = [threshold for threshold, _ in brackets]
+        # Batch sizes count decoded sequences, as in `prediction_batches`
+        self._min_batch_size = max(1, min_batch_size // sequences_per_prompt)
+        self._max_batch_size = max(1, max_batch_size // sequences_per_prompt)
+        self._batch_sizes = [self._clamp(batch_size // sequences_per_prompt) for _, batch_size in brackets]
+        self._best_throughputs = [0.0] * len(brackets)
+
+    def batch_size(self, bracket: int) -> int:
+        return int(self._batch_sizes[bracket])
+
+    def bracket_for(self, num_tokens: int) -> int:
+        for bracket, threshold in enumerate(self._thresholds[:-1]):
+            if threshold is not None and num_tokens <= threshold:
+                return bracket
+        return len(self._thresholds) - 1
+
+    def batches(self, l: PreparedBatch) -> Iterator[PreparedBatch]:
+        """
+        Splits length-sorted rows into batches of the current size of their bracket. Sizes are
+        read as each batch is cut, so batches taken later reflect the stats recorded meanwhile.
+        """
+        lengths = token_lengths(l)
+        start = 0
+        while start < len(lengths):
+            bracket = self.bracket_for(lengths[start])
+            stop = min(len(lengths), start + self.batch_size(bracket))
+            for position in range(start + 1, stop):
+                if self.bracket_for(lengths[position]) != bracket:
+                    stop = position
+                    break
+
+            yield l[start:stop]
+            start = stop
+
+    def record(self, stats: BatchStats) -> None:
+        bracket = self.bracket_for(stats.longest_prompt)
+        current = self._batch_sizes[bracket]
+        if stats.num_prompts < current * MIN_FILL_TO_RECORD or stats.generation_seconds <= 0:
+            return
+
+        throughput = stats.num_tokens / stats.generation_seconds
+        best = self._best_throughputs[bracket]
+
+        if stats.num_preemptions:
+            updated = self._clamp(current * PREEMPTION_BACKOFF_FACTOR)
+            reason = f"{stats.num_preemptions} preemptions"
+        elif throughput >= best * (1 - SLOWDOWN_TOLERANCE):
+            self._best_throughputs[bracket] = max(best, throughput)
+            updated = self._clamp(current * GROWTH_FACTOR)
+            reason = f"throughput of {throughput:.0f} tokens/s"
+        else:
+            # Forget the best so we follow conditions that changed, e.g. longer outputs later on
+            self._best_throughputs[bracket] = throughput
+            updated = self._clamp(current * SLOWDOWN_BACKOFF_FACTOR)
+            reason = f"throughput of {throughput:.0f} tokens/s, down from {best:.0f}"
+
+        if int(updated) != int(current):
+            logger.info(
+                f"Changing batch size of bracket {bracket} from {int(current)} to {int(updated)} after {reason}"
+            )
+        self._batch_sizes[bracket] = updated
+
+    def _clamp(self, batch_size: float) -> float:
+        return min(float(self._max_batch_size), max(float(self._min_batch_size), batch_size))
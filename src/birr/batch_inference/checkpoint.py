@@ -0,0 +1,155 @@
+"""
+Row-level checkpointing of a single file's output.
+
+Completed rows are appended to a partial output file, and after every flush
+the flushed row indices are logged to a sidecar checkpoint together with the
+partial file's new length. Anything in the partial file past the last logged
+length is discarded on resume, so a crash between the two writes can neither
+duplicate nor orphan rows.
+"""
+
+import json
+import logging
+import os
+from typing import IO, ContextManager, List, Set, Tuple
+
+from birr.batch_inference.json_codec import OutputRow, encode_output_rows
+from birr.batch_inference.utils import (
+    checkpoint_file_path_for,
+    compression_for,
+    open_for_reading,
+    open_for_writing,
+    partial_output_file_path_for,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class RowCheckpoint:
+    def __init__(
+        self,
+        output_file_path: str,
+        resume: bool = True,
+        compression_level: int = 3,
+        compression_threads: int = 0,
+    ) -> None:
+        self.output_file_path = output_file_path
+        # The partial output is compressed like the final one so that promoting it is just a rename
+        self.compression = compression_for(output_file_path)
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
+        self.partial_file_path = partial_output_file_path_for(output_file_path)
+        self.checkpoint_file_path = checkpoint_file_path_for(output_file_path)
+
+        # Row indices in the order their rows appear in the partial file
+        self._flushed_indices: List[int] = []
+        self._pending: List[Tuple[int, OutputRow]] = []
+
+        if not (resume and self._restore()):
+            self._reset()
+
+    @property
+    def completed_indices(self) -> Set[int]:
+        return set(self._flushed_indices)
+
+    @property
+    def num_pending(self) -> int:
+        return len(self._pending)
+
+    def add(self, index: int, row: OutputRow) -> None:
+        self._pending.append((index, row))
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+
+        with self._open_partial_for_writing(self.partial_file_path, append=True) as f:
+            f.write(b"".join(line + b"\n" for line in encode_output_rows(row for _, row in self._pending)))
+        end_offset = os.path.getsize(self.partial_file_path)
+
+        indices = [index for index, _ in self._pending]
+        with open(self.checkpoint_file_path, "a") as f:
+            f.write(json.dumps(dict(end_offset=end_offset, indices=indices)))
+            f.write("\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._flushed_indices.extend(indices)
+        self._pending = []
+
+    def promote(self) -> None:
+        """Flush what's left and atomically move the partial output to its final path in input order."""
+        self.flush()
+
+        if not os.path.exists(self.partial_file_path):
+            open(self.partial_file_path, "wb").close()
+
+        if any(a > b for a, b in zip(self._flushed_indices, self._flushed_indices[1:])):
+            self._reorder_partial_file()
+
+        os.replace(self.partial_file_path, self.output_file_path)
+        os.remove(self.checkpoint_file_path)
+
+    def _reorder_partial_file(self) -> None:
+        with open_for_reading(self.partial_file_path, self.compression) as f:
+            lines = [line for line in f]
+
+        assert len(lines) == len(self._flushed_indices), "Partial output and checkpoint are out of sync"
+
+        reordered_file_path = f"{self.partial_file_path}.reordered"
+        with self._open_partial_for_writing(reordered_file_path) as f:
+            for _, line in sorted(zip(self._flushed_indices, lines), key=lambda pair: pair[0]):
+                f.write(line)
+
+        os.replace(reordered_file_path, self.partial_file_path)
+
+    def _open_partial_for_writing(self, file_path: str, append: bool = False) -> ContextManager[IO[bytes]]:
+        return open_for_writing(
+            file_path,
+            self.compression,
+            append=append,
+            compression_level=self.compression_level,
+            compression_threads=self.compression_threads,
+            sync=True,
+        )
+
+    def _restore(self) -> bool:
+        if not (os.path.exists(self.checkpoint_file_path) and os.path.exists(self.partial_file_path)):
+            return False
+
+        end_offset = 0
+        flushed_indices: List[int] = []
+        with open(self.checkpoint_file_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn final write; everything it covered is past `end_offset` and gets truncated below.
+                    break
+                end_offset = entry["end_offset"]
+                flushed_indices.extend(entry["indices"])
+
+        if os.path.getsize(self.partial_file_path) < end_offset:
+            logger.warning(
+                f"Partial output {self.partial_file_path} is shorter than its checkpoint, starting over"
+            )
+            return False
+
+        os.truncate(self.partial_file_path, end_offset)
+        # Compact the sidecar so a torn trailing entry can't be followed by new, valid ones
+        compacted_file_path = f"{self.checkpoint_file_path}.compacted"
+        with open(compacted_file_path, "w") as f:
+            if flushed_indices:
+                f.write(json.dumps(dict(end_offset=end_offset, indices=flushed_indices)))
+                f.write("\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(compacted_file_path, self.checkpoint_file_path)
+
+        self._flushed_indices = flushed_indices
+        logger.info(f"Resuming {self.output_file_path} with {len(flushed_indices)} rows already completed")
+        return True
+
+    def _reset(self) -> None:
+        open(self.partial_file_path, "wb").close()
+        open(self.checkpoint_file_path, "w").close()
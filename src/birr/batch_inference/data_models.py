@@ -1,11 +1,25 @@
 from dataclasses import dataclass
 from enum import Enum
-from typing import Any, Dict, List, Optional, Union
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 
 
+import numpy as np
+import numpy.typing as npt
 from PIL import Image
 
 
+# Token ids travel through the pipeline as int32 arrays, which Ray serializes as one buffer
+# instead of element by element. Plain lists are accepted too.
+TokenIds = Union[List[int], npt.NDArray[np.int32]]
+
+
+def token_ids_to_list(token_ids: TokenIds) -> List[int]:
+    if isinstance(token_ids, np.ndarray):
+        return token_ids.tolist()
+    return token_ids
+
+
 @dataclass
 class TextChatMessageContent:
     text: str
@@ -98,7 +112,7 @@ class ChatMessage:
 class CompletionOutput:
     index: int
     text: str
-    token_ids: List[int]
+    token_ids: TokenIds
     finish_reason: Optional[str] = None
     stop_reason: Union[int, str, None] = None
 
@@ -118,11 +132,43 @@ class RawInputItem:
         return RawInputItem(index=index, messages=messages)
 
 
+@dataclass
+class InputRow:
+    """
+    An input line decoded only as far as its prompt. The line itself is kept to be written back out
+    with the outputs appended, so passthrough fields (ids, metadata, ...) are never re-encoded.
+    """
+
+    line: bytes
+    messages: List[ChatMessage]
+    # Whether the line already has fields the outputs would replace, so they can't just be appended
+    has_output_fields: bool = False
+
+
+@dataclass
+class EncodedImage:
+    """
+    An image kept in its compressed file format (e.g. PNG or JPEG) on its way to the predictor,
+    which is much smaller to pickle and hold in the object store than decoded pixels.
+
+    Rows repeating an image share one instance with the same `key`, a hash of the original
+    image data, so a batch pickles each unique image once and the predictor decodes it once.
+    """
+
+    data: bytes
+    key: bytes
+
+    def decode(self) -> Image.Image:
+        image = Image.open(BytesIO(self.data))
+        image.load()
+        return image
+
+
 @dataclass
 class PreparedInputItem:
     index: int
-    token_ids: List[int]
-    image_data: Optional[List[Image.Image]] = None
+    token_ids: TokenIds
+    image_data: Optional[List[EncodedImage]] = None
 
 
 @dataclass
@@ -134,7 +180,7 @@ class TextItem:
 @dataclass
 class TokenizedItem:
     index: int
-    token_ids: List[int]
+    token_ids: TokenIds
 
 
 class CompletionError(str, Enum):
@@ -148,9 +194,298 @@ class CompletedItem:
     error: Optional[CompletionError] = None
 
 
+def ragged_from_arrays(arrays: Sequence[TokenIds]) -> Tuple[npt.NDArray[np.int32], npt.NDArray[np.int64]]:
+    """Concatenates per-row token ids into one flat array plus `len(arrays) + 1` row offsets."""
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    np.cumsum([len(array) for array in arrays], out=offsets[1:])
+    if not arrays:
+        return np.empty(0, dtype=np.int32), offsets
+    return np.concatenate([np.asarray(array, dtype=np.int32) for array in arrays]), offsets
+
+
+def ragged_take(
+    token_ids: npt.NDArray[np.int32], offsets: npt.NDArray[np.int64], positions: npt.NDArray[np.int64]
+) -> Tuple[npt.NDArray[np.int32], npt.NDArray[np.int64]]:
+    """Gathers the rows at `positions` of a flat array plus offsets, without a Python loop over rows."""
+    lengths = (offsets[1:] - offsets[:-1])[positions]
+    new_offsets = np.zeros(len(positions) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    gather = np.repeat(offsets[:-1][positions] - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+    return token_ids[gather], new_offsets
+
+
+@dataclass(eq=False)
+class PreparedBatch:
+    """
+    Columnar batch of prepared inputs. Row `i` is input row `indices[i]`, with token ids
+    `token_ids[offsets[i]:offsets[i + 1]]`. Slicing returns views; `take` gathers rows.
+    """
+
+    indices: npt.NDArray[np.int64]
+    token_ids: npt.NDArray[np.int32]
+    offsets: npt.NDArray[np.int64]
+    image_data: Optional[List[Optional[List[EncodedImage]]]] = None
+
+    @staticmethod
+    def from_token_ids(
+        indices: Sequence[int],
+        token_ids: Sequence[TokenIds],
+        image_data: Optional[List[Optional[List[EncodedImage]]]] = None,
+    ) -> "PreparedBatch":
+        flat_token_ids, offsets = ragged_from_arrays(token_ids)
+        return PreparedBatch(np.asarray(indices, dtype=np.int64), flat_token_ids, offsets, image_data)
+
+    @staticmethod
+    def from_items(items: Sequence[PreparedInputItem]) -> "PreparedBatch":
+        image_data = [item.image_data for item in items]
+        return PreparedBatch.from_token_ids(
+            [item.index for item in items],
+            [item.token_ids for item in items],
+            image_data if any(images is not None for images in image_data) else None,
+        )
+
+    @staticmethod
+    def concat(batches: Sequence["PreparedBatch"]) -> "PreparedBatch":
+        if not batches:
+            return PreparedBatch.from_token_ids([], [])
+
+        offsets = [batches[0].offsets[:1]]
+        for batch, shift in zip(batches, np.cumsum([0] + [len(batch.token_ids) for batch in batches[:-1]])):
+            offsets.append(batch.offsets[1:] + shift)
+
+        image_data = None
+        if any(batch.image_data is not None for batch in batches):
+            # Batches from different tokenizers hold their own copies of shared images, keep only one
+            unique_images: Dict[bytes, EncodedImage] = {}
+            image_data = [
+                None if images is None else [unique_images.setdefault(image.key, image) for image in images]
+                for batch in batches
+                for images in (batch.image_data or [None] * len(batch))
+            ]
+
+        return PreparedBatch(
+            indices=np.concatenate([batch.indices for batch in batches]),
+            token_ids=np.concatenate([batch.token_ids for batch in batches]),
+            offsets=np.concatenate(offsets),
+            image_data=image_data,
+        )
+
+    @property
+    def lengths(self) -> npt.NDArray[np.int64]:
+        return self.offsets[1:] - self.offsets[:-1]
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def row_token_ids(self, position: int) -> npt.NDArray[np.int32]:
+        return self.token_ids[self.offsets[position] : self.offsets[position + 1]]
+
+    def prompt_key(self, position: int) -> Tuple[bytes, ...]:
+        """Everything that makes up the row's prompt: its token ids' bytes followed by its images' keys."""
+        images = self.image_data[position] if self.image_data is not None else None
+        return (self.row_token_ids(position).tobytes(), *(image.key for image in images or []))
+
+    def row(self, position: int) -> PreparedInputItem:
+        return PreparedInputItem(
+            index=int(self.indices[position]),
+            token_ids=self.row_token_ids(position),
+            image_data=self.image_data[position] if self.image_data is not None else None,
+        )
+
+    def __getitem__(self, key: slice) -> "PreparedBatch":
+        start, stop, step = key.indices(len(self))
+        assert step == 1, "Only contiguous slices are supported"
+        stop = max(start, stop)
+        return PreparedBatch(
+            indices=self.indices[start:stop],
+            token_ids=self.token_ids[self.offsets[start] : self.offsets[stop]],
+            offsets=self.offsets[start : stop + 1] - self.offsets[start],
+            image_data=self.image_data[start:stop] if self.image_data is not None else None,
+        )
+
+    def take(self, positions: npt.NDArray[np.int64]) -> "PreparedBatch":
+        token_ids, offsets = ragged_take(self.token_ids, self.offsets, positions)
+        return PreparedBatch(
+            indices=self.indices[positions],
+            token_ids=token_ids,
+            offsets=offsets,
+            image_data=[self.image_data[p] for p in positions] if self.image_data is not None else None,
+        )
+
+    def to_items(self) -> List[PreparedInputItem]:
+        return [self.row(position) for position in range(len(self))]
+
+
+@dataclass
+class BatchStats:
+    """How a predictor fared on one batch, so batch sizes can be tuned while a job runs."""
+
+    num_prompts: int
+    longest_prompt: int
+    # Prompt plus generated tokens
+    num_tokens: int
+    generation_seconds: float
+    num_preemptions: int = 0
+
+    @staticmethod
+    def measure(
+        batch: PreparedBatch, completed: "CompletedBatch", generation_seconds: float, num_preemptions: int = 0
+    ) -> "BatchStats":
+        lengths = batch.lengths
+        return BatchStats(
+            num_prompts=len(batch),
+            longest_prompt=int(lengths.max()) if len(batch) else 0,
+            num_tokens=int(lengths.sum()) + len(completed.token_ids),
+            generation_seconds=generation_seconds,
+            num_preemptions=num_preemptions,
+        )
+
+
+@dataclass(eq=False)
+class CompletedBatch:
+    """
+    Columnar batch of completions with one entry per output, grouped by input row. A row that
+    failed has a single entry with no tokens and its `errors` set.
+    """
+
+    indices: npt.NDArray[np.int64]
+    output_indices: npt.NDArray[np.int64]
+    token_ids: npt.NDArray[np.int32]
+    offsets: npt.NDArray[np.int64]
+    finish_reasons: List[Optional[str]]
+    stop_reasons: List[Union[int, str, None]]
+    errors: List[Optional[CompletionError]]
+    texts: List[str]
+    # Set by predictors; not carried over by `concat`
+    stats: Optional[BatchStats] = None
+
+    @staticmethod
+    def from_entries(
+        indices: Sequence[int],
+        output_indices: Sequence[int],
+        token_ids: Sequence[TokenIds],
+        finish_reasons: List[Optional[str]],
+        stop_reasons: List[Union[int, str, None]],
+        errors: List[Optional[CompletionError]],
+        texts: Optional[List[str]] = None,
+    ) -> "CompletedBatch":
+        flat_token_ids, offsets = ragged_from_arrays(token_ids)
+        return CompletedBatch(
+            indices=np.asarray(indices, dtype=np.int64),
+            output_indices=np.asarray(output_indices, dtype=np.int64),
+            token_ids=flat_token_ids,
+            offsets=offsets,
+            finish_reasons=finish_reasons,
+            stop_reasons=stop_reasons,
+            errors=errors,
+            texts=texts if texts is not None else [""] * len(indices),
+        )
+
+    @staticmethod
+    def from_items(items: Sequence[CompletedItem]) -> "CompletedBatch":
+        indices: List[int] = []
+        output_indices: List[int] = []
+        token_ids: List[TokenIds] = []
+        finish_reasons: List[Optional[str]] = []
+        stop_reasons: List[Union[int, str, None]] = []
+        errors: List[Optional[CompletionError]] = []
+        texts: List[str] = []
+
+        for item in items:
+            for output in item.outputs if item.error is None else []:
+                indices.append(item.index)
+                output_indices.append(output.index)
+                token_ids.append(output.token_ids)
+                finish_reasons.append(output.finish_reason)
+                stop_reasons.append(output.stop_reason)
+                errors.append(None)
+                texts.append(output.text)
+            if item.error is not None:
+                indices.append(item.index)
+                output_indices.append(0)
+                token_ids.append([])
+                finish_reasons.append(None)
+                stop_reasons.append(None)
+                errors.append(item.error)
+                texts.append("")
+
+        return CompletedBatch.from_entries(
+            indices, output_indices, token_ids, finish_reasons, stop_reasons, errors, texts
+        )
+
+    @staticmethod
+    def concat(batches: Sequence["CompletedBatch"]) -> "CompletedBatch":
+        if not batches:
+            return CompletedBatch.from_items([])
+
+        offsets = [batches[0].offsets[:1]]
+        for batch, shift in zip(batches, np.cumsum([0] + [len(batch.token_ids) for batch in batches[:-1]])):
+            offsets.append(batch.offsets[1:] + shift)
+
+        return CompletedBatch(
+            indices=np.concatenate([batch.indices for batch in batches]),
+            output_indices=np.concatenate([batch.output_indices for batch in batches]),
+            token_ids=np.concatenate([batch.token_ids for batch in batches]),
+            offsets=np.concatenate(offsets),
+            finish_reasons=[reason for batch in batches for reason in batch.finish_reasons],
+            stop_reasons=[reason for batch in batches for reason in batch.stop_reasons],
+            errors=[error for batch in batches for error in batch.errors],
+            texts=[text for batch in batches for text in batch.texts],
+        )
+
+    @property
+    def lengths(self) -> npt.NDArray[np.int64]:
+        return self.offsets[1:] - self.offsets[:-1]
+
+    def __len__(self) -> int:
+        """The number of entries, i.e. outputs and errors, rather than rows."""
+        return len(self.indices)
+
+    def entry_token_ids(self, position: int) -> npt.NDArray[np.int32]:
+        return self.token_ids[self.offsets[position] : self.offsets[position + 1]]
+
+    def to_items(self) -> List[CompletedItem]:
+        items: List[CompletedItem] = []
+        for position, index in enumerate(self.indices.tolist()):
+            if not items or items[-1].index != index:
+                items.append(CompletedItem(index=index, outputs=[]))
+
+            error = self.errors[position]
+            if error is not None:
+                items[-1].error = error
+                continue
+
+            items[-1].outputs.append(
+                CompletionOutput(
+                    index=int(self.output_indices[position]),
+                    text=self.texts[position],
+                    token_ids=self.entry_token_ids(position),
+                    finish_reason=self.finish_reasons[position],
+                    stop_reason=self.stop_reasons[position],
+                )
+            )
+
+        return items
+
+
+@dataclass
+class RowRange:
+    """
+    One of the `num_parts` consecutive parts a large, uncompressed input file is split into, spanning
+    the lines from byte `start_offset` up to `end_offset`.
+    """
+
+    part_index: int
+    num_parts: int
+    start_offset: int
+    end_offset: int
+
+
 @dataclass
 class Message:
     message_id: str
     receipt_handle: str
     bucket_name: str
     object_key: str
+    # Set when the message only covers part of its file
+    row_range: Optional[RowRange] = None
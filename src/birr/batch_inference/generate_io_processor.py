@@ -7,62 +7,127 @@ cpu-bound work from the core inference component.
 """
 
 import base64
+from collections import OrderedDict
+import hashlib
 from io import BytesIO
-from typing import List, Optional
+from itertools import chain
+import time
+from typing import List, Optional, Sequence
 
+import numpy as np
+import numpy.typing as npt
 from PIL import Image
 
 from birr.batch_inference.data_models import (
-    CompletedItem,
+    CompletedBatch,
+    EncodedImage,
     ImageChatMessageContent,
-    PreparedInputItem,
+    PreparedBatch,
     RawInputItem,
     TokenizedItem,
 )
+from birr.batch_inference.metrics import observe_latency
+from birr.batch_inference.tokenization_cache import (
+    TokenizationCache,
+    messages_cache_key,
+    tokenization_cache_namespace,
+)
+from birr.batch_inference.tracing import span
 from birr.core.config import FormatConfig, LLMModelConfig
 from birr.tokenization import ModelTokenizer
 
 
+def strip_padding(
+    batch_input_ids: Sequence[Sequence[int]], batch_attention_mask: Sequence[Sequence[int]]
+) -> List[npt.NDArray[np.int32]]:
+    """Drops the masked-out ids of every row at once, returning int32 views into one shared buffer."""
+    lengths = [len(instance_input_ids) for instance_input_ids in batch_input_ids]
+    assert lengths == [len(instance_attention_mask) for instance_attention_mask in batch_attention_mask]
+    if not lengths:
+        return []
+
+    total = sum(lengths)
+    flat_ids = np.fromiter(chain.from_iterable(batch_input_ids), dtype=np.int32, count=total)
+    flat_mask = np.fromiter(chain.from_iterable(batch_attention_mask), dtype=bool, count=total)
+
+    # Number of kept ids before each row boundary
+    kept_before = np.concatenate([[0], np.cumsum(flat_mask)])[np.cumsum(lengths)]
+    return np.split(flat_ids[flat_mask], kept_before[:-1])
+
+
 class GenerateIOProcessor:
-    def __init__(self, model_config: LLMModelConfig, format_config: FormatConfig):
+    def __init__(
+        self,
+        model_config: LLMModelConfig,
+        format_config: FormatConfig,
+        tokenization_cache_dir: Optional[str] = None,
+    ):
         self._vlm = model_config.vlm
+        self._max_image_size = model_config.max_image_size
+        # Least recently used processed images, keyed by a hash of their data URL
+        self._image_cache: OrderedDict[bytes, EncodedImage] = OrderedDict()
+        self._image_cache_size = model_config.image_cache_size
         self._tokenizer = ModelTokenizer(
             name_or_path=model_config.name_or_path, model_config=model_config, format_config=format_config
         )
 
-    def prepare_inputs(self, batch: List[RawInputItem]) -> List[PreparedInputItem]:
-        tokenized_inputs = self.tokenize(batch)
+        self._tokenization_cache: Optional[TokenizationCache] = None
+        if tokenization_cache_dir:
+            namespace = tokenization_cache_namespace(self._tokenizer, model_config, format_config)
+            self._tokenization_cache = TokenizationCache(tokenization_cache_dir, namespace)
 
-        image_inputs = self.load_images(batch) if self._vlm else [None for _ in batch]
+    def prepare_inputs(self, batch: List[RawInputItem]) -> PreparedBatch:
+        started = time.perf_counter()
+        with span("tokenize", "tokenizer", batch_size=len(batch)):
+            tokenized_inputs = self.tokenize(batch)
 
-        return [
-            PreparedInputItem(index=tokens.index, token_ids=tokens.token_ids, image_data=image_data)
-            for tokens, image_data in zip(tokenized_inputs, image_inputs)
-        ]
+            prepared = PreparedBatch.from_token_ids(
+                [tokens.index for tokens in tokenized_inputs],
+                [tokens.token_ids for tokens in tokenized_inputs],
+                self.load_images(batch) if self._vlm else None,
+            )
+        observe_latency("tokenize", time.perf_counter() - started)
+        return prepared
 
     def tokenize(self, batch: List[RawInputItem]) -> List[TokenizedItem]:
+        if self._tokenization_cache is None:
+            return self._tokenize(batch)
+
+        keys = [messages_cache_key(item.messages) for item in batch]
+        cached = [self._tokenization_cache.get(key) for key in keys]
+
+        misses = [item for item, token_ids in zip(batch, cached) if token_ids is None]
+        tokenized_misses = iter(self._tokenize(misses) if misses else [])
+
+        tokenized_items = []
+        new_entries = []
+        for item, key, token_ids in zip(batch, keys, cached):
+            if token_ids is None:
+                tokenized_item = next(tokenized_misses)
+                new_entries.append((key, tokenized_item.token_ids))
+                tokenized_items.append(tokenized_item)
+            else:
+                tokenized_items.append(TokenizedItem(item.index, token_ids))
+
+        self._tokenization_cache.put_many(new_entries)
+
+        return tokenized_items
+
+    def _tokenize(self, batch: List[RawInputItem]) -> List[TokenizedItem]:
         batch_encoding = self._tokenizer.batch_process(instances=[instance.messages for instance in batch])
         batch_input_ids = batch_encoding.input_ids
         batch_attention_mask = batch_encoding.attention_mask
 
-        final_batch_input_ids = []
-
         # Apply attention mask since we have prompts of unequal length
-        for instance_input_ids, instance_attention_mask in zip(batch_input_ids, batch_attention_mask):
-            final_instance_ids = []
-            assert len(instance_input_ids) == len(instance_attention_mask)
-            for token_id, keep in zip(list(instance_input_ids), list(instance_attention_mask)):
-                if keep:
-                    final_instance_ids.append(token_id)
-            final_batch_input_ids.append(final_instance_ids)
+        final_batch_input_ids = strip_padding(batch_input_ids, batch_attention_mask)
 
         return [
             TokenizedItem(item.index, instance_token_ids)
             for item, instance_token_ids in zip(batch, final_batch_input_ids)
         ]
 
-    def load_images(self, batch: List[RawInputItem]) -> List[Optional[List[Image.Image]]]:
-        image_objects: List[Optional[List[Image.Image]]] = []
+    def load_images(self, batch: List[RawInputItem]) -> List[Optional[List[EncodedImage]]]:
+        image_objects: List[Optional[List[EncodedImage]]] = []
 
         for instance in batch:
             instance_image_objects = []
@@ -72,11 +137,7 @@ class GenerateIOProcessor:
                 else:
                     for content_item in message.content:
                         if isinstance(content_item, ImageChatMessageContent):
-                            data = content_item.image.split(";", 1)[1]
-                            assert data.startswith("base64,"), "Invalid image data"
-                            decoded_data = base64.b64decode(data[7:])
-                            image_object = Image.open(BytesIO(decoded_data))
-                            instance_image_objects.append(image_object)
+                            instance_image_objects.append(self._load_image(content_item.image))
 
             if instance_image_objects:
                 image_objects.append(instance_image_objects)
@@ -85,16 +146,48 @@ class GenerateIOProcessor:
 
         return image_objects
 
-    def decode(self, batch: List[CompletedItem]) -> List[CompletedItem]:
-        completion_outputs = []
-        for item in batch:
-            for completion_output in item.outputs:
-                completion_outputs.append(completion_output)
-
-        token_batch = [output.token_ids for output in completion_outputs]
-
-        decoded = self._tokenizer.batch_decode(token_batch, skip_special_tokens=True)
-        for completion_output, decoded_item in zip(completion_outputs, decoded):
-            completion_output.text = decoded_item
-
+    def _load_image(self, image_url: str) -> EncodedImage:
+        key = hashlib.blake2b(image_url.encode("utf-8"), digest_size=16).digest()
+        cached = self._image_cache.get(key)
+        if cached is not None:
+            self._image_cache.move_to_end(key)
+            return cached
+
+        data = image_url.split(";", 1)[1]
+        assert data.startswith("base64,"), "Invalid image data"
+        image = EncodedImage(self._downscale_image(base64.b64decode(data[7:])), key)
+
+        if self._image_cache_size:
+            self._image_cache[key] = image
+            if len(self._image_cache) > self._image_cache_size:
+                self._image_cache.popitem(last=False)
+
+        return image
+
+    def _downscale_image(self, data: bytes) -> bytes:
+        if self._max_image_size is None:
+            return data
+
+        # Opening only parses the header, so images that are small enough are never decoded here
+        image = Image.open(BytesIO(data))
+        if max(image.size) <= self._max_image_size:
+            return data
+
+        image_format = image.format or "PNG"
+        image.thumbnail((self._max_image_size, self._max_image_size))
+        downscaled = BytesIO()
+        image.save(downscaled, format=image_format)
+        return downscaled.getvalue()
+
+    def decode(self, batch: CompletedBatch) -> CompletedBatch:
+        started = time.perf_counter()
+        with span("decode", "tokenizer", batch_size=len(batch)):
+            positions = [position for position, error in enumerate(batch.errors) if error is None]
+            token_batch = [batch.entry_token_ids(position) for position in positions]
+
+            decoded = self._tokenizer.batch_decode(token_batch, skip_special_tokens=True)
+            for position, decoded_item in zip(positions, decoded):
+                batch.texts[position] = decoded_item
+
+        observe_latency("decode", time.perf_counter() - started)
         return batch
@@ -0,0 +1,74 @@
+"""
+Fast JSON decoding of input rows and encoding of output rows, used when `PipelineConfig.fast_json` is set.
+
+Input lines are decoded with orjson when it's installed (`pip install birr[fast_json]`), falling back to
+the standard library when it isn't, or for lines orjson rejects, such as ones with `NaN` or integers
+beyond 64 bits. Each line becomes an `InputRow` holding just its typed chat messages and the line itself.
+Output rows are that line with the encoded outputs appended, so passthrough fields (ids, metadata, ...)
+are written back byte for byte, and never turned into dicts and re-encoded.
+"""
+
+import json
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+from birr.batch_inference.data_models import ChatMessage, CompletionError, CompletionOutput, InputRow
+from birr.batch_inference.serializer import OUTPUT_FIELDS, default_serializer, output_fields
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# A row to write out, either as a dict to encode or as an already encoded line
+OutputRow = Union[Dict[str, Any], bytes]
+
+
+def has_orjson() -> bool:
+    return orjson is not None
+
+
+def loads(data: bytes) -> Any:
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj).encode("utf-8")
+
+
+def decode_input_row(line: bytes) -> InputRow:
+    """Decodes a stripped, non-empty input line."""
+    data: Dict[str, Any] = loads(line)
+    if "text" in data:
+        messages = [ChatMessage.from_text(data["text"])]
+    else:
+        messages = [ChatMessage.from_dict(message_dict) for message_dict in data["chat_messages"]]
+
+    return InputRow(line=line, messages=messages, has_output_fields=any(field in data for field in OUTPUT_FIELDS))
+
+
+def encode_output_row(
+    row: InputRow, outputs: List[CompletionOutput], completion_error: Optional[CompletionError]
+) -> bytes:
+    """Encodes the same row as `default_serializer`, without a newline."""
+    if row.has_output_fields:
+        return dumps(default_serializer(loads(row.line), outputs, completion_error))
+
+    # The line is an object with at least a prompt field, so its closing brace can become a comma,
+    # followed by the encoded output fields without their opening brace
+    return row.line[:-1] + b"," + dumps(output_fields(outputs, completion_error))[1:]
+
+
+def encode_output_rows(rows: Iterable[OutputRow]) -> List[bytes]:
+    """Encodes a batch of output rows, passing through those that are already encoded."""
+    # Dicts are encoded by the standard library, so output is unchanged when `fast_json` isn't set
+    return [row if isinstance(row, bytes) else json.dumps(row).encode("utf-8") for row in rows]
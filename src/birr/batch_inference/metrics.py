@@ -0,0 +1,77 @@
+"""
+Pipeline metrics, exported by Ray in Prometheus format on `ray.init`'s `_metrics_export_port`,
+e.g. `curl localhost:8080/metrics`, where each name is prefixed with `ray_`.
+
+Metrics are created on first use in each process, and recording is a no-op outside of Ray
+(e.g. in tests), so pipeline components can record unconditionally.
+"""
+
+from typing import Dict, Optional, Tuple, Union
+
+import ray
+from ray.util.metrics import Counter, Gauge, Histogram
+
+LATENCY_BOUNDARIES = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600]
+
+# Name -> (kind, description, tag keys)
+METRICS: Dict[str, Tuple[str, str, Tuple[str, ...]]] = {
+    "birr_rows_processed": ("counter", "Rows whose results were written.", ()),
+    "birr_files_processed": ("counter", "Input files whose whole output was written.", ()),
+    "birr_prompt_tokens": ("counter", "Prompt tokens sent to generation.", ()),
+    "birr_completion_tokens": ("counter", "Tokens generated.", ()),
+    "birr_stage_latency_seconds": (
+        "histogram",
+        "Seconds spent on one batch (or file, for `write`) in each pipeline stage: `tokenize`, `generate`, `decode` or `write`.",
+        ("stage",),
+    ),
+    "birr_batches_in_flight": (
+        "gauge",
+        "Generation batches a worker has dispatched to free predictors that have not come back yet.",
+        ("worker",),
+    ),
+    "birr_context_too_long_rows": ("counter", "Rows whose prompts exceeded `max_context_length`.", ()),
+    "birr_predictor_restarts": ("counter", "Predictor actors restarted by Ray after a failure.", ()),
+    "birr_cuda_errors": ("counter", "CUDA errors raised by predictors during generation.", ()),
+    "birr_queue_depth": ("gauge", "Messages (files) waiting in the queue.", ()),
+}
+
+_metrics: Dict[str, Union[Counter, Gauge, Histogram]] = {}
+
+
+def _metric(name: str) -> Optional[Union[Counter, Gauge, Histogram]]:
+    if not ray.is_initialized():
+        return None
+
+    if name not in _metrics:
+        kind, description, tag_keys = METRICS[name]
+        if kind == "counter":
+            _metrics[name] = Counter(name, description=description, tag_keys=tag_keys)
+        elif kind == "gauge":
+            _metrics[name] = Gauge(name, description=description, tag_keys=tag_keys)
+        else:
+            _metrics[name] = Histogram(
+                name, description=description, boundaries=LATENCY_BOUNDARIES, tag_keys=tag_keys
+            )
+
+    return _metrics[name]
+
+
+def increment(name: str, value: float = 1, tags: Optional[Dict[str, str]] = None) -> None:
+    metric = _metric(name)
+    if metric is not None and value:
+        assert isinstance(metric, Counter)
+        metric.inc(value, tags=tags)
+
+
+def set_gauge(name: str, value: float, tags: Optional[Dict[str, str]] = None) -> None:
+    metric = _metric(name)
+    if metric is not None:
+        assert isinstance(metric, Gauge)
+        metric.set(value, tags=tags)
+
+
+def observe_latency(stage: str, seconds: float) -> None:
+    metric = _metric("birr_stage_latency_seconds")
+    if metric is not None:
+        assert isinstance(metric, Histogram)
+        metric.observe(seconds, tags={"stage": stage})
@@ -0,0 +1,89 @@
+import asyncio
+from dataclasses import asdict
+import time
+from typing import Any, List, Set
+import uuid
+
+from vllm import AsyncEngineArgs, AsyncLLMEngine, SamplingParams, TokensPrompt
+
+from birr.batch_inference.data_models import BatchStats, CompletedBatch, PreparedBatch
+from birr.batch_inference.predictors.predictor import Predictor
+from birr.batch_inference.tracing import span
+
+
+class AsyncPredictor(Predictor):
+    """
+    Predictor on top of vLLM's async engine, which continuously batches every request in flight.
+
+    `predict` is a coroutine, so as a Ray actor several batches run concurrently, and the engine
+    schedules a new batch's prompts as soon as sequences of earlier ones finish, instead of
+    draining the GPU while a batch's longest generations complete. Each batch still comes back
+    as a whole once all of its prompts are done.
+    """
+
+    def _load_model(self) -> AsyncLLMEngine:
+        engine = AsyncLLMEngine.from_engine_args(
+            AsyncEngineArgs(model=self._model_config.name_or_path, **self._engine_kwargs())
+        )
+        self._logits_processors = self._build_logits_processors(engine.engine)
+        self._accumulated_cuda_errors = 0
+        # Trace lanes of the batches in flight, since their spans overlap on the actor's one thread
+        self._busy_lanes: Set[int] = set()
+
+        return engine
+
+    async def predict(self, batch: PreparedBatch) -> CompletedBatch:  # type: ignore[override]
+        lane = min(set(range(len(self._busy_lanes) + 1)) - self._busy_lanes)
+        self._busy_lanes.add(lane)
+        try:
+            with span("predict", "predictor", lane=lane, batch_size=len(batch)) as span_args:
+                fitting_positions, too_long_positions = self._split_by_context_length(batch)
+                tokens_prompt_batch = self._tokens_prompts(batch, fitting_positions)
+
+                # Batches overlap on the engine, so preemptions are those of any batch in flight meanwhile
+                num_preemptions_before = self._num_preemptions()
+                started = time.perf_counter()
+                outputs = await self._generate_async(tokens_prompt_batch) if tokens_prompt_batch else []
+
+                completed = self._completed_batch(batch, fitting_positions, too_long_positions, outputs)
+                completed.stats = BatchStats.measure(
+                    batch,
+                    completed,
+                    time.perf_counter() - started,
+                    self._num_preemptions() - num_preemptions_before,
+                )
+                span_args.update(asdict(completed.stats))
+        finally:
+            self._busy_lanes.discard(lane)
+
+        self._record_metrics(batch, fitting_positions, too_long_positions, completed)
+        return completed
+
+    def _llm_engine(self) -> Any:
+        return self._model.engine
+
+    async def _generate_async(self, tokens_prompt_batch: List[TokensPrompt]) -> List[Any]:
+        sampling_params = self._sampling_params(tokens_prompt_batch)
+        request_ids = [uuid.uuid4().hex for _ in tokens_prompt_batch]
+        requests = [
+            asyncio.ensure_future(self._generate_one(tokens_prompt, sampling_params, request_id))
+            for tokens_prompt, request_id in zip(tokens_prompt_batch, request_ids)
+        ]
+        try:
+            return await asyncio.gather(*requests)
+        except Exception as exc:
+            # `gather` leaves the batch's other requests running, which would keep taking up the engine
+            for request, request_id in zip(requests, request_ids):
+                if not request.done():
+                    request.cancel()
+                    await self._model.abort(request_id)
+            self._check_cuda_error(exc)
+            raise exc
+
+    async def _generate_one(
+        self, tokens_prompt: TokensPrompt, sampling_params: SamplingParams, request_id: str
+    ) -> Any:
+        final_output = None
+        async for output in self._model.generate(tokens_prompt, sampling_params, request_id=request_id):
+            final_output = output
+        return final_output
@@ -1,8 +1,11 @@
-from typing import Any, List
+from typing import Any
 
 from abc import ABC, abstractmethod
 
-from birr.batch_inference.data_models import CompletedItem, PreparedInputItem
+import ray
+
+from birr.batch_inference.data_models import CompletedBatch, PreparedBatch
+from birr.batch_inference.metrics import increment
 from birr.core.config import GenerateConfig, LLMModelConfig
 
 
@@ -16,8 +19,11 @@ class BasePredictor(ABC):
         self._generate_config = generate_config
         self._model = self._load_model()
 
+        if ray.is_initialized() and ray.get_runtime_context().was_current_actor_reconstructed:
+            increment("birr_predictor_restarts")
+
     @abstractmethod
-    def predict(self, batch: List[PreparedInputItem]) -> List[CompletedItem]:
+    def predict(self, batch: PreparedBatch) -> CompletedBatch:
         raise NotImplementedError
 
     def _load_model(self) -> Any:
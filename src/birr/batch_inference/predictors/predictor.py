@@ -1,17 +1,23 @@
+from dataclasses import asdict
 import logging
 import sys
-from typing import List, Optional
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
 
+import numpy as np
 from outlines.serve.vllm import JSONLogitsProcessor
+from PIL import Image
 from vllm import LLM, SamplingParams, TokensPrompt
 
 from birr.batch_inference.data_models import (
+    BatchStats,
     CompletionError,
-    CompletedItem,
-    CompletionOutput,
-    PreparedInputItem,
+    CompletedBatch,
+    PreparedBatch,
 )
+from birr.batch_inference.metrics import increment, observe_latency
 from birr.batch_inference.predictors.base_predictor import BasePredictor
+from birr.batch_inference.tracing import span
 
 
 logger = logging.getLogger(__name__)
@@ -22,11 +28,17 @@ MAX_ALLOWED_CUDA_ERRORS = 2
 
 class Predictor(BasePredictor):
     def _load_model(self) -> LLM:
+        llm = LLM(self._model_config.name_or_path, **self._engine_kwargs())
+        self._logits_processors = self._build_logits_processors(llm.llm_engine)
+        self._accumulated_cuda_errors = 0
+
+        return llm
+
+    def _engine_kwargs(self) -> Dict[str, Any]:
         # See: https://github.com/vllm-project/vllm/pull/8001
         enable_chunked_prefill = False if self._model_config.num_scheduler_steps > 1 else None
 
-        llm = LLM(
-            self._model_config.name_or_path,
+        return dict(
             trust_remote_code=self._model_config.trust_remote_code,
             skip_tokenizer_init=False,  # we need the tokenizer for vLLM to know about stop tokens
             max_model_len=self._model_config.max_model_len,
@@ -34,36 +46,122 @@ class Predictor(BasePredictor):
             gpu_memory_utilization=self._model_config.gpu_memory_utilization,
             num_scheduler_steps=self._model_config.num_scheduler_steps,
             enable_chunked_prefill=enable_chunked_prefill,
+            enable_prefix_caching=self._model_config.enable_prefix_caching,
         )
 
-        self._logits_processors: Optional[List[JSONLogitsProcessor]]
-        if self._generate_config.guided_decoding_json_schema:
-            self._logits_processors = [
-                JSONLogitsProcessor(
-                    schema=self._generate_config.guided_decoding_json_schema,
-                    llm=llm.llm_engine,
-                )
-            ]
-        else:
-            self._logits_processors = None
+    def _build_logits_processors(self, llm_engine: Any) -> Optional[List[JSONLogitsProcessor]]:
+        if not self._generate_config.guided_decoding_json_schema:
+            return None
 
-        self._accumulated_cuda_errors = 0
+        return [
+            JSONLogitsProcessor(
+                schema=self._generate_config.guided_decoding_json_schema,
+                llm=llm_engine,
+            )
+        ]
 
-        return llm
+    def predict(self, batch: PreparedBatch) -> CompletedBatch:
+        with span("predict", "predictor", batch_size=len(batch)) as span_args:
+            fitting_positions, too_long_positions = self._split_by_context_length(batch)
+            tokens_prompt_batch = self._tokens_prompts(batch, fitting_positions)
+
+            num_preemptions_before = self._num_preemptions()
+            started = time.perf_counter()
+            outputs = self._generate(tokens_prompt_batch) if tokens_prompt_batch else []
 
-    def predict(self, batch: List[PreparedInputItem]) -> List[CompletedItem]:
-        tokens_prompt_batch: List[TokensPrompt] = [
-            dict(
-                prompt_token_ids=instance.token_ids,
-                multi_modal_data=None if not instance.image_data else dict(image=instance.image_data),
+            completed = self._completed_batch(batch, fitting_positions, too_long_positions, outputs)
+            completed.stats = BatchStats.measure(
+                batch, completed, time.perf_counter() - started, self._num_preemptions() - num_preemptions_before
+            )
+            span_args.update(asdict(completed.stats))
+
+        self._record_metrics(batch, fitting_positions, too_long_positions, completed)
+        return completed
+
+    def _record_metrics(
+        self,
+        batch: PreparedBatch,
+        fitting_positions: List[int],
+        too_long_positions: List[int],
+        completed: CompletedBatch,
+    ) -> None:
+        assert completed.stats is not None
+        observe_latency("generate", completed.stats.generation_seconds)
+        increment("birr_prompt_tokens", int(batch.lengths[fitting_positions].sum()))
+        increment("birr_completion_tokens", len(completed.token_ids))
+        increment("birr_context_too_long_rows", len(too_long_positions))
+
+    def _llm_engine(self) -> Any:
+        return self._model.llm_engine
+
+    def _num_preemptions(self) -> int:
+        return sum(scheduler.num_cumulative_preemption for scheduler in self._llm_engine().scheduler)
+
+    def _split_by_context_length(self, batch: PreparedBatch) -> Tuple[List[int], List[int]]:
+        fits_context = batch.lengths <= self._generate_config.max_context_length
+        return np.flatnonzero(fits_context).tolist(), np.flatnonzero(~fits_context).tolist()
+
+    def _tokens_prompts(self, batch: PreparedBatch, positions: List[int]) -> List[TokensPrompt]:
+        # Images are only decoded now, right before the batch is submitted, and once per unique image
+        decoded_images: Dict[bytes, Image.Image] = {}
+        for images in batch.image_data or []:
+            for image in images or []:
+                if image.key not in decoded_images:
+                    decoded_images[image.key] = image.decode()
+
+        tokens_prompt_batch: List[TokensPrompt] = []
+        for position in positions:
+            images = batch.image_data[position] if batch.image_data is not None else None
+            tokens_prompt_batch.append(
+                dict(
+                    prompt_token_ids=batch.row_token_ids(position).tolist(),
+                    multi_modal_data=(
+                        dict(image=[decoded_images[image.key] for image in images]) if images else None
+                    ),
+                )
             )
-            for instance in batch
-            if len(instance.token_ids) <= self._generate_config.max_context_length
-        ]
 
-        if not tokens_prompt_batch:
-            return []
+        return tokens_prompt_batch
+
+    def _completed_batch(
+        self,
+        batch: PreparedBatch,
+        fitting_positions: List[int],
+        too_long_positions: List[int],
+        outputs: List[Any],
+    ) -> CompletedBatch:
+        indices: List[int] = []
+        output_indices: List[int] = []
+        token_ids: List[np.ndarray] = []
+        finish_reasons: List[Optional[str]] = []
+        stop_reasons: List[Union[int, str, None]] = []
+        errors: List[Optional[CompletionError]] = []
+
+        for position, prediction in zip(fitting_positions, outputs):
+            for output in prediction.outputs:
+                if self._generate_config.drop_long_outputs and output.finish_reason != "stop":
+                    continue
+                indices.append(int(batch.indices[position]))
+                output_indices.append(output.index)
+                token_ids.append(np.asarray(output.token_ids, dtype=np.int32))
+                finish_reasons.append(output.finish_reason)
+                stop_reasons.append(output.stop_reason)
+                errors.append(None)
 
+        if not self._generate_config.drop_long_contexts:
+            for position in too_long_positions:
+                indices.append(int(batch.indices[position]))
+                output_indices.append(0)
+                token_ids.append(np.empty(0, dtype=np.int32))
+                finish_reasons.append(None)
+                stop_reasons.append(None)
+                errors.append(CompletionError.CONTEXT_TOO_LONG)
+
+        return CompletedBatch.from_entries(
+            indices, output_indices, token_ids, finish_reasons, stop_reasons, errors
+        )
+
+    def _sampling_params(self, tokens_prompt_batch: List[TokensPrompt]) -> SamplingParams:
         longest_sequence = max([len(instance["prompt_token_ids"]) for instance in tokens_prompt_batch])
 
         if self._generate_config.max_tokens:
@@ -71,8 +169,9 @@ class Predictor(BasePredictor):
         else:
             max_tokens = longest_sequence
 
-        sampling_params = SamplingParams(
-            n=1,  # TODO: allow multiple outputs per input; will affect batching in a few places
+        return SamplingParams(
+            n=self._generate_config.n,
+            best_of=self._generate_config.best_of,
             temperature=self._generate_config.temperature,
             top_k=self._generate_config.top_k,
             top_p=self._generate_config.top_p,
@@ -84,57 +183,24 @@ class Predictor(BasePredictor):
             repetition_penalty=self._generate_config.repetition_penalty,
         )
 
+    def _generate(self, tokens_prompt_batch: List[TokensPrompt]) -> List[Any]:
         try:
-            outputs = self._model.generate(
+            return self._model.generate(
                 tokens_prompt_batch,
                 use_tqdm=False,
-                sampling_params=sampling_params,
+                sampling_params=self._sampling_params(tokens_prompt_batch),
             )
         except Exception as exc:
-            if "CUDA error" in str(exc):
-                self._accumulated_cuda_errors += 1
-                if self._accumulated_cuda_errors >= MAX_ALLOWED_CUDA_ERRORS:
-                    logger.exception(
-                        """
-                    CUDA errors encountered too many times -- GPU memory likely in unrecoverable state.
-                    Terminating predictor...
-                    """
-                    )
-                    sys.exit(1)
+            self._check_cuda_error(exc)
             raise exc
 
-        unfiltered_predictions = [
-            CompletedItem(
-                index=instance.index,
-                outputs=[
-                    CompletionOutput(
-                        index=0,
-                        text="",
-                        token_ids=list(prediction.outputs[0].token_ids),
-                        finish_reason=prediction.outputs[0].finish_reason,
-                        stop_reason=prediction.outputs[0].stop_reason,
-                    )
-                ],
-            )
-            for instance, prediction in zip(batch, outputs)
-        ]
-
-        filtered_predictions = [
-            prediction for prediction in unfiltered_predictions if prediction.outputs[0].finish_reason == "stop"
-        ]
-
-        if self._generate_config.drop_long_outputs:
-            predictions = filtered_predictions
-        else:
-            predictions = unfiltered_predictions
-
-        context_too_longs = [
-            CompletedItem(index=instance.index, outputs=[], error=CompletionError.CONTEXT_TOO_LONG)
-            for instance in batch
-            if len(instance.token_ids) > self._generate_config.max_context_length
-        ]
-
-        if not self._generate_config.drop_long_contexts:
-            predictions += context_too_longs
-
-        return predictions
+    def _check_cuda_error(self, exc: Exception) -> None:
+        if "CUDA error" in str(exc):
+            self._accumulated_cuda_errors += 1
+            increment("birr_cuda_errors")
+            if self._accumulated_cuda_errors >= MAX_ALLOWED_CUDA_ERRORS:
+                logger.exception("""
+                CUDA errors encountered too many times -- GPU memory likely in unrecoverable state.
+                Terminating predictor...
+                """)
+                sys.exit(1)
@@ -1,5 +1,5 @@
 import abc
-from typing import Optional
+from typing import List, Optional
 
 from birr.batch_inference.data_models import Message
 from birr.core.config import PipelineConfig
@@ -14,7 +14,25 @@ class BaseQueue(abc.ABC):
         """Retrieve the next message of work from this queue"""
         raise NotImplementedError()
 
+    def get_messages(self, n: int) -> List[Message]:
+        """Retrieve up to `n` next messages of work from this queue"""
+        messages: List[Message] = []
+        while len(messages) < n and (message := self.get_message()):
+            messages.append(message)
+        return messages
+
     @abc.abstractmethod
     def delete_message(self, message: Message) -> None:
         """Delete a message from the queue after completing the work"""
         raise NotImplementedError()
+
+    def extend_lease(self, message: Message) -> bool:
+        """Keep a message being worked on from being handed out again, returning whether it still was"""
+        return True
+
+    def release_message(self, message: Message) -> None:
+        """Give up on a message after failing to complete the work, so it can be handed out again"""
+
+    def is_drained(self) -> bool:
+        """Whether no message is left to hand out, now or later, e.g. once a lease expires"""
+        return True
@@ -1,23 +1,47 @@
-from typing import List
+import time
+from typing import Callable, Optional, Tuple
 
-from birr.batch_inference.data_models import CompletedItem, CompletionOutput, PreparedInputItem
+import numpy as np
+
+from birr.batch_inference.data_models import BatchStats, CompletedBatch, PreparedBatch, ragged_take
 from birr.batch_inference.predictors.base_predictor import BasePredictor
+from birr.batch_inference.tracing import span
+from birr.core.config import GenerateConfig, LLMModelConfig
+
+# Maps a batch to how many seconds it takes and how many preemptions it causes
+LatencyModel = Callable[[PreparedBatch], Tuple[float, int]]
 
 
 class DummyPredictor(BasePredictor):
-    def predict(self, batch: List[PreparedInputItem]) -> List[CompletedItem]:
-        return [
-            CompletedItem(
-                index=item.index,
-                outputs=[
-                    CompletionOutput(
-                        index=0,
-                        text="",
-                        token_ids=item.token_ids,
-                        finish_reason=None,
-                        stop_reason=None,
-                    )
-                ],
+    def __init__(
+        self,
+        model_config: LLMModelConfig,
+        generate_config: GenerateConfig,
+        latency_model: Optional[LatencyModel] = None,
+    ):
+        super().__init__(model_config, generate_config)
+        self._latency_model = latency_model
+
+    def predict(self, batch: PreparedBatch) -> CompletedBatch:
+        with span("predict", "predictor", batch_size=len(batch)):
+            # Echoes each prompt back as each of its `n` completions
+            n = self._generate_config.n
+            positions = np.repeat(np.arange(len(batch), dtype=np.int64), n)
+            token_ids, offsets = ragged_take(batch.token_ids, batch.offsets, positions)
+            completed = CompletedBatch(
+                indices=batch.indices[positions],
+                output_indices=np.tile(np.arange(n, dtype=np.int64), len(batch)),
+                token_ids=token_ids,
+                offsets=offsets,
+                finish_reasons=[None] * len(positions),
+                stop_reasons=[None] * len(positions),
+                errors=[None] * len(positions),
+                texts=[""] * len(positions),
             )
-            for item in batch
-        ]
+
+            if self._latency_model is not None:
+                seconds, num_preemptions = self._latency_model(batch)
+                time.sleep(seconds)
+                completed.stats = BatchStats.measure(batch, completed, seconds, num_preemptions)
+
+        return completed
@@ -1,32 +1,113 @@
 from collections import deque
-from typing import Deque, Optional
+from itertools import zip_longest
+import os
+from typing import Deque, List, Optional
 
-from birr.batch_inference.data_models import Message
+from birr.batch_inference.data_models import Message, RowRange
+from birr.batch_inference.metrics import set_gauge
 from birr.batch_inference.queue.base_queue import BaseQueue
-from birr.batch_inference.utils import determine_remaining_files_to_process
+from birr.batch_inference.utils import (
+    compression_for,
+    determine_remaining_files_to_process,
+    has_checkpoint,
+    row_range_offsets,
+)
 from birr.core.config import PipelineConfig
 
 
+def messages_for_file(index: int, file_path: str, pipeline_config: PipelineConfig) -> List[Message]:
+    """A message for the file, or one per part of it if it is split by `PipelineConfig.rows_per_message`."""
+    offsets = (
+        row_range_offsets(file_path, pipeline_config.rows_per_message)
+        if pipeline_config.rows_per_message and compression_for(file_path) is None
+        else []
+    )
+    if len(offsets) <= 2:
+        return [
+            Message(
+                message_id=f"item={index};file={file_path}",
+                receipt_handle="in-memory",
+                bucket_name="",
+                object_key=file_path,
+            )
+        ]
+
+    num_parts = len(offsets) - 1
+    return [
+        Message(
+            message_id=f"item={index};file={file_path};part={part_index}",
+            receipt_handle="in-memory",
+            bucket_name="",
+            object_key=file_path,
+            row_range=RowRange(part_index, num_parts, start_offset, end_offset),
+        )
+        for part_index, (start_offset, end_offset) in enumerate(zip(offsets, offsets[1:]))
+    ]
+
+
+# Rough ratios at which compressed JSONL expands, to compare compressed and uncompressed files by size
+COMPRESSION_RATIO_ESTIMATES = {"zstd": 5.0, "gzip": 4.0}
+
+
+def estimated_message_size(message: Message) -> float:
+    """How many bytes of rows a message covers, as a proxy for how long it takes to process."""
+    if message.row_range is not None:
+        return message.row_range.end_offset - message.row_range.start_offset
+
+    compression = compression_for(message.object_key)
+    return os.path.getsize(message.object_key) * (COMPRESSION_RATIO_ESTIMATES[compression] if compression else 1.0)
+
+
+def ordered_messages(messages: List[Message], pipeline_config: PipelineConfig) -> List[Message]:
+    """
+    Orders messages by `PipelineConfig.message_order`, after putting first those interrupted part-way
+    through, so their partial outputs are finished off early.
+    """
+    if pipeline_config.message_order != "listed":
+        # Longest processing time first: what's left at the end is small enough to be spread over workers
+        messages = sorted(messages, key=estimated_message_size, reverse=True)
+        if pipeline_config.message_order == "interleaved":
+            num_large = (len(messages) + 1) // 2
+            largest_first, smallest_first = messages[:num_large], messages[num_large:][::-1]
+            messages = [
+                message
+                for pair in zip_longest(largest_first, smallest_first)
+                for message in pair
+                if message is not None
+            ]
+
+    return sorted(
+        messages,
+        key=lambda m: not has_checkpoint(
+            m.object_key, pipeline_config.output_file_dir, pipeline_config.output_compression, m.row_range
+        ),
+    )
+
+
 class InMemoryQueue(BaseQueue):
     def __init__(self, pipeline_config: PipelineConfig) -> None:
         remaining_files_to_process = determine_remaining_files_to_process(
             input_dir=pipeline_config.input_file_dir, output_dir=pipeline_config.output_file_dir
         )
+        messages = ordered_messages(
+            [
+                message
+                for index, f in enumerate(remaining_files_to_process)
+                for message in messages_for_file(index, f, pipeline_config)
+            ],
+            pipeline_config,
+        )
 
         self._queue: Deque[Message] = deque()
-        for index, f in enumerate(remaining_files_to_process):
-            self._queue.appendleft(
-                Message(
-                    message_id=f"item={index};file={f}",
-                    receipt_handle="in-memory",
-                    bucket_name="",
-                    object_key=f,
-                )
-            )
+        for message in messages:
+            self._queue.appendleft(message)
+        set_gauge("birr_queue_depth", len(self._queue))
 
     def get_message(self) -> Optional[Message]:
         if len(self._queue):
-            return self._queue.pop()
+            message = self._queue.pop()
+            set_gauge("birr_queue_depth", len(self._queue))
+            return message
         return None
 
     def delete_message(self, message: Message) -> None:
@@ -0,0 +1,241 @@
+"""
+A durable queue of messages in a SQLite database, which outlives the queue actor and can be shared
+by several runners on one machine.
+
+Messages are leased rather than popped: one handed to a worker stays invisible to others until
+its lease expires `PipelineConfig.queue_visibility_timeout` seconds later, unless the worker keeps
+extending it, and is then handed out again unless it was deleted as completed. A message whose
+worker failed on it is released, and handed out again right away. After
+`PipelineConfig.queue_max_attempts` leases that expired or were released, a message is moved to
+the dead-letter state and no longer handed out.
+
+Each lease has a receipt handle of its own, so a worker whose lease was handed to another can
+neither extend it nor complete the message.
+
+The database is filled from the input directory when it is first created and never rescanned,
+so a restarted job resumes with just the messages not yet completed.
+"""
+
+from contextlib import contextmanager
+from dataclasses import asdict
+import json
+import logging
+import sqlite3
+import time
+from typing import Callable, Dict, Iterator, List, Optional
+import uuid
+
+from birr.batch_inference.data_models import Message, RowRange
+from birr.batch_inference.metrics import set_gauge
+from birr.batch_inference.queue.base_queue import BaseQueue
+from birr.batch_inference.queue.in_memory_queue import messages_for_file, ordered_messages
+from birr.batch_inference.utils import determine_remaining_files_to_process
+from birr.core.config import PipelineConfig
+
+logger = logging.getLogger(__name__)
+
+# The states a message goes through
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+DEAD = "dead"
+
+
+class SqliteQueue(BaseQueue):
+    def __init__(self, pipeline_config: PipelineConfig, clock: Callable[[], float] = time.time) -> None:
+        assert pipeline_config.queue_path, "`PipelineConfig.queue_path` must be set"
+        self.path = pipeline_config.queue_path
+        self._visibility_timeout = pipeline_config.queue_visibility_timeout
+        self._max_attempts = pipeline_config.queue_max_attempts
+        # Wall clock time, since leases are compared across processes
+        self._clock = clock
+
+        # Transactions are begun explicitly, so that handing out a message is a single atomic step
+        # even with several runners sharing the database
+        self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                position INTEGER PRIMARY KEY,
+                message_id TEXT NOT NULL UNIQUE,
+                bucket_name TEXT NOT NULL,
+                object_key TEXT NOT NULL,
+                row_range TEXT,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                receipt_handle TEXT,
+                lease_expires_at REAL
+            )
+            """)
+        self._connection.execute("CREATE INDEX IF NOT EXISTS messages_by_state ON messages (state, position)")
+
+        if not self._num_messages():
+            # Scanned outside the transaction, so other runners aren't blocked meanwhile
+            self._add_messages_if_empty(self._scan(pipeline_config))
+        self._set_depth_gauge()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # Takes the write lock up front, so two runners can't read the same pending messages
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._connection
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")
+
+    def _num_messages(self) -> int:
+        (num_messages,) = self._connection.execute("SELECT COUNT(*) FROM messages").fetchone()
+        return num_messages
+
+    @staticmethod
+    def _scan(pipeline_config: PipelineConfig) -> List[Message]:
+        remaining_files_to_process = determine_remaining_files_to_process(
+            input_dir=pipeline_config.input_file_dir, output_dir=pipeline_config.output_file_dir
+        )
+        return ordered_messages(
+            [
+                message
+                for index, f in enumerate(remaining_files_to_process)
+                for message in messages_for_file(index, f, pipeline_config)
+            ],
+            pipeline_config,
+        )
+
+    def _add_messages_if_empty(self, messages: List[Message]) -> None:
+        with self._transaction() as connection:
+            if self._num_messages():
+                return
+
+            connection.executemany(
+                """
+                INSERT INTO messages (position, message_id, bucket_name, object_key, row_range, state)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (
+                        position,
+                        message.message_id,
+                        message.bucket_name,
+                        message.object_key,
+                        json.dumps(asdict(message.row_range)) if message.row_range else None,
+                        PENDING,
+                    )
+                    for position, message in enumerate(messages)
+                ],
+            )
+        logger.info(f"Added {len(messages)} messages to the queue at {self.path}")
+
+    def _set_depth_gauge(self) -> None:
+        (num_pending,) = self._connection.execute(
+            "SELECT COUNT(*) FROM messages WHERE state = ?", (PENDING,)
+        ).fetchone()
+        set_gauge("birr_queue_depth", num_pending)
+
+    def get_message(self) -> Optional[Message]:
+        messages = self.get_messages(1)
+        return messages[0] if messages else None
+
+    def get_messages(self, n: int) -> List[Message]:
+        now = self._clock()
+        with self._transaction() as connection:
+            dead_ids = [
+                message_id
+                for (message_id,) in connection.execute(
+                    "SELECT message_id FROM messages WHERE state = ? AND lease_expires_at <= ? AND attempts >= ?",
+                    (LEASED, now, self._max_attempts),
+                )
+            ]
+            if dead_ids:
+                logger.warning(f"Giving up on messages after {self._max_attempts} attempts: {dead_ids}")
+                connection.executemany(
+                    "UPDATE messages SET state = ?, receipt_handle = NULL, lease_expires_at = NULL "
+                    "WHERE message_id = ?",
+                    [(DEAD, message_id) for message_id in dead_ids],
+                )
+
+            # Pending messages, and those whose lease expired, in the order they were added
+            rows = connection.execute(
+                """
+                SELECT message_id, bucket_name, object_key, row_range FROM messages
+                WHERE state = ? OR (state = ? AND lease_expires_at <= ?)
+                ORDER BY position LIMIT ?
+                """,
+                (PENDING, LEASED, now, n),
+            ).fetchall()
+
+            messages = [
+                Message(
+                    message_id=message_id,
+                    receipt_handle=uuid.uuid4().hex,
+                    bucket_name=bucket_name,
+                    object_key=object_key,
+                    row_range=RowRange(**json.loads(row_range)) if row_range else None,
+                )
+                for message_id, bucket_name, object_key, row_range in rows
+            ]
+            connection.executemany(
+                """
+                UPDATE messages SET state = ?, attempts = attempts + 1, receipt_handle = ?, lease_expires_at = ?
+                WHERE message_id = ?
+                """,
+                [
+                    (LEASED, message.receipt_handle, now + self._visibility_timeout, message.message_id)
+                    for message in messages
+                ],
+            )
+
+        self._set_depth_gauge()
+        return messages
+
+    def delete_message(self, message: Message) -> None:
+        # Completed work counts even if its lease expired meanwhile, as long as it wasn't handed out again
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                """
+                UPDATE messages SET state = ?, receipt_handle = NULL, lease_expires_at = NULL
+                WHERE message_id = ? AND receipt_handle = ?
+                """,
+                (DONE, message.message_id, message.receipt_handle),
+            )
+        if cursor.rowcount != 1:
+            logger.warning(f"Not completing message {message.message_id}, whose lease was handed out again")
+
+    def extend_lease(self, message: Message) -> bool:
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE messages SET lease_expires_at = ? WHERE message_id = ? AND receipt_handle = ?",
+                (self._clock() + self._visibility_timeout, message.message_id, message.receipt_handle),
+            )
+        return cursor.rowcount == 1
+
+    def release_message(self, message: Message) -> None:
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT attempts FROM messages WHERE message_id = ? AND receipt_handle = ?",
+                (message.message_id, message.receipt_handle),
+            ).fetchone()
+            if row is None:
+                return
+
+            (attempts,) = row
+            if attempts >= self._max_attempts:
+                logger.warning(f"Giving up on message after {attempts} attempts: {message.message_id}")
+            connection.execute(
+                "UPDATE messages SET state = ?, receipt_handle = NULL, lease_expires_at = NULL WHERE message_id = ?",
+                (DEAD if attempts >= self._max_attempts else PENDING, message.message_id),
+            )
+        self._set_depth_gauge()
+
+    def is_drained(self) -> bool:
+        (num_unfinished,) = self._connection.execute(
+            "SELECT COUNT(*) FROM messages WHERE state IN (?, ?)", (PENDING, LEASED)
+        ).fetchone()
+        return not num_unfinished
+
+    def num_messages_by_state(self) -> Dict[str, int]:
+        return dict(self._connection.execute("SELECT state, COUNT(*) FROM messages GROUP BY state").fetchall())
+
+    def close(self) -> None:
+        self._connection.close()
@@ -0,0 +1,99 @@
+"""
+Persistent cache of generated completions, so a re-run only predicts the rows whose prompts changed.
+
+Completions are stored in a SQLite database, keyed by a hash of the namespace (the model and
+`GenerateConfig`) and the row's prompt, i.e. its token ids and images. Values are the completion's
+outputs before decoding, as JSON. With a non-zero temperature, a cached completion is simply
+the sample drawn by the run that stored it.
+"""
+
+import hashlib
+import json
+import sqlite3
+from typing import Any, Dict, List, Sequence, Tuple
+
+from birr.batch_inference.data_models import (
+    CompletedItem,
+    CompletionError,
+    CompletionOutput,
+    PreparedBatch,
+    token_ids_to_list,
+)
+from birr.core.config import GenerateConfig, LLMModelConfig
+
+# Keeps each lookup's number of bound parameters below SQLite's limit
+MAX_KEYS_PER_QUERY = 500
+
+
+def result_cache_namespace(model_config: LLMModelConfig, generate_config: GenerateConfig) -> str:
+    identity = dict(
+        name_or_path=model_config.name_or_path,
+        dtype=model_config.dtype,
+        generate_config=generate_config.model_dump(),
+    )
+    return hashlib.blake2b(json.dumps(identity, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def prompt_cache_keys(namespace: str, batch: PreparedBatch) -> List[bytes]:
+    keys = []
+    for position in range(len(batch)):
+        hasher = hashlib.blake2b(namespace.encode("utf-8"), digest_size=16)
+        for part in batch.prompt_key(position):
+            hasher.update(len(part).to_bytes(8, "little"))
+            hasher.update(part)
+        keys.append(hasher.digest())
+    return keys
+
+
+def completed_item_to_json(item: CompletedItem) -> str:
+    outputs = [
+        dict(
+            index=output.index,
+            token_ids=token_ids_to_list(output.token_ids),
+            finish_reason=output.finish_reason,
+            stop_reason=output.stop_reason,
+        )
+        for output in item.outputs
+    ]
+    return json.dumps(dict(outputs=outputs, error=item.error.value if item.error else None))
+
+
+def completed_item_from_json(index: int, value: str) -> CompletedItem:
+    d: Dict[str, Any] = json.loads(value)
+    return CompletedItem(
+        index=index,
+        outputs=[CompletionOutput(text="", **output) for output in d["outputs"]],
+        error=CompletionError(d["error"]) if d["error"] else None,
+    )
+
+
+class ResultCache:
+    def __init__(self, path: str, namespace: str) -> None:
+        self.path = path
+        self.namespace = namespace
+        # Several workers may share one database, so wait for each other's writes instead of failing.
+        # Only ever used by one thread at a time, but not necessarily the one that opened it.
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, value TEXT NOT NULL)")
+        self._connection.commit()
+
+    def get_many(self, keys: Sequence[bytes]) -> Dict[bytes, str]:
+        found: Dict[bytes, str] = {}
+        for start in range(0, len(keys), MAX_KEYS_PER_QUERY):
+            chunk = keys[start : start + MAX_KEYS_PER_QUERY]
+            rows = self._connection.execute(
+                f"SELECT key, value FROM results WHERE key IN ({', '.join('?' * len(chunk))})", chunk
+            )
+            found.update(rows.fetchall())
+        return found
+
+    def put_many(self, entries: Sequence[Tuple[bytes, CompletedItem]]) -> None:
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)",
+                [(key, completed_item_to_json(item)) for key, item in entries],
+            )
+
+    def close(self) -> None:
+        self._connection.close()
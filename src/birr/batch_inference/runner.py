@@ -1,14 +1,18 @@
+from dataclasses import dataclass
 import logging
-from typing import Optional
+from typing import Any, List, Optional, Type
 
 import click
 import ray
 from ray.util import ActorPool
 
 from birr.batch_inference.generate_io_processor import GenerateIOProcessor
-from birr.batch_inference.predictors.predictor import Predictor
+from birr.batch_inference.predictors.base_predictor import BasePredictor
+from birr.batch_inference.queue.dummy_predictor import DummyPredictor
 from birr.batch_inference.queue.in_memory_queue import InMemoryQueue
+from birr.batch_inference.queue.sqlite_queue import SqliteQueue
 from birr.batch_inference.settings import Settings
+from birr.batch_inference.tracing import TRACE_DIR_ENV_VAR, merge_traces, new_run_trace_dir
 from birr.batch_inference.worker import Worker
 
 
@@ -20,6 +24,12 @@ class InMemoryQueueActor(InMemoryQueue):
     """Simple ray actor wrapper around the underlying birr.batch_inference.in_memory_queue class"""
 
 
+# Its state is all in the database, so it can simply be restarted
+@ray.remote(num_cpus=0.25, max_restarts=-1, max_task_retries=3)
+class SqliteQueueActor(SqliteQueue):
+    """Simple ray actor wrapper around the underlying birr.batch_inference.sqlite_queue class"""
+
+
 @ray.remote(num_cpus=1)
 class TokenizerActor(GenerateIOProcessor):
     """Simple ray actor wrapper around the underlying birr.batch_inference.tokenizer class"""
@@ -30,40 +40,98 @@ class WorkerActor(Worker):
     """Simple ray actor wrapper around the underlying birr.batch_inference.worker class"""
 
 
-def main(settings: Optional[Settings] = None) -> None:
-    settings = settings if settings else Settings()
-    ray.init(
-        object_store_memory=10**9 * 2,
-        _metrics_export_port=8080,
-        logging_config=ray.LoggingConfig(encoding="TEXT", log_level="INFO"),
-    )
-    logger.info("Starting batch inference server with settings:\n %s", settings)
+@dataclass
+class Pipeline:
+    """The actors of a running pipeline."""
 
-    queue = InMemoryQueueActor.remote(settings.pipeline_config)  # type: ignore
+    queue: Any
+    tokenizers: List[Any]
+    predictors: List[Any]
+    workers: List[Any]
 
-    tokenizer_pool = ActorPool(
-        [TokenizerActor.remote(settings.llm_model_config, settings.format_config) for _ in range(settings.pipeline_config.num_tokenizers)]  # type: ignore
-    )
 
-    @ray.remote(
+def _predictor_class(settings: Settings) -> Type[BasePredictor]:
+    if settings.dummy_mode:
+        return DummyPredictor
+
+    # vLLM is only imported when predicting for real, since it can't be installed everywhere, e.g. on macs
+    if settings.pipeline_config.continuous_batching_slots:
+        from birr.batch_inference.predictors.async_predictor import AsyncPredictor
+
+        return AsyncPredictor
+
+    from birr.batch_inference.predictors.predictor import Predictor
+
+    return Predictor
+
+
+def start_pipeline(settings: Settings, predictor_class: Optional[Type[BasePredictor]] = None) -> Pipeline:
+    """
+    Creates the queue, tokenizer, predictor and worker actors of a pipeline and starts the workers,
+    whose `run` calls finish once the queue is drained. Predictors are vLLM ones, or `DummyPredictor`s
+    in dummy mode, unless another `predictor_class` is given.
+    """
+    queue_actor_class = SqliteQueueActor if settings.pipeline_config.queue_path else InMemoryQueueActor
+    queue = queue_actor_class.remote(settings.pipeline_config)  # type: ignore
+
+    tokenizers = [
+        TokenizerActor.remote(  # type: ignore
+            settings.llm_model_config, settings.format_config, settings.pipeline_config.tokenization_cache_dir
+        )
+        for _ in range(settings.pipeline_config.num_tokenizers)
+    ]
+    tokenizer_pool = ActorPool(tokenizers)
+
+    predictor_actor_class = ray.remote(
         num_gpus=settings.gpus_per_predictor,
         max_restarts=settings.pipeline_config.allowed_restarts_per_predictor,
         max_task_retries=settings.pipeline_config.max_task_retries,
-    )
-    class PredictorActor(Predictor):
-        """Simple ray actor wrapper around the underlying birr.batch_inference.predictor class"""
-
+    )(predictor_class or _predictor_class(settings))
+    predictors = [
+        predictor_actor_class.remote(settings.llm_model_config, settings.generate_config)
+        # Dummy mode may run without GPUs, but still needs a predictor
+        for _ in range(settings.num_predictors or 1)
+    ]
+    # The pool hands out one batch per entry at a time, so listing an async predictor several times
+    # keeps that many batches in flight on it
+    continuous_batching_slots = settings.pipeline_config.continuous_batching_slots
     predictor_pool = ActorPool(
-        [PredictorActor.remote(settings.llm_model_config, settings.generate_config) for _ in range(settings.num_predictors)]  # type: ignore
+        [predictor for predictor in predictors for _ in range(continuous_batching_slots or 1)]
     )
 
+    # Prefetching tokenizes upcoming messages on a separate thread, which needs its own pool over the same actors
+    prefetch_tokenizer_pool = ActorPool(tokenizers) if settings.pipeline_config.prefetch_depth else None
+
     workers = [
-        WorkerActor.remote(settings, queue, tokenizer_pool, predictor_pool)  # type: ignore
+        WorkerActor.remote(settings, queue, tokenizer_pool, predictor_pool, prefetch_tokenizer_pool)  # type: ignore
         for _ in range(settings.pipeline_config.num_workers)
     ]
 
+    return Pipeline(queue=queue, tokenizers=tokenizers, predictors=predictors, workers=workers)
+
+
+def main(settings: Optional[Settings] = None) -> None:
+    settings = settings if settings else Settings()
+    trace_dir = settings.pipeline_config.trace_dir
+    if trace_dir:
+        # Traces go to a directory of the job's own, so a reused `trace_dir` doesn't mix in earlier jobs
+        trace_dir = new_run_trace_dir(trace_dir)
+    ray.init(
+        object_store_memory=10**9 * 2,
+        _metrics_export_port=8080,
+        logging_config=ray.LoggingConfig(encoding="TEXT", log_level="INFO"),
+        # Not every actor gets the settings, so tracing is turned on for all of them through the environment
+        runtime_env=dict(env_vars={TRACE_DIR_ENV_VAR: trace_dir}) if trace_dir else None,
+    )
+    logger.info("Starting batch inference server with settings:\n %s", settings)
+
+    pipeline = start_pipeline(settings)
+
     # Start work loop
-    ray.get([worker.run.remote() for worker in workers])
+    ray.get([worker.run.remote() for worker in pipeline.workers])
+
+    if trace_dir:
+        merge_traces(trace_dir)
 
 
 if __name__ == "__main__":
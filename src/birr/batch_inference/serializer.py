@@ -1,29 +1,34 @@
 from typing import Any, Callable, Dict, List, Optional
 
-from birr.batch_inference.data_models import CompletionError, CompletionOutput
-
+from birr.batch_inference.data_models import CompletionError, CompletionOutput, token_ids_to_list
 
 SerializerType = Callable[[Dict[str, Any], List[CompletionOutput], Optional[CompletionError]], Dict[str, Any]]
 
+# Fields `default_serializer` adds to each input row, replacing any the input already has
+OUTPUT_FIELDS = ("outputs", "completion_error")
 
-def default_serializer(
-    input_dict: Dict[str, Any], outputs: List[CompletionOutput], completion_error: Optional[CompletionError]
-) -> Dict[str, Any]:
-    output = dict(**input_dict)
 
+def output_fields(outputs: List[CompletionOutput], completion_error: Optional[CompletionError]) -> Dict[str, Any]:
     if completion_error:
-        output["outputs"] = None
-        output["completion_error"] = completion_error.value
-    else:
-        output["outputs"] = [
+        return dict(outputs=None, completion_error=completion_error.value)
+
+    return dict(
+        outputs=[
             dict(
                 index=output.index,
                 text=output.text,
-                token_ids=output.token_ids,
+                token_ids=token_ids_to_list(output.token_ids),
                 finish_reason=output.finish_reason,
                 stop_reason=output.stop_reason,
             )
             for output in outputs
         ]
+    )
 
+
+def default_serializer(
+    input_dict: Dict[str, Any], outputs: List[CompletionOutput], completion_error: Optional[CompletionError]
+) -> Dict[str, Any]:
+    output = dict(**input_dict)
+    output.update(output_fields(outputs, completion_error))
     return output
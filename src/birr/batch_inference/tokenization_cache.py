@@ -0,0 +1,144 @@
+"""
+Persistent, content-addressed cache of prompt token ids.
+
+Entries live under `<cache_dir>/<namespace>/`, where the namespace is a hash of everything
+besides the messages that determines how a row is tokenized (tokenizer, chat template and
+`FormatConfig`). Each writer appends to its own shard, which is a flat int32 `.tokens` file
+plus an `.index` of fixed-width (key, offset, length) entries, so tokenizer actors on one
+node can share a cache directory without locking. Token ids are only ever appended before
+the index entry pointing at them, so a torn write leaves at worst an unreachable tail.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from typing import BinaryIO, Dict, List, Optional, Sequence, Tuple
+import uuid
+
+import numpy as np
+import numpy.typing as npt
+
+from birr.batch_inference.data_models import ChatMessage, TokenIds
+from birr.core.config import FormatConfig, LLMModelConfig
+from birr.tokenization import ModelTokenizer
+
+logger = logging.getLogger(__name__)
+
+
+INDEX_ENTRY_DTYPE = np.dtype([("key", "V16"), ("offset", "<i8"), ("length", "<i4")])
+TOKENS_SUFFIX = ".tokens"
+INDEX_SUFFIX = ".index"
+
+
+def tokenization_cache_namespace(
+    tokenizer: ModelTokenizer, model_config: LLMModelConfig, format_config: FormatConfig
+) -> str:
+    identity = dict(
+        name_or_path=model_config.name_or_path,
+        fast_tokenizer=model_config.fast_tokenizer,
+        tokenizer_class=type(tokenizer.tokenizer).__name__,
+        vocab_size=len(tokenizer),
+        chat_template=tokenizer.tokenizer.chat_template,
+        format_config=format_config.model_dump(),
+    )
+    return hashlib.blake2b(json.dumps(identity, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def messages_cache_key(messages: List[ChatMessage]) -> bytes:
+    serialized = json.dumps([message.to_dict() for message in messages], sort_keys=True)
+    return hashlib.blake2b(serialized.encode("utf-8"), digest_size=16).digest()
+
+
+class TokenizationCache:
+    def __init__(self, cache_dir: str, namespace: str) -> None:
+        self.namespace_dir = os.path.join(cache_dir, namespace)
+        os.makedirs(self.namespace_dir, exist_ok=True)
+
+        # Shards written by earlier runs or other actors are memory-mapped and never modified again
+        self._shards: List[np.ndarray] = []
+        # Key -> (shard number, offset, length); our own shard is number -1
+        self._index: Dict[bytes, Tuple[int, int, int]] = {}
+        self._load_existing_shards()
+
+        # Our own shard is only created once there is something to write to it
+        self._shard_path = os.path.join(self.namespace_dir, f"shard-{uuid.uuid4().hex}")
+        self._tokens_file: Optional[BinaryIO] = None
+        self._index_file: Optional[BinaryIO] = None
+        self._num_tokens_written = 0
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get(self, key: bytes) -> Optional[npt.NDArray[np.int32]]:
+        location = self._index.get(key)
+        if location is None:
+            return None
+
+        shard_number, offset, length = location
+        if shard_number == -1:
+            assert self._tokens_file is not None
+            data = os.pread(self._tokens_file.fileno(), length * 4, offset * 4)
+            return np.frombuffer(data, dtype=np.int32)
+
+        # Copied out of the memory map so the result can be pickled and outlive the map
+        return np.array(self._shards[shard_number][offset : offset + length])
+
+    def put_many(self, entries: Sequence[Tuple[bytes, TokenIds]]) -> None:
+        entries = list({key: token_ids for key, token_ids in entries if key not in self._index}.items())
+        if not entries:
+            return
+
+        if self._tokens_file is None or self._index_file is None:
+            # Readable too, since entries from our own shard are read back with `pread`
+            self._tokens_file = open(f"{self._shard_path}{TOKENS_SUFFIX}", "a+b")
+            self._index_file = open(f"{self._shard_path}{INDEX_SUFFIX}", "ab")
+
+        index_entries = np.empty(len(entries), dtype=INDEX_ENTRY_DTYPE)
+        offset = self._num_tokens_written
+        for i, (key, token_ids) in enumerate(entries):
+            index_entries[i] = (key, offset, len(token_ids))
+            offset += len(token_ids)
+
+        self._tokens_file.write(np.concatenate([np.asarray(t, dtype=np.int32) for _, t in entries]).tobytes())
+        self._tokens_file.flush()
+        self._index_file.write(index_entries.tobytes())
+        self._index_file.flush()
+
+        for key, entry_offset, length in index_entries.tolist():
+            self._index[key] = (-1, entry_offset, length)
+        self._num_tokens_written = offset
+
+    def close(self) -> None:
+        if self._tokens_file is not None:
+            self._tokens_file.close()
+        if self._index_file is not None:
+            self._index_file.close()
+
+    def _load_existing_shards(self) -> None:
+        for filename in sorted(os.listdir(self.namespace_dir)):
+            if not filename.endswith(INDEX_SUFFIX):
+                continue
+
+            shard_path = os.path.join(self.namespace_dir, filename[: -len(INDEX_SUFFIX)])
+            tokens_path = f"{shard_path}{TOKENS_SUFFIX}"
+            num_tokens = os.path.getsize(tokens_path) // 4 if os.path.exists(tokens_path) else 0
+            if not num_tokens:
+                continue
+
+            with open(f"{shard_path}{INDEX_SUFFIX}", "rb") as f:
+                index_data = f.read()
+            # A torn trailing entry is dropped
+            usable_size = len(index_data) - len(index_data) % INDEX_ENTRY_DTYPE.itemsize
+            index_entries = np.frombuffer(index_data[:usable_size], dtype=INDEX_ENTRY_DTYPE)
+
+            tokens = np.memmap(tokens_path, dtype=np.int32, mode="r", shape=(num_tokens,))
+            shard_number = len(self._shards)
+            self._shards.append(tokens)
+
+            for key, offset, length in index_entries.tolist():
+                if offset + length <= num_tokens:
+                    self._index.setdefault(key, (shard_number, offset, length))
+
+        if self._index:
+            logger.info(f"Loaded {len(self._index)} cached tokenizations from {self.namespace_dir}")
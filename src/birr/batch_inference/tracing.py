@@ -0,0 +1,134 @@
+"""
+Span tracing of where each message's wall time goes, exported as a Chrome trace.
+
+When the `BIRR_TRACE_DIR` environment variable is set (see `PipelineConfig.trace_dir`, of which
+each job gets a directory of its own from `new_run_trace_dir`), every process appends one event per
+span to its own file in that directory, and `merge_traces` combines them into a single `trace.json`
+that opens in chrome://tracing or https://ui.perfetto.dev, with a row per process and thread,
+labelled by its role and Ray actor id. Otherwise a span costs one check of a cached setting.
+"""
+
+from contextlib import contextmanager
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+import uuid
+
+import ray
+
+logger = logging.getLogger(__name__)
+
+
+TRACE_DIR_ENV_VAR = "BIRR_TRACE_DIR"
+MERGED_TRACE_FILE_NAME = "trace.json"
+TRACE_FILE_SUFFIX = ".trace.jsonl"
+
+
+class _Tracer:
+    def __init__(self, trace_dir: str) -> None:
+        os.makedirs(trace_dir, exist_ok=True)
+        self._pid = os.getpid()
+        path = os.path.join(trace_dir, f"{socket.gethostname()}-{self._pid}{TRACE_FILE_SUFFIX}")
+        # Line buffered, so events recorded before an actor is killed aren't lost
+        self._file = open(path, "a", buffering=1)
+        # Spans may end on several threads, e.g. a worker's prefetch thread
+        self._lock = threading.Lock()
+        self._named = False
+
+    def record(self, name: str, cat: str, start_us: int, duration_us: int, tid: int, args: Dict[str, Any]) -> None:
+        with self._lock:
+            if not self._named:
+                # The first span names the process's row after its role, e.g. "predictor 4f3a9c1e"
+                actor_id = ray.get_runtime_context().get_actor_id() if ray.is_initialized() else None
+                label = f"{cat} {actor_id[:8] if actor_id else self._pid}"
+                self._write(dict(name="process_name", ph="M", pid=self._pid, args=dict(name=label)))
+                self._named = True
+
+            self._write(
+                dict(name=name, cat=cat, ph="X", ts=start_us, dur=duration_us, pid=self._pid, tid=tid, args=args)
+            )
+
+    def _write(self, event: Dict[str, Any]) -> None:
+        self._file.write(json.dumps(event) + "\n")
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+_tracer: Optional[_Tracer] = None
+_tracer_loaded = False
+
+
+def _get_tracer() -> Optional[_Tracer]:
+    global _tracer, _tracer_loaded
+
+    if not _tracer_loaded:
+        trace_dir = os.environ.get(TRACE_DIR_ENV_VAR)
+        _tracer = _Tracer(trace_dir) if trace_dir else None
+        _tracer_loaded = True
+
+    return _tracer
+
+
+@contextmanager
+def span(name: str, cat: str, lane: Optional[int] = None, **args: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Traces the enclosed block as a span of stage `name`, in a process whose role is `cat`.
+
+    Yields the span's args, so details only known at the end can be added to them. Spans are drawn
+    on their thread's row unless given a `lane`, for concurrent spans on a single thread.
+    """
+    tracer = _get_tracer()
+    if tracer is None:
+        yield args
+        return
+
+    start_us = time.time_ns() // 1000
+    started = time.perf_counter()
+    try:
+        yield args
+    finally:
+        duration_us = int((time.perf_counter() - started) * 1e6)
+        tid = lane if lane is not None else threading.get_native_id()
+        tracer.record(name, cat, start_us, duration_us, tid, args)
+
+
+def new_run_trace_dir(trace_dir: str) -> str:
+    """
+    Creates a directory in `trace_dir` for one job's traces, and returns its path, so that a job
+    reusing `trace_dir` doesn't merge the traces of earlier ones into its own.
+    """
+    run_trace_dir = os.path.join(trace_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}")
+    os.makedirs(run_trace_dir)
+    return run_trace_dir
+
+
+def merge_traces(trace_dir: str) -> str:
+    """
+    Combines the per-process trace files in `trace_dir` into a single Chrome trace, and returns its path.
+    Processes are renumbered per file, since pids of different hosts may clash.
+    """
+    events: List[Dict[str, Any]] = []
+    file_names = sorted(name for name in os.listdir(trace_dir) if name.endswith(TRACE_FILE_SUFFIX))
+    for pid, file_name in enumerate(file_names):
+        with open(os.path.join(trace_dir, file_name), "r") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line of a process killed mid-write
+                    continue
+                event["pid"] = pid
+                events.append(event)
+
+    path = os.path.join(trace_dir, MERGED_TRACE_FILE_NAME)
+    with open(path, "w") as f:
+        json.dump(dict(traceEvents=events, displayTimeUnit="ms"), f)
+
+    logger.info(f"Wrote a trace of {len(events)} events from {len(file_names)} processes to {path}")
+    return path
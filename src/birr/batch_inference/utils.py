@@ -1,47 +1,194 @@
+from contextlib import contextmanager
+import gzip
+import io
 from itertools import islice
 import json
 import os
-from typing import Any, Dict, Iterable, Iterator, List, Tuple
+import shutil
+import uuid
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+    cast,
+)
 
+import numpy as np
+import numpy.typing as npt
+import zstandard
 
-from birr.batch_inference.data_models import PreparedInputItem
+from birr.batch_inference.data_models import CompletedBatch, PreparedBatch, PreparedInputItem, RowRange
+from birr.batch_inference.json_codec import OutputRow, encode_output_rows
 
+# Anything the batching helpers can split; `PreparedBatch` is split into views without materializing rows
+Batchable = TypeVar("Batchable", List[PreparedInputItem], PreparedBatch)
+
+
+def simple_chunks(l: Union[Iterable[Any], PreparedBatch], n: int) -> Iterator[Any]:
+    if isinstance(l, PreparedBatch):
+        for start in range(0, len(l), n):
+            yield l[start : start + n]
+        return
 
-def simple_chunks(l: Iterable[Any], n: int) -> Iterator[List[Any]]:
     iterator = iter(l)
     while chunk := list(islice(iterator, n)):
         yield chunk
 
 
+def merged_chunks(batches: Iterable[CompletedBatch], n: int) -> Iterator[CompletedBatch]:
+    """
+    Merges consecutive batches until they hold at least `n` entries. Batches are never split,
+    so all outputs of a row stay together.
+    """
+    pending: List[CompletedBatch] = []
+    num_pending = 0
+    for batch in batches:
+        pending.append(batch)
+        num_pending += len(batch)
+        if num_pending >= n:
+            yield CompletedBatch.concat(pending)
+            pending, num_pending = [], 0
+
+    if pending:
+        yield CompletedBatch.concat(pending)
+
+
+def token_lengths(l: Batchable) -> List[int]:
+    if isinstance(l, PreparedBatch):
+        return l.lengths.tolist()
+    return [len(item.token_ids) for item in l]
+
+
 def prediction_batches(
-    l: List[PreparedInputItem], batch_size_config: List[Tuple[int, int]]
-) -> Iterator[List[PreparedInputItem]]:
-    batch: List[PreparedInputItem] = []
+    l: Batchable, batch_size_config: List[Tuple[int, int]], sequences_per_prompt: int = 1
+) -> Iterator[Batchable]:
+    # Batch sizes count decoded sequences, so prompts sampled several times fill a batch sooner
+    batch_size_config = [
+        (threshold_tokens, max(1, batch_size // sequences_per_prompt))
+        for threshold_tokens, batch_size in batch_size_config
+    ]
+    batch_start = 0
     current_threshold_index = 0
     nearest_threshold_tokens, nearest_threshold_batch_size = batch_size_config[current_threshold_index]
 
-    for item in l:
-        num_tokens = len(item.token_ids)
-
+    for position, num_tokens in enumerate(token_lengths(l)):
         # We're either within current size bracket, or have no larger bracket to go up to.
         # Simply accumulate until the batch is full and then yield.
         if num_tokens <= nearest_threshold_tokens or current_threshold_index == len(batch_size_config) - 1:
-            if len(batch) == nearest_threshold_batch_size:
-                batch_to_yield = batch
-                batch = [item]
-                yield batch_to_yield
-            else:
-                batch.append(item)
+            if position - batch_start == nearest_threshold_batch_size:
+                yield l[batch_start:position]
+                batch_start = position
 
         # We need to move to larger bracket and yield whatever is in current batch.
         else:
             current_threshold_index += 1
             nearest_threshold_tokens, nearest_threshold_batch_size = batch_size_config[current_threshold_index]
-            batch_to_yield = batch
-            batch = [item]
-            yield batch_to_yield
+            if position > batch_start:
+                yield l[batch_start:position]
+                batch_start = position
+
+    if len(l) > batch_start:
+        yield l[batch_start:]
+
+
+def token_budget_batches(
+    l: Batchable,
+    token_budget: int,
+    max_tokens: Optional[int] = None,
+    cost_model: str = "reserved",
+    sequences_per_prompt: int = 1,
+) -> Iterator[Batchable]:
+    """
+    Batches length-sorted items so that each batch's estimated token cost stays within `token_budget`.
+
+    The "reserved" cost model counts each row's prompt plus the tokens reserved for its completions,
+    which is `max_tokens`, or the batch's longest prompt when unset (as in `Predictor.predict`), for
+    each of the `sequences_per_prompt` sequences sampled from it. The prompt itself is shared by them.
+    The "padded" cost model counts the batch's longest prompt times its number of sequences.
+    A single row costing more than the budget is still yielded, as a batch of its own.
+    """
+    batch_start = 0
+    prompt_tokens = 0
+    longest_prompt = 0
+
+    for position, num_tokens in enumerate(token_lengths(l)):
+        num_rows = position - batch_start + 1
+        candidate_longest_prompt = max(longest_prompt, num_tokens)
+
+        num_sequences = num_rows * sequences_per_prompt
+        if cost_model == "padded":
+            cost = candidate_longest_prompt * num_sequences
+        else:
+            cost = prompt_tokens + num_tokens + num_sequences * (max_tokens or candidate_longest_prompt)
+
+        if num_rows > 1 and cost > token_budget:
+            yield l[batch_start:position]
+            batch_start, prompt_tokens, longest_prompt = position, 0, 0
+
+        prompt_tokens += num_tokens
+        longest_prompt = max(longest_prompt, num_tokens)
+
+    if len(l) > batch_start:
+        yield l[batch_start:]
 
-    yield batch
+
+def discard_pending(pool: Any) -> int:
+    """
+    Waits for the results still pending in an `ActorPool`, e.g. those of a stream abandoned partway,
+    and discards them, so they can't be taken for results of values submitted later. Returns how
+    many were discarded.
+    """
+    num_discarded = 0
+    while pool.has_next():
+        num_discarded += 1
+        try:
+            pool.get_next_unordered()
+        except Exception:
+            pass
+    return num_discarded
+
+
+def stream_unordered(pool: Any, fn: Callable[[Any, Any], Any], values: Iterable[Any]) -> Iterator[Any]:
+    """
+    Like `ActorPool.map_unordered`, but consumes `values` lazily and hands back each result
+    as soon as it is ready, rather than only after every value has been submitted. Like it,
+    first discards whatever results an earlier stream left pending.
+    """
+    discard_pending(pool)
+    for value in values:
+        pool.submit(fn, value)
+        while pool.has_next():
+            try:
+                yield pool.get_next_unordered(timeout=0)
+            except TimeoutError:
+                break
+
+    while pool.has_next():
+        yield pool.get_next_unordered()
+
+
+def stream_when_free(pool: Any, fn: Callable[[Any, Any], Any], values: Iterable[Any]) -> Iterator[Any]:
+    """
+    Like `stream_unordered`, but only takes the next value once an actor is free to work on it,
+    so `values` can be produced with what was learned from the results so far.
+    """
+    discard_pending(pool)
+    for value in values:
+        while not pool.has_free():
+            yield pool.get_next_unordered()
+        pool.submit(fn, value)
+
+    while pool.has_next():
+        yield pool.get_next_unordered()
 
 
 def flatten(batches: Iterable[List[Any]]) -> Iterator[Any]:
@@ -50,43 +197,297 @@ def flatten(batches: Iterable[List[Any]]) -> Iterator[Any]:
             yield item
 
 
-def flatten_and_sort(token_batches: List[List[PreparedInputItem]]) -> List[PreparedInputItem]:
-    acc = []
-    for batch in token_batches:
-        for item in batch:
-            acc.append(item)
+def deduplicate_prompts(batch: PreparedBatch) -> Tuple[PreparedBatch, Dict[int, List[int]]]:
+    """
+    Keeps the first row of each distinct prompt, i.e. token ids plus images. Returns the remaining
+    rows in their original order, and the indices of each kept row's duplicates.
+    """
+    first_position_by_prompt: Dict[Tuple[bytes, ...], int] = {}
+    duplicate_indices: Dict[int, List[int]] = {}
+    kept_positions = []
 
-    return sorted(acc, key=lambda x: len(x.token_ids))
+    indices = batch.indices.tolist()
+    for position in range(len(batch)):
+        first_position = first_position_by_prompt.setdefault(batch.prompt_key(position), position)
+        if first_position == position:
+            kept_positions.append(position)
+        else:
+            duplicate_indices.setdefault(indices[first_position], []).append(indices[position])
 
+    if not duplicate_indices:
+        return batch, duplicate_indices
+    return batch.take(np.asarray(kept_positions, dtype=np.int64)), duplicate_indices
 
-def load_instances_from_local_file(file_path: str) -> List[Dict[str, Any]]:
-    instances = []
-    with open(file_path, "r") as f:
-        for line in f:
+
+def flatten_and_sort(
+    token_batches: Iterable[PreparedBatch], prefix_bucket_size: Optional[int] = None
+) -> PreparedBatch:
+    acc = PreparedBatch.concat(list(token_batches))
+    lengths = acc.lengths
+
+    order: npt.NDArray[np.int64]
+    if prefix_bucket_size:
+        # Within a bucket of similar lengths, sorting by token ids walks them in trie order,
+        # which puts rows that share a prompt prefix next to each other.
+        # Big-endian bytes of non-negative ids compare like the ids themselves.
+        big_endian_token_ids = acc.token_ids.astype(">i4")
+        keys = [
+            (length // prefix_bucket_size, big_endian_token_ids[start:end].tobytes())
+            for length, start, end in zip(lengths.tolist(), acc.offsets[:-1].tolist(), acc.offsets[1:].tolist())
+        ]
+        order = np.asarray(sorted(range(len(acc)), key=keys.__getitem__), dtype=np.int64)
+    else:
+        order = np.argsort(lengths, kind="stable")
+
+    return acc.take(order)
+
+
+# File suffixes we recognize as compressed, and the compression each implies
+COMPRESSION_SUFFIXES = {".zst": "zstd", ".zstd": "zstd", ".gz": "gzip"}
+# Suffix appended to output files written with each compression
+COMPRESSION_OUTPUT_SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+
+
+def compression_for(file_path: str) -> Optional[str]:
+    for suffix, compression in COMPRESSION_SUFFIXES.items():
+        if file_path.endswith(suffix):
+            return compression
+    return None
+
+
+def strip_compression_suffix(file_path: str) -> str:
+    for suffix in COMPRESSION_SUFFIXES:
+        if file_path.endswith(suffix):
+            return file_path[: -len(suffix)]
+    return file_path
+
+
+def is_jsonl_file(file_path: str) -> bool:
+    return strip_compression_suffix(file_path).endswith(".jsonl")
+
+
+def resolve_output_compression(input_file_path: str, output_compression: Optional[str]) -> Optional[str]:
+    """An `output_compression` of None follows the input file's compression; "none" means uncompressed."""
+    if output_compression is None:
+        return compression_for(input_file_path)
+    if output_compression == "none":
+        return None
+    return output_compression
+
+
+@contextmanager
+def open_for_reading(file_path: str, compression: Optional[str] = None) -> Iterator[IO[bytes]]:
+    """Opens a file for reading as a (decompressed) binary stream."""
+    with open(file_path, "rb") as raw:
+        if compression == "zstd":
+            # Appended outputs consist of several frames, so we must not stop after the first one
+            reader = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=False)
+            with io.BufferedReader(cast(io.RawIOBase, reader)) as f:
+                yield f
+        elif compression == "gzip":
+            with gzip.GzipFile(fileobj=raw, mode="rb") as f:
+                yield cast(IO[bytes], f)
+        else:
+            yield raw
+
+
+@contextmanager
+def open_for_writing(
+    file_path: str,
+    compression: Optional[str] = None,
+    append: bool = False,
+    compression_level: int = 3,
+    compression_threads: int = 0,
+    sync: bool = False,
+) -> Iterator[IO[bytes]]:
+    """
+    Opens a file for writing through a compressing stream. Appending adds a new zstd frame
+    or gzip member, both of which decompress as one contiguous stream.
+    """
+    with open(file_path, "ab" if append else "wb") as raw:
+        if compression == "zstd":
+            compressor = zstandard.ZstdCompressor(level=compression_level, threads=compression_threads)
+            with compressor.stream_writer(raw, closefd=False) as f:
+                yield cast(IO[bytes], f)
+        elif compression == "gzip":
+            with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=compression_level) as f:
+                yield cast(IO[bytes], f)
+        else:
+            yield raw
+
+        if sync:
+            raw.flush()
+            os.fsync(raw.fileno())
+
+
+def _lines_in_range(f: IO[bytes], row_range: RowRange) -> Iterator[bytes]:
+    f.seek(row_range.start_offset)
+    remaining_bytes = row_range.end_offset - row_range.start_offset
+    while remaining_bytes > 0 and (line := f.readline()):
+        remaining_bytes -= len(line)
+        yield line
+
+
+def iter_lines_from_local_file(file_path: str, row_range: Optional[RowRange] = None) -> Iterator[bytes]:
+    """Yields a file's non-empty lines, stripped, or only those within `row_range`."""
+    with open_for_reading(file_path, compression_for(file_path)) as f:
+        for line in f if row_range is None else _lines_in_range(f, row_range):
             content = line.strip()
             if content:
-                instances.append(json.loads(content))
-    return instances
+                yield content
+
+
+def iter_instances_from_local_file(
+    file_path: str, row_range: Optional[RowRange] = None
+) -> Iterator[Dict[str, Any]]:
+    for line in iter_lines_from_local_file(file_path, row_range):
+        yield json.loads(line)
+
+
+def load_instances_from_local_file(file_path: str) -> List[Dict[str, Any]]:
+    return list(iter_instances_from_local_file(file_path))
+
+
+def row_range_offsets(file_path: str, rows_per_range: int, block_size: int = 1 << 24) -> List[int]:
+    """
+    Byte offsets splitting an uncompressed file into ranges of `rows_per_range` lines, from 0 up to
+    the file's size, found by scanning for newlines a block at a time.
+    """
+    offsets = [0]
+    # Lines seen since the last offset
+    num_lines = 0
+    position = 0
+    with open(file_path, "rb") as f:
+        while block := f.read(block_size):
+            line_ends = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n")) + position + 1
+            offsets.extend(line_ends[rows_per_range - num_lines - 1 :: rows_per_range].tolist())
+            num_lines = (num_lines + len(line_ends)) % rows_per_range
+            position += len(block)
+
+    if offsets[-1] < position:
+        offsets.append(position)
+    return offsets
+
+
+def output_file_path_for(
+    input_file_path: str,
+    output_dir: str,
+    output_compression: Optional[str] = None,
+    row_range: Optional[RowRange] = None,
+) -> str:
+    filename = strip_compression_suffix(input_file_path.split("/")[-1])
+    if row_range is not None:
+        # Deliberately does not end in `.jsonl` so a part is never mistaken for a finished output
+        filename += f".part-{row_range.part_index:05d}-of-{row_range.num_parts:05d}"
+    compression = resolve_output_compression(input_file_path, output_compression)
+    if compression:
+        filename += COMPRESSION_OUTPUT_SUFFIXES[compression]
+    return os.path.join(output_dir, filename)
+
+
+def partial_output_file_path_for(output_file_path: str) -> str:
+    # Deliberately does not end in `.jsonl` so an unfinished file is never mistaken for a finished one.
+    return f"{output_file_path}.partial"
+
+
+def checkpoint_file_path_for(output_file_path: str) -> str:
+    return f"{output_file_path}.checkpoint"
+
+
+def has_checkpoint(
+    input_file_path: str,
+    output_dir: str,
+    output_compression: Optional[str] = None,
+    row_range: Optional[RowRange] = None,
+) -> bool:
+    output_file_path = output_file_path_for(input_file_path, output_dir, output_compression, row_range)
+    return os.path.isfile(checkpoint_file_path_for(output_file_path))
 
 
 def write_predictions_to_local_file(
-    predictions: List[Dict[str, Any]], input_file_path: str, output_dir: str
+    predictions: Sequence[OutputRow],
+    input_file_path: str,
+    output_dir: str,
+    output_compression: Optional[str] = None,
+    compression_level: int = 3,
+    compression_threads: int = 0,
+    row_range: Optional[RowRange] = None,
 ) -> None:
-    filename = input_file_path.split("/")[-1]
-    output_file_path = os.path.join(output_dir, filename)
-    data = "\n".join([json.dumps(prediction) for prediction in predictions])
-    with open(output_file_path, "w") as f:
+    output_file_path = output_file_path_for(input_file_path, output_dir, output_compression, row_range)
+    # Every line ends in a newline, as in checkpointed outputs, so that parts can be concatenated
+    data = b"".join(line + b"\n" for line in encode_output_rows(predictions))
+    # A part only appears once complete, since it being there marks it as done
+    write_file_path = output_file_path if row_range is None else partial_output_file_path_for(output_file_path)
+
+    with open_for_writing(
+        write_file_path,
+        compression_for(output_file_path),
+        compression_level=compression_level,
+        compression_threads=compression_threads,
+    ) as f:
         f.write(data)
 
+    if write_file_path != output_file_path:
+        os.replace(write_file_path, output_file_path)
+
+
+def merge_row_range_outputs(
+    input_file_path: str, output_dir: str, num_parts: int, output_compression: Optional[str] = None
+) -> bool:
+    """
+    Concatenates the outputs of all parts of an input file into its output, in order, once every part
+    is complete, and returns whether it did. Compressed parts concatenate into a single stream.
+
+    Workers completing the last parts at the same time may both merge, into files of their own that
+    replace the output with the same content, so no lock is needed.
+    """
+    part_file_paths = [
+        output_file_path_for(
+            input_file_path, output_dir, output_compression, RowRange(part_index, num_parts, 0, 0)
+        )
+        for part_index in range(num_parts)
+    ]
+    if not all(os.path.isfile(part_file_path) for part_file_path in part_file_paths):
+        return False
+
+    output_file_path = output_file_path_for(input_file_path, output_dir, output_compression)
+    merging_file_path = f"{partial_output_file_path_for(output_file_path)}.{uuid.uuid4().hex}"
+    try:
+        with open(merging_file_path, "wb") as merged:
+            for part_file_path in part_file_paths:
+                with open(part_file_path, "rb") as part:
+                    shutil.copyfileobj(part, merged)
+    except FileNotFoundError:
+        # Another worker merged and removed the parts first
+        os.remove(merging_file_path)
+        return False
+
+    os.replace(merging_file_path, output_file_path)
+    for part_file_path in part_file_paths:
+        try:
+            os.remove(part_file_path)
+        except FileNotFoundError:
+            pass
+    return True
+
 
 def determine_remaining_files_to_process(input_dir: str, output_dir: str) -> List[str]:
-    input_dir_files = [path for path in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, path)) and path.endswith(".jsonl")]
+    input_dir_files = [
+        path
+        for path in os.listdir(input_dir)
+        if os.path.isfile(os.path.join(input_dir, path)) and is_jsonl_file(path)
+    ]
+    # Outputs are matched on their uncompressed name, so e.g. `x.jsonl.zst` in and `x.jsonl` out are the same unit
     output_dir_files = set(
-        [path for path in os.listdir(output_dir) if os.path.isfile(os.path.join(output_dir, path)) and path.endswith(".jsonl")]
+        [
+            strip_compression_suffix(path)
+            for path in os.listdir(output_dir)
+            if os.path.isfile(os.path.join(output_dir, path)) and is_jsonl_file(path)
+        ]
     )
 
     return [
         os.path.join(input_dir, input_file)
         for input_file in input_dir_files
-        if input_file not in output_dir_files
+        if strip_compression_suffix(input_file) not in output_dir_files
     ]
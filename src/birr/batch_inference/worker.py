@@ -1,167 +1,619 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from itertools import islice
 import logging
+import os
 import time
-from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import uuid
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
+import numpy as np
 import ray
 
+from birr.batch_inference.batch_size_controller import BatchSizeController
+from birr.batch_inference.checkpoint import RowCheckpoint
 from birr.batch_inference.data_models import (
+    CompletedBatch,
     CompletedItem,
+    InputRow,
     Message,
+    PreparedBatch,
     RawInputItem,
-    PreparedInputItem,
+    RowRange,
+)
+from birr.batch_inference.json_codec import OutputRow, decode_input_row, encode_output_row, has_orjson
+from birr.batch_inference.metrics import increment, observe_latency, set_gauge
+from birr.batch_inference.result_cache import (
+    ResultCache,
+    completed_item_from_json,
+    prompt_cache_keys,
+    result_cache_namespace,
 )
 from birr.batch_inference.settings import Settings
+from birr.batch_inference.tracing import span
 from birr.batch_inference.utils import (
-    flatten,
+    deduplicate_prompts,
+    discard_pending,
     flatten_and_sort,
-    load_instances_from_local_file,
+    iter_instances_from_local_file,
+    iter_lines_from_local_file,
+    merge_row_range_outputs,
+    merged_chunks,
+    output_file_path_for,
     prediction_batches,
     simple_chunks,
+    stream_unordered,
+    stream_when_free,
+    token_budget_batches,
     write_predictions_to_local_file,
 )
 from birr.batch_inference.serializer import default_serializer
 
-
 logger = logging.getLogger(__name__)
 
+# An input row, as a dict, or as an `InputRow` with `PipelineConfig.fast_json`
+Instance = Union[Dict[str, Any], InputRow]
+
+
+class LeaseLostError(Exception):
+    """The queue handed the message being processed to another worker, so this one must not write its output."""
+
+
+@dataclass
+class PreparedMessage:
+    """A message whose rows have been loaded, tokenized and sorted, and are ready to be predicted."""
+
+    message: Message
+    enumerated_raw_instances: List[Tuple[int, Instance]]
+    prepared_instances: PreparedBatch
+    checkpoint: Optional[RowCheckpoint] = None
+
 
 class Worker:
-    def __init__(self, settings: Settings, queue, tokenizers, predictors) -> None:
+    def __init__(self, settings: Settings, queue, tokenizers, predictors, prefetch_tokenizers=None) -> None:
         self._settings = settings
         self._queue = queue
         self._tokenizers = tokenizers
         self._predictors = predictors
+        # A second pool over the same tokenizer actors, since an `ActorPool` can't be shared between threads
+        self._prefetch_tokenizers = prefetch_tokenizers
         self._serializer = default_serializer
 
+        if settings.pipeline_config.fast_json and not has_orjson():
+            logger.warning("`fast_json` is set but orjson isn't installed, decoding with the standard library")
+
+        if settings.pipeline_config.prefetch_depth and prefetch_tokenizers is None:
+            raise ValueError(
+                "A `prefetch_tokenizers` pool is required when `PipelineConfig.prefetch_depth` is set"
+            )
+
+        self._result_cache: Optional[ResultCache] = None
+        if settings.pipeline_config.result_cache_path:
+            namespace = result_cache_namespace(settings.llm_model_config, settings.generate_config)
+            self._result_cache = ResultCache(settings.pipeline_config.result_cache_path, namespace)
+
+        self._batch_size_controller: Optional[BatchSizeController] = None
+        if settings.pipeline_config.adaptive_batch_size_bounds:
+            assert settings.pipeline_config.generation_batch_size is not None
+            self._batch_size_controller = BatchSizeController(
+                settings.pipeline_config.generation_batch_size,
+                *settings.pipeline_config.adaptive_batch_size_bounds,
+                sequences_per_prompt=settings.generate_config.sequences_per_prompt,
+            )
+
         self._messages_processed = 0
+        self._batches_in_flight = 0
+        self._metric_tags = {"worker": uuid.uuid4().hex[:8]}
         self._current_message_start: Optional[float] = None
         self._current_message: Optional[Message] = None
-
-    def _load_instances_from_file(self, file_path: str) -> List[Dict[str, Any]]:
-        instances = load_instances_from_local_file(file_path)
+        self._lease_extended_at: Optional[float] = None
+        self._num_messages_fetched = 0
+        self._out_of_messages = False
+        # Messages leased ahead of the current one, and their preparation, with `prefetch_depth`
+        self._prefetched: Deque[Tuple[Message, "Future[PreparedMessage]"]] = deque()
+
+    def _iter_instances_from_file(
+        self, file_path: str, row_range: Optional[RowRange] = None
+    ) -> Iterator[Instance]:
+        instances: Iterator[Instance]
+        if self._settings.pipeline_config.fast_json:
+            instances = (decode_input_row(line) for line in iter_lines_from_local_file(file_path, row_range))
+        else:
+            instances = iter_instances_from_local_file(file_path, row_range)
 
         if self._settings.dummy_mode:
             logger.info("Running in dummy mode, slicing to only 100 instances")
-            instances = instances[:100]
+            instances = islice(instances, 100)
 
         if self._settings.pipeline_config.max_instances_per_message:
-            instances = instances[: self._settings.pipeline_config.max_instances_per_message]
+            instances = islice(instances, self._settings.pipeline_config.max_instances_per_message)
 
         return instances
 
-    def _write_predictions_to_file(self, predictions: List[Dict[str, Any]], input_file_path: str) -> None:
+    def _write_predictions_to_file(self, predictions: List[OutputRow], message: Message) -> None:
         if self._settings.dummy_mode:
             logger.info("Running in dummy mode, not writing")
         else:
-            write_predictions_to_local_file(
-                predictions, input_file_path, self._settings.pipeline_config.output_file_dir
-            )
+            pipeline_config = self._settings.pipeline_config
+            started = time.perf_counter()
+            with span("write", "worker", num_rows=len(predictions)):
+                write_predictions_to_local_file(
+                    predictions,
+                    message.object_key,
+                    pipeline_config.output_file_dir,
+                    output_compression=pipeline_config.output_compression,
+                    compression_level=pipeline_config.compression_level,
+                    compression_threads=pipeline_config.compression_threads,
+                    row_range=message.row_range,
+                )
+            observe_latency("write", time.perf_counter() - started)
+
+    def _uses_checkpoint(self) -> bool:
+        pipeline_config = self._settings.pipeline_config
+        return not self._settings.dummy_mode and bool(
+            pipeline_config.streaming_window_size or pipeline_config.checkpoint_interval
+        )
+
+    def _output_file_path(self, message: Message) -> str:
+        pipeline_config = self._settings.pipeline_config
+        return output_file_path_for(
+            message.object_key,
+            pipeline_config.output_file_dir,
+            pipeline_config.output_compression,
+            message.row_range,
+        )
+
+    def _open_checkpoint(self, message: Message) -> RowCheckpoint:
+        pipeline_config = self._settings.pipeline_config
+        return RowCheckpoint(
+            self._output_file_path(message),
+            resume=bool(pipeline_config.checkpoint_interval),
+            compression_level=pipeline_config.compression_level,
+            compression_threads=pipeline_config.compression_threads,
+        )
 
     def _prepare_inputs_and_sort(
-        self, enumerated_raw_instances: List[Tuple[int, Dict[str, Any]]]
-    ) -> List[PreparedInputItem]:
+        self, enumerated_raw_instances: List[Tuple[int, Instance]], tokenizers=None
+    ) -> PreparedBatch:
         def text_iter(enumerated_instances):
             for index, instance in enumerated_instances:
-                if "text" in instance:
+                if isinstance(instance, InputRow):
+                    yield RawInputItem(index=index, messages=instance.messages)
+                elif "text" in instance:
                     yield RawInputItem.from_text(index, instance["text"])
                 else:
                     yield RawInputItem.from_message_dicts(index, instance["chat_messages"])
 
+        tokenizers = tokenizers or self._tokenizers
         chunked_pumps = simple_chunks(
             text_iter(enumerated_raw_instances), self._settings.pipeline_config.tokenization_batch_size
         )
-        prepared = flatten_and_sort(
-            self._tokenizers.map_unordered(lambda toker, batch: toker.prepare_inputs.remote(batch), chunked_pumps)
-        )
-
+        with span("tokenize_and_sort", "worker", num_rows=len(enumerated_raw_instances)):
+            prepared = flatten_and_sort(
+                tokenizers.map_unordered(lambda toker, batch: toker.prepare_inputs.remote(batch), chunked_pumps),
+                prefix_bucket_size=self._settings.pipeline_config.prefix_sort_bucket_size,
+            )
 
         return prepared
 
-    def _predict(self, sorted_instances: List[PreparedInputItem]) -> Iterator[CompletedItem]:
-        generation_batch_size = self._settings.pipeline_config.generation_batch_size
-
-        if isinstance(generation_batch_size, int):
-            chunked_tokes = simple_chunks(sorted_instances, generation_batch_size)
-        else:
-            chunked_tokes = prediction_batches(sorted_instances, generation_batch_size)
+    @staticmethod
+    def _of_rows(batches: Iterable[CompletedBatch], indices: Set[int], stage: str) -> Iterator[CompletedBatch]:
+        """Drops batches with rows other than `indices`, which can only be results of another message."""
+        for batch in batches:
+            if indices.issuperset(batch.indices.tolist()):
+                yield batch
+            else:
+                logger.warning(f"Dropping {stage} results of {len(batch)} rows that aren't of the current message")
+
+    def _predict(self, sorted_instances: PreparedBatch) -> Iterator[CompletedBatch]:
+        if self._result_cache is None:
+            yield from self._dispatch_to_predictors(sorted_instances)
+            return
+
+        keys = prompt_cache_keys(self._result_cache.namespace, sorted_instances)
+        cached = self._result_cache.get_many(keys)
+        logger.info(f"Found {len(cached)} of {len(sorted_instances)} rows in the result cache")
+
+        indices = sorted_instances.indices.tolist()
+        cached_items = [
+            completed_item_from_json(index, cached[key]) for index, key in zip(indices, keys) if key in cached
+        ]
+        for chunk in simple_chunks(cached_items, self._settings.pipeline_config.decoding_batch_size):
+            yield CompletedBatch.from_items(chunk)
 
-        predictions = flatten(
-            self._predictors.map_unordered(lambda pred, batch: pred.predict.remote(batch), chunked_tokes)
+        miss_positions = np.asarray(
+            [position for position, key in enumerate(keys) if key not in cached], dtype=np.int64
         )
+        if not len(miss_positions):
+            return
 
-        for prediction in predictions:
+        key_by_index = dict(zip(indices, keys))
+        for prediction in self._dispatch_to_predictors(sorted_instances.take(miss_positions)):
+            self._result_cache.put_many([(key_by_index[item.index], item) for item in prediction.to_items()])
+            yield prediction
+
+    def _dispatch_to_predictors(self, sorted_instances: PreparedBatch) -> Iterator[CompletedBatch]:
+        pipeline_config = self._settings.pipeline_config
+        generation_batch_size = pipeline_config.generation_batch_size
+        sequences_per_prompt = self._settings.generate_config.sequences_per_prompt
+
+        chunked_tokes: Iterable[PreparedBatch]
+        if self._batch_size_controller is not None:
+            chunked_tokes = self._batch_size_controller.batches(sorted_instances)
+        elif pipeline_config.generation_token_budget:
+            chunked_tokes = token_budget_batches(
+                sorted_instances,
+                pipeline_config.generation_token_budget,
+                max_tokens=self._settings.generate_config.max_tokens,
+                cost_model=pipeline_config.token_budget_cost_model,
+                sequences_per_prompt=sequences_per_prompt,
+            )
+        elif isinstance(generation_batch_size, int):
+            chunked_tokes = simple_chunks(sorted_instances, max(1, generation_batch_size // sequences_per_prompt))
+        else:
+            assert generation_batch_size is not None
+            chunked_tokes = prediction_batches(sorted_instances, generation_batch_size, sequences_per_prompt)
+
+        def predict(pred: Any, batch: PreparedBatch) -> Any:
+            # Called once a predictor is free to work on the batch, rather than when it is queued
+            self._batches_in_flight += 1
+            set_gauge("birr_batches_in_flight", self._batches_in_flight, tags=self._metric_tags)
+            return pred.predict.remote(batch)
+
+        # Batches are cut one at a time as predictors free up, so each uses the latest adaptive sizes
+        predictions = stream_when_free(self._predictors, predict, chunked_tokes)
+
+        for prediction in self._of_rows(predictions, set(sorted_instances.indices.tolist()), "prediction"):
+            self._batches_in_flight -= 1
+            set_gauge("birr_batches_in_flight", self._batches_in_flight, tags=self._metric_tags)
+            if self._batch_size_controller is not None and prediction.stats is not None:
+                self._batch_size_controller.record(prediction.stats)
             yield prediction
 
-    def _decode(self, predictions: Iterable[CompletedItem]) -> Iterator[CompletedItem]:
-        chunked_preds = simple_chunks(predictions, self._settings.pipeline_config.decoding_batch_size)
-        decoded = flatten(
-            self._tokenizers.map_unordered(lambda toker, batch: toker.decode.remote(batch), chunked_preds)
+    def _decode(self, predictions: Iterable[CompletedBatch], indices: Set[int]) -> Iterator[CompletedItem]:
+        chunked_preds = merged_chunks(predictions, self._settings.pipeline_config.decoding_batch_size)
+        # Streamed so that decoded rows become available while later batches are still being predicted
+        decoded = stream_unordered(
+            self._tokenizers, lambda toker, batch: toker.decode.remote(batch), chunked_preds
         )
 
-        for item in decoded:
-            yield item
+        for batch in self._of_rows(decoded, indices, "decoding"):
+            # Rows are only materialized as objects here, right before they are serialized
+            for item in batch.to_items():
+                yield item
+
+    def _deduplicates_prompts(self) -> bool:
+        deduplicate_prompts = self._settings.pipeline_config.deduplicate_prompts
+        if deduplicate_prompts == "greedy":
+            return self._settings.generate_config.temperature == 0
+        return deduplicate_prompts == "always"
+
+    def _predict_and_decode(self, sorted_instances: PreparedBatch) -> Iterator[CompletedItem]:
+        if not self._deduplicates_prompts():
+            yield from self._decode(self._predict(sorted_instances), set(sorted_instances.indices.tolist()))
+            return
+
+        unique_instances, duplicate_indices = deduplicate_prompts(sorted_instances)
+        num_duplicates = len(sorted_instances) - len(unique_instances)
+        if sorted_instances:
+            logger.info(
+                f"Deduplicated {num_duplicates} of {len(sorted_instances)} rows "
+                f"({num_duplicates / len(sorted_instances):.1%} fewer prompts to predict)"
+            )
 
-    def _process_message(self, message: Message) -> None:
-        enumerated_raw_instances = [
-            (index, raw_instance)
-            for index, raw_instance in enumerate(self._load_instances_from_file(message.object_key))
-        ]
+        for prediction in self._decode(self._predict(unique_instances), set(unique_instances.indices.tolist())):
+            yield prediction
+            for duplicate_index in duplicate_indices.get(prediction.index, []):
+                yield replace(prediction, index=duplicate_index)
 
+    def _process_instances(self, enumerated_raw_instances: List[Tuple[int, Instance]]) -> Iterator[CompletedItem]:
         prepared_and_sorted_instances = self._prepare_inputs_and_sort(enumerated_raw_instances)
-        predictions = self._predict(prepared_and_sorted_instances)
-        decoded_predictions = self._decode(predictions)
-
+        return self._predict_and_decode(prepared_and_sorted_instances)
+
+    def _serialize(self, instance: Instance, prediction: CompletedItem) -> OutputRow:
+        if isinstance(instance, InputRow):
+            return encode_output_row(instance, prediction.outputs, prediction.error)
+        return self._serializer(instance, prediction.outputs, prediction.error)
+
+    def _serialize_in_input_order(
+        self,
+        enumerated_raw_instances: List[Tuple[int, Instance]],
+        decoded_predictions: Iterable[CompletedItem],
+    ) -> List[Tuple[int, OutputRow]]:
         decoded_map = {prediction.index: prediction for prediction in decoded_predictions}
 
         results = []
         for index, instance in enumerated_raw_instances:
             if index in decoded_map:
-                results.append(self._serializer(instance, decoded_map[index].outputs, decoded_map[index].error))
+                results.append((index, self._serialize(instance, decoded_map[index])))
 
-        self._write_predictions_to_file(
-            results,
-            message.object_key,
+        return results
+
+    def _process_message_in_windows(self, message: Message) -> None:
+        """
+        Reads, predicts and checkpoints a file one window of rows at a time, adding each window's
+        results in input order and flushing them as soon as the window finishes.
+        """
+        pipeline_config = self._settings.pipeline_config
+        assert pipeline_config.streaming_window_size
+        checkpoint = self._open_checkpoint(message)
+        completed_indices = checkpoint.completed_indices
+
+        remaining_enumerated_raw_instances = (
+            (index, raw_instance)
+            for index, raw_instance in enumerate(
+                self._iter_instances_from_file(message.object_key, message.row_range)
+            )
+            if index not in completed_indices
         )
 
-    def run(self) -> None:
-        while True:
-            if (
-                self._settings.pipeline_config.max_num_messages_per_worker
-                and self._messages_processed == self._settings.pipeline_config.max_num_messages_per_worker
-            ):
-                logger.info(
-                    f"Worker finished processing {self._settings.pipeline_config.max_num_messages_per_worker} messages. Terminating..."
+        windows = simple_chunks(remaining_enumerated_raw_instances, pipeline_config.streaming_window_size)
+        for window_index, window in enumerate(windows):
+            with span("window", "worker", window_index=window_index, num_rows=len(window)):
+                results = self._serialize_in_input_order(
+                    window, self._keeping_lease(message, self._process_instances(window))
+                )
+            self._keep_lease(message, force=True)
+            with span("write", "worker", num_rows=len(results)):
+                for index, result in results:
+                    checkpoint.add(index, result)
+                checkpoint.flush()
+            increment("birr_rows_processed", len(results))
+            logger.info(f"Finished window {window_index} ({len(window)} rows) of message: {message}")
+
+        self._keep_lease(message, force=True)
+        checkpoint.promote()
+
+    def _prepare_message(self, message: Message, tokenizers=None) -> PreparedMessage:
+        """Loads a whole file's (remaining) rows, then tokenizes and sorts them."""
+        checkpoint = self._open_checkpoint(message) if self._uses_checkpoint() else None
+        completed_indices = checkpoint.completed_indices if checkpoint else set()
+
+        with span("load", "worker", object_key=message.object_key) as span_args:
+            enumerated_raw_instances = [
+                (index, raw_instance)
+                for index, raw_instance in enumerate(
+                    self._iter_instances_from_file(message.object_key, message.row_range)
                 )
-                return
-
-            try:
-                message = ray.get(self._queue.get_message.remote())
-                self._current_message = message
-            except ray.exceptions.ActorDiedError:
-                logger.exception("Queue Actor died")
-                ray.actor.exit_actor()
-            except Exception:
-                logger.exception("Failure when fetching messages")
-
-            if not message:
+                if index not in completed_indices
+            ]
+            span_args.update(num_rows=len(enumerated_raw_instances))
+
+        return PreparedMessage(
+            message=message,
+            enumerated_raw_instances=enumerated_raw_instances,
+            prepared_instances=self._prepare_inputs_and_sort(enumerated_raw_instances, tokenizers),
+            checkpoint=checkpoint,
+        )
+
+    def _complete_message(self, prepared_message: PreparedMessage) -> None:
+        """
+        Predicts and decodes a prepared message and writes its results.
+
+        With a checkpoint, rows are added as they are decoded and flushed every `checkpoint_interval`
+        rows, and get put back into input order when the partial output is promoted.
+        """
+        message = prepared_message.message
+        decoded = self._keeping_lease(message, self._predict_and_decode(prepared_message.prepared_instances))
+        checkpoint = prepared_message.checkpoint
+
+        if checkpoint is None:
+            with span("predict_and_decode", "worker", num_rows=len(prepared_message.enumerated_raw_instances)):
+                results = self._serialize_in_input_order(prepared_message.enumerated_raw_instances, decoded)
+            self._keep_lease(message, force=True)
+            self._write_predictions_to_file([result for _, result in results], message)
+            increment("birr_rows_processed", len(results))
+            return
+
+        raw_instances_by_index = dict(prepared_message.enumerated_raw_instances)
+        for prediction in decoded:
+            result = self._serialize(raw_instances_by_index[prediction.index], prediction)
+            checkpoint.add(prediction.index, result)
+            increment("birr_rows_processed")
+            if checkpoint.num_pending >= (self._settings.pipeline_config.checkpoint_interval or 1):
+                self._keep_lease(message, force=True)
+                with span("write", "worker", num_rows=checkpoint.num_pending):
+                    checkpoint.flush()
+
+        self._keep_lease(message, force=True)
+        checkpoint.promote()
+
+    def _process_message(self, message: Message) -> None:
+        if self._uses_checkpoint() and self._settings.pipeline_config.streaming_window_size:
+            self._process_message_in_windows(message)
+        else:
+            self._complete_message(self._prepare_message(message))
+
+    def _merge_row_ranges(self, message: Message) -> bool:
+        """Merges the parts of the message's file once all are complete, and returns whether it did."""
+        assert message.row_range
+        if self._settings.dummy_mode:
+            return False
+
+        pipeline_config = self._settings.pipeline_config
+        with span("merge", "worker", object_key=message.object_key):
+            merged = merge_row_range_outputs(
+                message.object_key,
+                pipeline_config.output_file_dir,
+                message.row_range.num_parts,
+                pipeline_config.output_compression,
+            )
+        if merged:
+            logger.info(f"Merged {message.row_range.num_parts} parts into the output of {message.object_key}")
+        return merged
+
+    def _keep_lease(self, message: Message, force: bool = False) -> None:
+        """
+        Extends the leases on the message being processed and those prefetched after it, unless forced
+        at most every third of the visibility timeout, and raises `LeaseLostError` if the queue handed
+        the message being processed to another worker meanwhile.
+        """
+        now = time.monotonic()
+        renewal_interval = self._settings.pipeline_config.queue_visibility_timeout / 3
+        if not force and self._lease_extended_at is not None and now - self._lease_extended_at < renewal_interval:
+            return
+
+        if not ray.get(self._queue.extend_lease.remote(message)):
+            raise LeaseLostError(message.message_id)
+
+        # Prefetched messages would otherwise be handed out again while they wait their turn
+        prefetched_messages = [prefetched_message for prefetched_message, _ in self._prefetched]
+        leases_kept = ray.get([self._queue.extend_lease.remote(m) for m in prefetched_messages])
+        for prefetched_message, lease_kept in zip(prefetched_messages, leases_kept):
+            if not lease_kept:
+                logger.warning(f"Lost the lease on a prefetched message: {prefetched_message}")
+        self._lease_extended_at = now
+
+    def _keeping_lease(self, message: Message, predictions: Iterable[CompletedItem]) -> Iterator[CompletedItem]:
+        for prediction in predictions:
+            self._keep_lease(message)
+            yield prediction
+
+    def _discard_pending_results(self) -> None:
+        # Batches an abandoned message left on the actors would otherwise come back as the next message's
+        for pool in [self._tokenizers, self._predictors]:
+            if num_discarded := discard_pending(pool):
+                logger.info(f"Discarded {num_discarded} pending results of the abandoned message")
+        self._batches_in_flight = 0
+        set_gauge("birr_batches_in_flight", self._batches_in_flight, tags=self._metric_tags)
+
+    def _release_message(self, message: Message) -> None:
+        try:
+            ray.get(self._queue.release_message.remote(message))
+        except Exception:
+            logger.exception(f"Failure when releasing message: {message}")
+
+    def _fetch_messages(self, n: int) -> List[Message]:
+        try:
+            return ray.get(self._queue.get_messages.remote(n))
+        except ray.exceptions.ActorDiedError:
+            logger.exception("Queue Actor died")
+            ray.actor.exit_actor()
+        except Exception:
+            logger.exception("Failure when fetching messages")
+
+        return []
+
+    def _is_queue_drained(self) -> bool:
+        try:
+            return ray.get(self._queue.is_drained.remote())
+        except ray.exceptions.ActorDiedError:
+            logger.exception("Queue Actor died")
+            ray.actor.exit_actor()
+        except Exception:
+            logger.exception("Failure when checking whether the queue is drained")
+
+        return True
+
+    def _next_messages(self, n: int, wait: bool = True) -> List[Message]:
+        """
+        Fetches up to `n` messages. When none is available yet, but other workers hold leases on messages
+        that may be handed out again, waits for one if `wait` is set. Returns none once out of messages.
+        """
+        pipeline_config = self._settings.pipeline_config
+        max_num_messages = pipeline_config.max_num_messages_per_worker
+
+        while not self._out_of_messages:
+            if max_num_messages and self._num_messages_fetched >= max_num_messages:
+                logger.info(f"Worker finished processing {max_num_messages} messages. Terminating...")
+                self._out_of_messages = True
+                break
+
+            if max_num_messages:
+                n = min(n, max_num_messages - self._num_messages_fetched)
+            messages = self._fetch_messages(n)
+            if messages:
+                self._num_messages_fetched += len(messages)
+                return messages
+
+            if self._is_queue_drained():
                 logger.info("Out of messages, terminating...")
-                return
-
-            start = time.monotonic()
-            self._current_message_start = start
-
-            try:
-                logger.info(f"Processing message: {message}")
-                self._process_message(message)
-                ray.get(self._queue.delete_message.remote(message))
-                logger.info(f"Finished processing message: {message}")
-
-            except ray.exceptions.ActorDiedError:
-                logger.exception(f"An actor the worker requires has died while processing: {message}")
-                ray.actor.exit_actor()
-            except Exception:
-                logger.exception(f"Error processing message: {message}")
-            finally:
-                self._current_message_start = None
-                self._current_message = None
-                self._messages_processed += 1
+                self._out_of_messages = True
+            elif not wait:
+                break
+            else:
+                logger.info(f"No messages available yet, asking again in {pipeline_config.queue_poll_interval}s")
+                time.sleep(pipeline_config.queue_poll_interval)
+
+        return []
+
+    def _iter_messages(self) -> Iterator[Message]:
+        while messages := self._next_messages(1):
+            yield from messages
+
+    def _seconds_on_current_message(self) -> float:
+        assert self._current_message_start is not None
+        return time.monotonic() - self._current_message_start
+
+    def _handle_message(self, message: Message, process: Callable[[], None]) -> None:
+        self._current_message = message
+        self._current_message_start = time.monotonic()
+        self._lease_extended_at = None
+
+        try:
+            logger.info(f"Processing message: {message}")
+            # A prefetched message may have waited long enough for its lease to be handed out again
+            self._keep_lease(message, force=True)
+            with span("message", "worker", object_key=message.object_key):
+                if message.row_range and os.path.isfile(self._output_file_path(message)):
+                    logger.info(f"Part of file already completed: {message}")
+                else:
+                    process()
+            # A split file only counts once, when its last part completes and the parts are merged
+            if not message.row_range or self._merge_row_ranges(message):
+                increment("birr_files_processed")
+            ray.get(self._queue.delete_message.remote(message))
+            logger.info(f"Finished processing message in {self._seconds_on_current_message():.1f}s: {message}")
+
+        except ray.exceptions.ActorDiedError:
+            logger.exception(f"An actor the worker requires has died while processing: {message}")
+            ray.actor.exit_actor()
+        except LeaseLostError:
+            logger.warning(f"Lost the lease, leaving the message to the worker it was handed to: {message}")
+            self._discard_pending_results()
+        except Exception:
+            logger.exception(
+                f"Error processing message after {self._seconds_on_current_message():.1f}s: {message}"
+            )
+            self._discard_pending_results()
+            # Handed out again right away, rather than once its lease expires
+            self._release_message(message)
+        finally:
+            self._current_message_start = None
+            self._current_message = None
+            self._messages_processed += 1
+
+    def _run_with_prefetch(self) -> None:
+        """
+        Prepares up to `prefetch_depth` upcoming messages on a background thread while the current
+        one is being predicted, so predictors don't sit idle at file boundaries.
+        """
+        prefetch_depth = self._settings.pipeline_config.prefetch_depth
+        # A single thread, so that only one message at a time uses the prefetch tokenizer pool
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch") as executor:
+            pending = self._prefetched
+
+            def top_up(wait: bool) -> None:
+                if len(pending) < prefetch_depth:
+                    for message in self._next_messages(prefetch_depth - len(pending), wait=wait):
+                        pending.append(
+                            (message, executor.submit(self._prepare_message, message, self._prefetch_tokenizers))
+                        )
+
+            top_up(wait=True)
+            while pending:
+                message, prepared_message = pending.popleft()
+                top_up(wait=False)
+                self._handle_message(message, lambda: self._complete_message(prepared_message.result()))
+                if not pending:
+                    # Only waits for messages leased by other workers once there's nothing else to do
+                    top_up(wait=True)
+
+    def run(self) -> None:
+        if self._settings.pipeline_config.prefetch_depth:
+            self._run_with_prefetch()
+            return
+
+        for message in self._iter_messages():
+            self._handle_message(message, lambda: self._process_message(message))
@@ -1,4 +1,4 @@
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Dict, List, Literal, Optional, Tuple, Union
 
 from jsonschema.protocols import Validator as JSONSchemaValidator
 from pydantic import BaseModel, ConfigDict, Field, model_validator
@@ -18,6 +18,16 @@ class LLMModelConfig(BaseModel):
         default=False, description="Whether to trust python code packaged with model files."
     )
     vlm: bool = Field(default=False, description="Whether this is a vision-language model or not.")
+    max_image_size: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="For vision-language models, optionally downscale images whose longer side exceeds this many pixels. Done in the tokenizer, before images are handed to predictors.",
+    )
+    image_cache_size: int = Field(
+        default=256,
+        ge=0,
+        description="For vision-language models, how many processed images each tokenizer keeps, keyed by a hash of their data, so images repeated across rows are decoded and downscaled once. Set to 0 to disable.",
+    )
     tensor_parallel_size: Optional[int] = Field(
         default=None,
         description="For big models, how many GPUs to split them between. Mutually exclusive with `PipelineConfig.predictors_per_gpu`.",
@@ -26,6 +36,10 @@ class LLMModelConfig(BaseModel):
         default=None, description="Optionally override the model's configured model length."
     )
     fast_tokenizer: bool = Field(default=True, description="Whether to use the fast tokenizer for the model.")
+    template_fast_path: bool = Field(
+        default=False,
+        description="Whether to tokenize the chat template's constant prefix and suffix once, and only tokenize each row's content, for rows that are a single user message. Checked against full tokenization on a sample at startup, and not used if they differ.",
+    )
     gpu_memory_utilization: float = Field(
         default=0.9,
         description="Determines how much vram the model is allowed to use, includings its allocated KV cache.",
@@ -34,6 +48,10 @@ class LLMModelConfig(BaseModel):
         default=8,
         description="Minimizes CPU-bound overhead within vLLM. Set to 1 to opt out (some compatibility issues in some cases with >1).",
     )
+    enable_prefix_caching: bool = Field(
+        default=False,
+        description="Whether vLLM should cache and reuse the KV cache of prompt prefixes shared between rows, e.g. a common system message or instruction prefix.",
+    )
 
 
 class FormatConfig(BaseModel):
@@ -83,6 +101,16 @@ class GenerateConfig(BaseModel):
     temperature: float = Field(default=0.2, description="The temperature to use for generation")
     top_k: int = Field(default=50, description="The top k to use for generation")
     top_p: float = Field(default=1.0, description="The top p to use for generation")
+    n: int = Field(
+        default=1,
+        ge=1,
+        description="How many completions to generate per prompt. The samples share the prompt's prefill, which is much cheaper than repeating rows.",
+    )
+    best_of: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="Optionally generate this many completions per prompt and return the `n` with the highest log probability. Must be at least `n`.",
+    )
     drop_long_contexts: bool = Field(
         default=False,
         description="If true, will discard any rows that had too many tokens for the model max context length",
@@ -117,6 +145,18 @@ class GenerateConfig(BaseModel):
 
         return self
 
+    @model_validator(mode="after")
+    def validate_best_of_at_least_n(self) -> "GenerateConfig":
+        if self.best_of is not None and self.best_of < self.n:
+            raise ValueError("`best_of` must be at least `n`")
+
+        return self
+
+    @property
+    def sequences_per_prompt(self) -> int:
+        """How many sequences are decoded for each prompt."""
+        return self.best_of or self.n
+
 
 class PipelineConfig(BaseModel):
     """Configuration for pipeline parameters."""
@@ -151,12 +191,139 @@ class PipelineConfig(BaseModel):
     tokenization_batch_size: int = Field(
         default=3000, ge=1, description="How many documents to tokenize at a time."
     )
-    generation_batch_size: Union[int, List[Tuple[int, int]]] = Field(
-        description="How many prompts to pass for inference at a time. Either a flat number, or a list of numbers bracketed by max sequence length."
+    generation_batch_size: Union[int, List[Tuple[int, int]], None] = Field(
+        default=None,
+        description="How many prompts to pass for inference at a time. Either a flat number, or a list of numbers bracketed by max sequence length. Divided by `GenerateConfig.n` (or `best_of`) when sampling several completions per prompt. Mutually exclusive with `generation_token_budget`.",
+    )
+    generation_token_budget: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="If set, prompts are batched for inference by an estimated total token cost instead of a row count, so each batch fills the KV cache about equally regardless of prompt length. Mutually exclusive with `generation_batch_size`.",
+    )
+    token_budget_cost_model: Literal["reserved", "padded"] = Field(
+        default="reserved",
+        description="How a batch's cost is estimated against `generation_token_budget`. `reserved` sums each row's prompt tokens plus the `GenerateConfig.max_tokens` reserved for its output (or the longest prompt in the batch if unset); `padded` is the longest prompt times the number of rows.",
+    )
+    prefix_sort_bucket_size: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="If set, rows are sorted by length in buckets of this many tokens, and by token ids within each bucket, so rows sharing a prompt prefix are batched together. Pairs well with `LLMModelConfig.enable_prefix_caching`.",
+    )
+    tokenization_cache_dir: Optional[str] = Field(
+        default=None,
+        description="If set, tokenizers cache prompt token ids on disk in this directory, keyed by a hash of the tokenizer, chat template, format config and messages, so reruns over the same inputs skip tokenization. Can be shared by all tokenizers on a node.",
+    )
+    result_cache_path: Optional[str] = Field(
+        default=None,
+        description="If set, completions are stored in a SQLite database at this path, keyed by a hash of the model, `GenerateConfig` and prompt, and reused by later runs, so only rows with new prompts are predicted. Can be shared by all workers on a node.",
+    )
+    adaptive_batch_size_bounds: Optional[Tuple[int, int]] = Field(
+        default=None,
+        description="If set, as (min, max), each length bracket's `generation_batch_size` is only a starting point, and is adjusted within these bounds while the job runs: shrunk when vLLM preempts sequences, grown while throughput keeps improving. Can't be combined with `continuous_batching_slots`.",
+    )
+    continuous_batching_slots: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="If set, predictors run on vLLM's async engine and each accepts this many generation batches at once, so new prompts are scheduled as soon as sequences finish instead of the GPU draining at the end of every batch. Works best with small `generation_batch_size`s or `generation_token_budget`s, and bounds the sequences in flight per predictor to about this many batches.",
     )
     decoding_batch_size: int = Field(
         default=3000, ge=1, description="How many documents to decode into from tokens into text at a time."
     )
+    deduplicate_prompts: Literal["greedy", "always", "never"] = Field(
+        default="greedy",
+        description='Whether rows of a file with identical prompts (token ids and images) are predicted once, and the completion copied to the duplicates. "greedy" only does so when `GenerateConfig.temperature` is 0, where duplicates would get the same completion anyway.',
+    )
+    rows_per_message: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="If set, uncompressed input files with more lines than this are split into messages of this many lines each, found with a newline scan when the queue starts, so several workers share a large file instead of one worker being pinned to it. Each part is written to its own file, and the worker completing the last part concatenates them into the file's output, in order. Compressed inputs can't be read from an offset and are never split.",
+    )
+    queue_path: Optional[str] = Field(
+        default=None,
+        description="If set, messages are kept in a SQLite database at this path rather than in the queue actor's memory. It is filled from `input_file_dir` when first created, and never rescanned, so a restarted job resumes with the messages not yet completed, and several runners on one machine can drain it together. Delete it to pick up new input files.",
+    )
+    queue_visibility_timeout: float = Field(
+        default=3600.0,
+        gt=0,
+        description="With `queue_path`, how many seconds a message handed to a worker stays invisible to others. Workers extend the lease as they make progress: before writing, at every checkpoint flush and streaming window, and as predictions come back, at most every third of this timeout. A message whose lease runs out, e.g. because its worker died, is handed out again, and its first worker stops without writing its output.",
+    )
+    queue_max_attempts: int = Field(
+        default=3,
+        ge=1,
+        description="With `queue_path`, how many times a message is handed out before it is considered failed and moved to the dead-letter state.",
+    )
+    queue_poll_interval: float = Field(
+        default=1.0,
+        gt=0,
+        description="With `queue_path`, how many seconds a worker with nothing to do waits before asking the queue again, while other workers still hold leases on messages that may be handed out again. Also how long a job may take to notice that the last message was completed.",
+    )
+    message_order: Literal["largest_first", "interleaved", "listed"] = Field(
+        default="largest_first",
+        description='The order messages are handed to workers in, after those interrupted part-way through. "largest_first" goes by the size of their rows in bytes, with compressed files estimated to expand by a fixed ratio, so the job doesn\'t end waiting on a large file picked last. "interleaved" alternates between the largest and the smallest remaining messages, so small files keep tokenizers busy while large ones are read. "listed" keeps the order files are listed in.',
+    )
+    streaming_window_size: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="If set, each file is read, tokenized, predicted and written in windows of this many rows, so worker memory is bounded by the window size rather than the file size. Rows are only sorted by length within a window.",
+    )
+    checkpoint_interval: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="If set, completed rows are flushed to a partial output file with a sidecar checkpoint every this many rows (or every window in streaming mode), and a file interrupted mid-way resumes with only its missing rows.",
+    )
+    output_compression: Optional[Literal["zstd", "gzip", "none"]] = Field(
+        default=None,
+        description="How to compress output files. If unset, each output is compressed the same way as its input, e.g. `x.jsonl.zst` in gives `x.jsonl.zst` out. Inputs ending in `.zst`/`.zstd`/`.gz` are always decompressed on read.",
+    )
+    compression_level: int = Field(
+        default=3, description="Compression level for compressed outputs; 1-22 for zstd, 1-9 for gzip."
+    )
+    compression_threads: int = Field(
+        default=0,
+        ge=-1,
+        description="Threads used for zstd compression. 0 compresses on the writing thread, -1 uses all cores.",
+    )
+    fast_json: bool = Field(
+        default=False,
+        description="If set, input lines are decoded with orjson (`pip install birr[fast_json]`, falling back to the standard library without it) straight into chat messages, and each output row is its input line written back verbatim with the outputs appended, rather than decoded into a dict and re-encoded. Saves worker CPU and memory on short-prompt jobs. The appended outputs are compact JSON, without spaces after separators.",
+    )
+    prefetch_depth: int = Field(
+        default=0,
+        ge=0,
+        description="How many upcoming messages each worker loads and tokenizes in the background while the current one is being predicted. Every prefetched message is held in worker memory. Not supported together with `streaming_window_size`.",
+    )
+    trace_dir: Optional[str] = Field(
+        default=None,
+        description="If set, every process appends a span per stage and batch (load, tokenize, predict, decode, write) to its own file in a subdirectory of this one for the job, and they are merged into a Chrome trace, `trace.json`, in that subdirectory when the job finishes. Open it in chrome://tracing or https://ui.perfetto.dev to find idle gaps and straggling predictors. Must be on a filesystem shared by all nodes.",
+    )
+
+    @model_validator(mode="after")
+    def validate_exactly_one_generation_batching(self) -> "PipelineConfig":
+        if (self.generation_batch_size is None) == (self.generation_token_budget is None):
+            raise ValueError("Exactly one of `generation_batch_size` and `generation_token_budget` must be set")
+
+        return self
+
+    @model_validator(mode="after")
+    def validate_adaptive_batch_size_bounds(self) -> "PipelineConfig":
+        if self.adaptive_batch_size_bounds is not None:
+            min_batch_size, max_batch_size = self.adaptive_batch_size_bounds
+            if not 1 <= min_batch_size <= max_batch_size:
+                raise ValueError("`adaptive_batch_size_bounds` must be (min, max) with 1 <= min <= max")
+            if self.generation_batch_size is None:
+                raise ValueError("`adaptive_batch_size_bounds` adjusts `generation_batch_size`, which must be set")
+            # Batches overlapping on a predictor skew each other's timings and preemption counts
+            if self.continuous_batching_slots:
+                raise ValueError("Cannot set both `adaptive_batch_size_bounds` and `continuous_batching_slots`")
+
+        return self
+
+    @model_validator(mode="after")
+    def validate_prefetch_and_streaming_mutual_exclusion(self) -> "PipelineConfig":
+        if self.prefetch_depth and self.streaming_window_size:
+            raise ValueError("Cannot set both `prefetch_depth` and `streaming_window_size`")
+
+        return self
 
     @property
     def max_task_retries(self) -> int:
@@ -1,10 +1,35 @@
-from typing import Dict, List, Optional, Union
+import logging
+from typing import Dict, List, Optional, Tuple, Union
 
 from transformers import AutoTokenizer, BatchEncoding
 
 from birr.batch_inference.data_models import ChatMessage
 from birr.core.config import FormatConfig, LLMModelConfig
 
+logger = logging.getLogger(__name__)
+
+
+# Stands in for the user's content when rendering the template once to find its constant parts
+TEMPLATE_CONTENT_SENTINEL = "\u2063birr-template-content\u2063"
+
+# Contents the template fast path must tokenize identically to the full template before it is used,
+# covering the boundaries where templates trim content or tokens merge across the seams
+TEMPLATE_FAST_PATH_VERIFICATION_SAMPLE = [
+    "Hello, world!",
+    "What is 12 + 30?",
+    " leading space",
+    "trailing space ",
+    "\nleading newline",
+    "trailing newline\n",
+    "Two\n\nparagraphs",
+    ".,;:!? punctuation first",
+    "Unicode: naïve café, 数字, 🙂",
+    "",
+]
+
+# How many of the job's first rows the template fast path is also checked against
+TEMPLATE_FAST_PATH_JOB_SAMPLE_SIZE = 64
+
 
 class ModelTokenizer:
     def __init__(
@@ -25,6 +50,14 @@ class ModelTokenizer:
 
         self.new_line_symbol = str(format_config.new_line_symbol)
 
+        # Token ids of the rendered template before and after a lone user message's content
+        self._template_token_ids: Optional[Tuple[List[int], List[int]]] = None
+        # Whether the fast path was checked against rows of the job too, since a template may
+        # branch on content the fixed sample doesn't cover
+        self._template_verified_on_job = False
+        if model_config.template_fast_path:
+            self._template_token_ids = self._pretokenize_template()
+
     @property
     def model_max_length(self) -> int:
         return self.tokenizer.model_max_length
@@ -65,11 +98,84 @@ class ModelTokenizer:
         formatted_replaced = [elem.replace("\n", self.new_line_symbol) for elem in formatted]  # pyright: ignore
         return formatted_replaced
 
+    def _encode(self, texts: List[str]) -> List[List[int]]:
+        return self.tokenizer(texts, add_special_tokens=False)["input_ids"]
+
+    @staticmethod
+    def _lone_user_content(instance: Union[str, List[ChatMessage]]) -> Optional[str]:
+        if isinstance(instance, str):
+            return instance
+        if len(instance) == 1 and instance[0].role == "user" and isinstance(instance[0].content, str):
+            return instance[0].content
+        return None
+
+    def _pretokenize_template(self) -> Optional[Tuple[List[int], List[int]]]:
+        [formatted] = self.batch_format([TEMPLATE_CONTENT_SENTINEL])
+        if formatted.count(TEMPLATE_CONTENT_SENTINEL) != 1:
+            logger.warning("Chat template does not render user content verbatim, not using template fast path")
+            return None
+
+        prefix, suffix = formatted.split(TEMPLATE_CONTENT_SENTINEL)
+        prefix_ids, suffix_ids = self._encode([prefix, suffix])
+        self._template_token_ids = (prefix_ids, suffix_ids)
+
+        expected = self._encode(self.batch_format(list(TEMPLATE_FAST_PATH_VERIFICATION_SAMPLE)))
+        actual = self._encode_with_template(TEMPLATE_FAST_PATH_VERIFICATION_SAMPLE)
+        if actual != expected:
+            logger.warning("Template fast path does not match full tokenization, not using it")
+            return None
+
+        return prefix_ids, suffix_ids
+
+    def _encode_with_template(self, contents: List[str]) -> List[List[int]]:
+        assert self._template_token_ids is not None
+        prefix_ids, suffix_ids = self._template_token_ids
+
+        content_ids = self._encode([content.replace("\n", self.new_line_symbol) for content in contents])
+        return [[*prefix_ids, *ids, *suffix_ids] for ids in content_ids]
+
+    def _batch_process_with_template(self, instances: List[Union[str, List[ChatMessage]]]) -> BatchEncoding:
+        """
+        Only tokenizes the content of rows that are a lone user message, stitching it between the
+        pre-tokenized template parts, and falls back to the full template for all other rows.
+        """
+        contents = [self._lone_user_content(instance) for instance in instances]
+
+        fast_positions = [i for i, content in enumerate(contents) if content is not None]
+        slow_positions = [i for i, content in enumerate(contents) if content is None]
+
+        if fast_positions and not self._template_verified_on_job:
+            self._template_verified_on_job = True
+            sample = fast_positions[:TEMPLATE_FAST_PATH_JOB_SAMPLE_SIZE]
+            expected = self._encode(self.batch_format([instances[i] for i in sample]))
+            if self._encode_with_template([contents[i] or "" for i in sample]) != expected:
+                logger.warning(
+                    "Template fast path does not match full tokenization of the job's rows, not using it"
+                )
+                self._template_token_ids = None
+                return self.batch_process(instances)
+
+        input_ids: List[List[int]] = [[] for _ in instances]
+        if fast_positions:
+            fast_ids = self._encode_with_template([contents[i] or "" for i in fast_positions])
+            for i, ids in zip(fast_positions, fast_ids):
+                input_ids[i] = ids
+        if slow_positions:
+            slow_ids = self._encode(self.batch_format([instances[i] for i in slow_positions]))
+            for i, ids in zip(slow_positions, slow_ids):
+                input_ids[i] = ids
+
+        return BatchEncoding(dict(input_ids=input_ids, attention_mask=[[1] * len(ids) for ids in input_ids]))
+
     def batch_process(
         self,
         instances: List[Union[str, List[ChatMessage]]],
         **tokenizer_kwargs,
     ) -> BatchEncoding:
+        # The fast path only produces the default, unpadded output
+        if self._template_token_ids is not None and not tokenizer_kwargs:
+            return self._batch_process_with_template(instances)
+
         tokenizer_kwargs.setdefault("return_attention_mask", True)
         tokenizer_kwargs.setdefault("add_special_tokens", False)
 
@@ -0,0 +1,66 @@
+import asyncio
+import importlib.util
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, List
+import unittest
+from unittest.mock import patch
+
+from birr.batch_inference.data_models import PreparedBatch, token_ids_to_list
+from birr.core.config import GenerateConfig, LLMModelConfig
+
+
+class FakeAsyncEngine:
+    """Echoes each prompt back as its completion, except that prompts starting with 0 fail and 1 never finish."""
+
+    def __init__(self) -> None:
+        self.engine = SimpleNamespace(scheduler=[SimpleNamespace(num_cumulative_preemption=0)])
+        self.aborted_request_ids: List[str] = []
+        self.started_request_ids: List[str] = []
+
+    async def generate(self, tokens_prompt: Any, sampling_params: Any, request_id: str) -> AsyncIterator[Any]:
+        self.started_request_ids.append(request_id)
+        token_ids = tokens_prompt["prompt_token_ids"]
+        # Lets the batch's other requests start first
+        await asyncio.sleep(0)
+        if token_ids[0] == 0:
+            raise RuntimeError("Request failed")
+        if token_ids[0] == 1:
+            await asyncio.Event().wait()
+
+        yield SimpleNamespace(
+            outputs=[SimpleNamespace(index=0, token_ids=token_ids, finish_reason="stop", stop_reason=None)]
+        )
+
+    async def abort(self, request_id: str) -> None:
+        self.aborted_request_ids.append(request_id)
+
+
+@unittest.skipUnless(importlib.util.find_spec("vllm"), "vLLM isn't installed")
+class TestAsyncPredictor(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        from birr.batch_inference.predictors.async_predictor import AsyncPredictor
+
+        self.engine = FakeAsyncEngine()
+        with patch("birr.batch_inference.predictors.async_predictor.AsyncLLMEngine") as MockAsyncLLMEngine:
+            MockAsyncLLMEngine.from_engine_args.return_value = self.engine
+            self.predictor = AsyncPredictor(LLMModelConfig(), GenerateConfig())
+
+    async def test__predicts_every_prompt_of_a_batch(self) -> None:
+        batch = PreparedBatch.from_token_ids([7, 3], [[5, 6], [8]])
+
+        completed = await self.predictor.predict(batch)
+
+        self.assertEqual(
+            [(item.index, token_ids_to_list(item.outputs[0].token_ids)) for item in completed.to_items()],
+            [(7, [5, 6]), (3, [8])],
+        )
+        self.assertIsNotNone(completed.stats)
+
+    async def test__aborts_the_other_requests_of_a_batch_when_one_fails(self) -> None:
+        batch = PreparedBatch.from_token_ids([0, 1, 2], [[1, 5], [0, 6], [1, 7]])
+
+        with self.assertRaisesRegex(RuntimeError, "Request failed"):
+            await self.predictor.predict(batch)
+
+        started = self.engine.started_request_ids
+        self.assertEqual(self.engine.aborted_request_ids, [started[0], started[2]])
@@ -1,8 +1,11 @@
+import os
+import tempfile
 import unittest
 from unittest.mock import patch
 
 from birr.batch_inference.data_models import Message
 from birr.batch_inference.queue.in_memory_queue import InMemoryQueue
+from birr.batch_inference.utils import open_for_writing
 from birr.core.config import PipelineConfig
 
 
@@ -22,6 +25,7 @@ class TestInMemoryQueue(unittest.TestCase):
                 input_file_dir="/local-dir/some/path/input",
                 output_file_dir="/local-dir/some/other/path/output",
                 generation_batch_size=256,
+                message_order="listed",
             )
 
             queue = InMemoryQueue(pipeline_config)
@@ -38,3 +42,90 @@ class TestInMemoryQueue(unittest.TestCase):
                 self.assertEqual(actual_message, expected_message)
 
             self.assertEqual(queue.get_message(), None)
+
+    def test__files_with_a_checkpoint_are_returned_first(self) -> None:
+        with patch(
+            "birr.batch_inference.queue.in_memory_queue.determine_remaining_files_to_process"
+        ) as mock_fn, patch("birr.batch_inference.queue.in_memory_queue.has_checkpoint") as mock_has_checkpoint:
+            mock_fn.return_value = [
+                "/local-dir/some/path/file1.jsonl",
+                "/local-dir/some/path/file2.jsonl",
+                "/local-dir/some/path/file3.jsonl",
+            ]
+            mock_has_checkpoint.side_effect = lambda f, *_: f.endswith("file2.jsonl")
+
+            pipeline_config = PipelineConfig(
+                input_file_dir="/local-dir/some/path/input",
+                output_file_dir="/local-dir/some/other/path/output",
+                generation_batch_size=256,
+                message_order="listed",
+            )
+
+            queue = InMemoryQueue(pipeline_config)
+
+            object_keys = [message.object_key for _ in range(3) if (message := queue.get_message())]
+
+            self.assertEqual(
+                object_keys,
+                [
+                    "/local-dir/some/path/file2.jsonl",
+                    "/local-dir/some/path/file1.jsonl",
+                    "/local-dir/some/path/file3.jsonl",
+                ],
+            )
+
+    def test__large_uncompressed_files_are_split_into_row_ranges(self) -> None:
+        with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+            lines = [f'{{"id": {i}, "text": "row {i}"}}\n'.encode("utf-8") for i in range(5)]
+            with open(os.path.join(input_dir, "large.jsonl"), "wb") as f:
+                f.write(b"".join(lines))
+            with open_for_writing(os.path.join(input_dir, "compressed.jsonl.zst"), "zstd") as f:
+                f.write(b"".join(lines))
+
+            pipeline_config = PipelineConfig(
+                input_file_dir=input_dir, output_file_dir=output_dir, generation_batch_size=256, rows_per_message=2
+            )
+            queue = InMemoryQueue(pipeline_config)
+            messages = [message for _ in range(5) if (message := queue.get_message())]
+
+            row_ranges = sorted(
+                (r.part_index, r.num_parts, r.start_offset, r.end_offset)
+                for message in messages
+                if (r := message.row_range)
+            )
+            self.assertEqual(len(messages), 4)
+            self.assertEqual(
+                row_ranges,
+                [
+                    (0, 3, 0, len(b"".join(lines[:2]))),
+                    (1, 3, len(b"".join(lines[:2])), len(b"".join(lines[:4]))),
+                    (2, 3, len(b"".join(lines[:4])), len(b"".join(lines))),
+                ],
+            )
+
+    def test__messages_are_ordered_by_size(self) -> None:
+        with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+            sizes = dict(a=3, b=50, c=10, d=1, e=20)
+            for name, num_rows in sizes.items():
+                with open(os.path.join(input_dir, f"{name}.jsonl"), "w") as f:
+                    f.write('{"text": "row"}\n' * num_rows)
+            with open_for_writing(os.path.join(input_dir, "f.jsonl.zst"), "zstd") as f:
+                # Random text barely compresses, so with its estimated expansion this is the largest file
+                f.write(b"".join(b'{"text": "%s"}\n' % os.urandom(16).hex().encode("ascii") for _ in range(40)))
+
+            for message_order, expected_names in [
+                ("largest_first", ["f", "b", "e", "c", "a", "d"]),
+                ("interleaved", ["f", "d", "b", "a", "e", "c"]),
+            ]:
+                pipeline_config = PipelineConfig(
+                    input_file_dir=input_dir,
+                    output_file_dir=output_dir,
+                    generation_batch_size=256,
+                    message_order=message_order,
+                )
+                queue = InMemoryQueue(pipeline_config)
+                messages = [message for _ in range(6) if (message := queue.get_message())]
+
+                self.assertEqual(
+                    [os.path.basename(message.object_key).split(".")[0] for message in messages], expected_names
+                )
@@ -0,0 +1,113 @@
+import os
+import tempfile
+import unittest
+from typing import List
+
+from birr.batch_inference.data_models import Message
+from birr.batch_inference.queue.sqlite_queue import SqliteQueue
+from birr.core.config import PipelineConfig
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestSqliteQueue(unittest.TestCase):
+    def setUp(self) -> None:
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.input_dir = os.path.join(self._tmp_dir.name, "input")
+        os.makedirs(self.input_dir)
+        for index, num_rows in enumerate([3, 1, 2]):
+            self._write_input_file(f"file{index}.jsonl", num_rows)
+
+        self.pipeline_config = PipelineConfig(
+            input_file_dir=self.input_dir,
+            output_file_dir=self._tmp_dir.name,
+            generation_batch_size=256,
+            queue_path=os.path.join(self._tmp_dir.name, "queue.sqlite"),
+            queue_visibility_timeout=60,
+            queue_max_attempts=2,
+        )
+        self.clock = FakeClock()
+
+    def tearDown(self) -> None:
+        self._tmp_dir.cleanup()
+
+    def _write_input_file(self, filename: str, num_rows: int) -> None:
+        with open(os.path.join(self.input_dir, filename), "w") as f:
+            f.write('{"text": "row"}\n' * num_rows)
+
+    def _object_keys(self, messages: List[Message]) -> List[str]:
+        return [os.path.basename(message.object_key) for message in messages]
+
+    def test__completed_messages_are_not_handed_out_again_after_a_restart(self) -> None:
+        queue = SqliteQueue(self.pipeline_config, clock=self.clock)
+        messages = queue.get_messages(2)
+        self.assertEqual(self._object_keys(messages), ["file0.jsonl", "file2.jsonl"])
+        queue.delete_message(messages[0])
+        queue.close()
+
+        # Files added later aren't picked up, since the queue isn't rescanned
+        self._write_input_file("file3.jsonl", 10)
+        restarted = SqliteQueue(self.pipeline_config, clock=self.clock)
+
+        self.assertEqual(self._object_keys(restarted.get_messages(5)), ["file1.jsonl"])
+        self.assertEqual(restarted.num_messages_by_state(), dict(done=1, leased=2))
+
+    def test__expired_leases_are_handed_out_again_until_out_of_attempts(self) -> None:
+        queue = SqliteQueue(self.pipeline_config, clock=self.clock)
+        first_lease = queue.get_messages(3)
+        self.assertEqual(queue.get_messages(3), [])
+
+        self.clock.now += 61
+        second_lease = queue.get_messages(1)
+        self.assertEqual(second_lease[0].message_id, first_lease[0].message_id)
+        self.assertNotEqual(second_lease[0].receipt_handle, first_lease[0].receipt_handle)
+        queue.delete_message(first_lease[1])
+
+        self.clock.now += 61
+        self.assertEqual(self._object_keys(queue.get_messages(3)), ["file1.jsonl"])
+        self.assertEqual(queue.num_messages_by_state(), dict(dead=1, done=1, leased=1))
+
+    def test__a_lease_handed_out_again_can_neither_be_extended_nor_complete_the_message(self) -> None:
+        queue = SqliteQueue(self.pipeline_config, clock=self.clock)
+        (first_lease,) = queue.get_messages(1)
+        self.clock.now += 50
+        self.assertTrue(queue.extend_lease(first_lease))
+
+        # Extended, so not handed out again at the original expiry
+        self.clock.now += 50
+        self.assertEqual(self._object_keys(queue.get_messages(3)), ["file2.jsonl", "file1.jsonl"])
+
+        self.clock.now += 61
+        (second_lease,) = [
+            message for message in queue.get_messages(3) if message.message_id == first_lease.message_id
+        ]
+        self.assertFalse(queue.extend_lease(first_lease))
+        queue.delete_message(first_lease)
+        self.assertEqual(queue.num_messages_by_state(), dict(leased=3))
+
+        self.assertTrue(queue.extend_lease(second_lease))
+        queue.delete_message(second_lease)
+        self.assertEqual(queue.num_messages_by_state(), dict(done=1, leased=2))
+
+    def test__released_messages_are_handed_out_again_right_away_until_out_of_attempts(self) -> None:
+        queue = SqliteQueue(self.pipeline_config, clock=self.clock)
+        first_lease, *other_messages = queue.get_messages(3)
+
+        queue.release_message(first_lease)
+        (second_lease,) = queue.get_messages(3)
+        self.assertEqual(second_lease.message_id, first_lease.message_id)
+
+        queue.release_message(second_lease)
+        self.assertEqual(queue.get_messages(3), [])
+        self.assertFalse(queue.is_drained())
+
+        for message in other_messages:
+            queue.delete_message(message)
+        self.assertTrue(queue.is_drained())
+        self.assertEqual(queue.num_messages_by_state(), dict(dead=1, done=2))
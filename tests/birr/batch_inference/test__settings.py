@@ -2,7 +2,7 @@ import os
 import unittest
 
 from birr.batch_inference.settings import Settings
-from birr.core.config import LLMModelConfig, PipelineConfig
+from birr.core.config import GenerateConfig, LLMModelConfig, PipelineConfig
 
 
 def mk_default_pipeline_config():
@@ -80,3 +80,46 @@ class TestSetting(unittest.TestCase):
 
         settings = Settings()
         self.assertEqual(settings.gpus_per_predictor, 0.5)
+
+    def test__prefetching_and_streaming_are_mutually_exclusive(self):
+        with self.assertRaises(Exception):
+            PipelineConfig(
+                input_file_dir="/input/files",
+                output_file_dir="/output/files",
+                generation_batch_size=16,
+                prefetch_depth=1,
+                streaming_window_size=1000,
+            )
+
+    def test__adaptive_batch_sizes_and_continuous_batching_are_mutually_exclusive(self):
+        with self.assertRaises(Exception):
+            PipelineConfig(
+                input_file_dir="/input/files",
+                output_file_dir="/output/files",
+                generation_batch_size=16,
+                adaptive_batch_size_bounds=(4, 64),
+                continuous_batching_slots=2,
+            )
+
+    def test__exactly_one_of_generation_batch_size_and_token_budget_must_be_set(self):
+        with self.assertRaises(Exception):
+            PipelineConfig(input_file_dir="/input/files", output_file_dir="/output/files")
+
+        with self.assertRaises(Exception):
+            PipelineConfig(
+                input_file_dir="/input/files",
+                output_file_dir="/output/files",
+                generation_batch_size=16,
+                generation_token_budget=4096,
+            )
+
+        PipelineConfig(
+            input_file_dir="/input/files", output_file_dir="/output/files", generation_token_budget=4096
+        )
+
+    def test__best_of_must_be_at_least_n(self):
+        with self.assertRaises(Exception):
+            GenerateConfig(n=4, best_of=2)
+
+        self.assertEqual(GenerateConfig(n=4).sequences_per_prompt, 4)
+        self.assertEqual(GenerateConfig(n=2, best_of=4).sequences_per_prompt, 4)
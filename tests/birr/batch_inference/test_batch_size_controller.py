@@ -0,0 +1,63 @@
+from typing import Tuple
+import unittest
+
+from birr.batch_inference.batch_size_controller import BatchSizeController
+from birr.batch_inference.data_models import PreparedBatch
+from birr.batch_inference.queue.dummy_predictor import DummyPredictor
+from birr.core.config import GenerateConfig, LLMModelConfig
+
+
+def mk_rows(lengths) -> PreparedBatch:
+    return PreparedBatch.from_token_ids(list(range(len(lengths))), [[1] * length for length in lengths])
+
+
+def latency_model(batch: PreparedBatch) -> Tuple[float, int]:
+    # A fixed overhead per batch rewards larger batches, until the KV cache overflows past 40 rows
+    return 0.001 + 0.0001 * len(batch), int(len(batch) > 40)
+
+
+class TestBatchSizeController(unittest.TestCase):
+    def setUp(self) -> None:
+        self._predictor = DummyPredictor(LLMModelConfig(), GenerateConfig(), latency_model=latency_model)
+
+    def test__grows_until_preemptions_and_then_stays_near_capacity(self) -> None:
+        controller = BatchSizeController(8, min_batch_size=1, max_batch_size=64)
+
+        sizes = []
+        with self.assertLogs("birr.batch_inference.batch_size_controller", level="INFO") as logs:
+            for _ in range(10):
+                for batch in controller.batches(mk_rows([4] * 200)):
+                    completed = self._predictor.predict(batch)
+                    assert completed.stats is not None
+                    controller.record(completed.stats)
+                    sizes.append(len(batch))
+
+        self.assertGreater(max(sizes), 40)
+        self.assertTrue(25 <= controller.batch_size(0) <= 48)
+        self.assertTrue(any("preemptions" in line for line in logs.output))
+
+    def test__stays_within_bounds(self) -> None:
+        controller = BatchSizeController(8, min_batch_size=4, max_batch_size=16)
+
+        for _ in range(5):
+            for batch in controller.batches(mk_rows([4] * 100)):
+                completed = self._predictor.predict(batch)
+                assert completed.stats is not None
+                controller.record(completed.stats)
+
+        self.assertEqual(controller.batch_size(0), 16)
+
+    def test__batches_do_not_cross_brackets_and_brackets_adapt_separately(self) -> None:
+        controller = BatchSizeController([(4, 8), (16, 2)], min_batch_size=1, max_batch_size=64)
+
+        batches = list(controller.batches(mk_rows([2] * 10 + [8] * 3 + [32] * 3)))
+        # The last bracket takes all longer prompts too
+        self.assertEqual(
+            [batch.lengths.tolist() for batch in batches], [[2] * 8, [2] * 2, [8, 8], [8, 32], [32, 32]]
+        )
+
+        completed = self._predictor.predict(batches[0])
+        assert completed.stats is not None
+        controller.record(completed.stats)
+
+        self.assertEqual((controller.batch_size(0), controller.batch_size(1)), (10, 2))
@@ -0,0 +1,96 @@
+import json
+import os
+import tempfile
+import unittest
+
+from birr.batch_inference.checkpoint import RowCheckpoint
+from birr.batch_inference.utils import load_instances_from_local_file
+
+
+def read_rows(file_path):
+    return load_instances_from_local_file(file_path)
+
+
+class TestRowCheckpoint(unittest.TestCase):
+    def setUp(self) -> None:
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.output_file_path = os.path.join(self._tmp_dir.name, "file1.jsonl")
+
+    def tearDown(self) -> None:
+        self._tmp_dir.cleanup()
+
+    def test__promote_writes_rows_in_input_order_and_cleans_up(self) -> None:
+        checkpoint = RowCheckpoint(self.output_file_path)
+        for index in [3, 1]:
+            checkpoint.add(index, dict(id=index))
+        checkpoint.flush()
+        for index in [0, 2]:
+            checkpoint.add(index, dict(id=index))
+
+        checkpoint.promote()
+
+        self.assertEqual(read_rows(self.output_file_path), [dict(id=0), dict(id=1), dict(id=2), dict(id=3)])
+        self.assertEqual(os.listdir(self._tmp_dir.name), ["file1.jsonl"])
+
+    def test__resume_picks_up_flushed_rows_only(self) -> None:
+        checkpoint = RowCheckpoint(self.output_file_path)
+        checkpoint.add(0, dict(id=0))
+        checkpoint.add(2, dict(id=2))
+        checkpoint.flush()
+        checkpoint.add(1, dict(id=1))  # never flushed, lost with the "crash"
+
+        resumed = RowCheckpoint(self.output_file_path)
+        self.assertEqual(resumed.completed_indices, {0, 2})
+
+        resumed.add(1, dict(id=1))
+        resumed.promote()
+
+        self.assertEqual(read_rows(self.output_file_path), [dict(id=0), dict(id=1), dict(id=2)])
+
+    def test__resume_discards_rows_written_after_the_last_checkpoint_entry(self) -> None:
+        checkpoint = RowCheckpoint(self.output_file_path)
+        checkpoint.add(0, dict(id=0))
+        checkpoint.flush()
+
+        # Simulate a crash between appending rows and recording them in the sidecar
+        with open(checkpoint.partial_file_path, "a") as f:
+            f.write(json.dumps(dict(id=1)) + "\n")
+        with open(checkpoint.checkpoint_file_path, "a") as f:
+            f.write('{"end_offset": 12')
+
+        resumed = RowCheckpoint(self.output_file_path)
+        self.assertEqual(resumed.completed_indices, {0})
+
+        resumed.add(1, dict(id=1))
+        resumed.promote()
+
+        self.assertEqual(read_rows(self.output_file_path), [dict(id=0), dict(id=1)])
+
+    def test__no_resume_starts_over(self) -> None:
+        checkpoint = RowCheckpoint(self.output_file_path)
+        checkpoint.add(0, dict(id=0))
+        checkpoint.flush()
+
+        fresh = RowCheckpoint(self.output_file_path, resume=False)
+        self.assertEqual(fresh.completed_indices, set())
+
+        fresh.promote()
+
+        self.assertEqual(read_rows(self.output_file_path), [])
+
+    def test__compressed_output_resumes_and_promotes(self) -> None:
+        output_file_path = os.path.join(self._tmp_dir.name, "file1.jsonl.zst")
+
+        checkpoint = RowCheckpoint(output_file_path)
+        checkpoint.add(2, dict(id=2))
+        checkpoint.flush()
+        checkpoint.add(0, dict(id=0))
+        checkpoint.flush()
+
+        resumed = RowCheckpoint(output_file_path)
+        self.assertEqual(resumed.completed_indices, {0, 2})
+
+        resumed.add(1, dict(id=1))
+        resumed.promote()
+
+        self.assertEqual(read_rows(output_file_path), [dict(id=0), dict(id=1), dict(id=2)])
@@ -1,6 +1,20 @@
 import unittest
 
-from birr.batch_inference.data_models import ChatMessage, ImageChatMessageContent, TextChatMessageContent
+import numpy as np
+
+from birr.batch_inference.data_models import (
+    ChatMessage,
+    CompletedBatch,
+    CompletedItem,
+    CompletionError,
+    CompletionOutput,
+    EncodedImage,
+    ImageChatMessageContent,
+    PreparedBatch,
+    PreparedInputItem,
+    TextChatMessageContent,
+    token_ids_to_list,
+)
 
 
 class TestDataModels(unittest.TestCase):
@@ -70,3 +84,58 @@ class TestDataModels(unittest.TestCase):
         )
 
         self.assertEqual(expected_message, message)
+
+    def test__prepared_batch_slices_takes_and_round_trips(self):
+        items = [PreparedInputItem(index=i, token_ids=[i] * (i + 1)) for i in range(4)]
+        batch = PreparedBatch.concat([PreparedBatch.from_items(items[:1]), PreparedBatch.from_items(items[1:])])
+
+        self.assertEqual(len(batch), 4)
+        self.assertEqual(batch.lengths.tolist(), [1, 2, 3, 4])
+        self.assertEqual(batch[1:3].indices.tolist(), [1, 2])
+        self.assertEqual(batch[1:3].row_token_ids(1).tolist(), [2, 2, 2])
+
+        taken = batch.take(np.array([3, 0, 2]))
+        self.assertEqual(
+            [(item.index, token_ids_to_list(item.token_ids)) for item in taken.to_items()],
+            [(3, [3, 3, 3, 3]), (0, [0]), (2, [2, 2, 2])],
+        )
+
+    def test__prepared_batch_concat_shares_images_with_the_same_key(self):
+        first = PreparedBatch.from_items(
+            [PreparedInputItem(index=0, token_ids=[1], image_data=[EncodedImage(b"logo", b"k" * 16)])]
+        )
+        second = PreparedBatch.from_items(
+            [
+                PreparedInputItem(index=1, token_ids=[2]),
+                PreparedInputItem(index=2, token_ids=[3], image_data=[EncodedImage(b"logo", b"k" * 16)]),
+            ]
+        )
+
+        image_data = PreparedBatch.concat([first, second]).image_data
+
+        assert image_data is not None and image_data[0] is not None and image_data[2] is not None
+        self.assertIsNone(image_data[1])
+        self.assertIs(image_data[0][0], image_data[2][0])
+
+    def test__completed_batch_groups_entries_back_into_items(self):
+        items = [
+            CompletedItem(
+                index=4,
+                outputs=[
+                    CompletionOutput(index=0, text="", token_ids=[1, 2], finish_reason="stop"),
+                    CompletionOutput(index=1, text="", token_ids=[3], finish_reason="length"),
+                ],
+            ),
+            CompletedItem(index=2, outputs=[], error=CompletionError.CONTEXT_TOO_LONG),
+            CompletedItem(index=7, outputs=[CompletionOutput(index=0, text="", token_ids=[5, 6, 7])]),
+        ]
+
+        batch = CompletedBatch.concat([CompletedBatch.from_items(items[:2]), CompletedBatch.from_items(items[2:])])
+        self.assertEqual(len(batch), 4)
+        self.assertEqual(batch.entry_token_ids(3).tolist(), [5, 6, 7])
+
+        round_tripped = batch.to_items()
+        for item in round_tripped:
+            for output in item.outputs:
+                output.token_ids = token_ids_to_list(output.token_ids)
+        self.assertEqual(round_tripped, items)
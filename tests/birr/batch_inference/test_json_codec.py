@@ -0,0 +1,67 @@
+import json
+from typing import Any, Dict, List
+import unittest
+
+from birr.batch_inference.data_models import ChatMessage, CompletionError, CompletionOutput, RawInputItem
+from birr.batch_inference.json_codec import (
+    decode_input_row,
+    encode_output_row,
+    encode_output_rows,
+)
+from birr.batch_inference.serializer import default_serializer
+
+CHAT_MESSAGES: List[Dict[str, Any]] = [
+    dict(role="system", content="Be brief."),
+    dict(
+        role="user",
+        content=[
+            dict(type="image_url", image_url=dict(url="data:image/png;base64,AAAA")),
+            dict(type="text", text="hi"),
+        ],
+    ),
+]
+
+
+def mk_completion_outputs():
+    return [CompletionOutput(index=0, text="I am Fred", token_ids=[1, 2, 3], finish_reason="stop")]
+
+
+class TestJsonCodec(unittest.TestCase):
+    def test__decodes_prompts_into_chat_messages(self) -> None:
+        text_row = decode_input_row(b'{"id": 1, "text": "hello"}')
+        chat_row = decode_input_row(json.dumps(dict(id=2, chat_messages=CHAT_MESSAGES)).encode("utf-8"))
+
+        self.assertEqual(text_row.messages, [ChatMessage.from_text("hello")])
+        self.assertEqual(chat_row.messages, RawInputItem.from_message_dicts(0, CHAT_MESSAGES).messages)
+
+    def test__encodes_the_same_rows_as_the_default_serializer(self) -> None:
+        line = json.dumps(dict(id="a", chat_messages=CHAT_MESSAGES, metadata=dict(score=0.5))).encode("utf-8")
+        for outputs, error in [(mk_completion_outputs(), None), ([], CompletionError.CONTEXT_TOO_LONG)]:
+            encoded = encode_output_row(decode_input_row(line), outputs, error)
+            self.assertEqual(json.loads(encoded), default_serializer(json.loads(line), outputs, error))
+
+    def test__passes_input_fields_through_verbatim(self) -> None:
+        line = '{"id": "a",  "metadata": {"score": 1.50, "city": "Zürich"}, "text": "hi"}'.encode("utf-8")
+
+        encoded = encode_output_row(decode_input_row(line), mk_completion_outputs(), None)
+
+        self.assertTrue(encoded.startswith(line[:-1] + b","))
+        self.assertEqual(json.loads(encoded)["outputs"][0]["token_ids"], [1, 2, 3])
+
+    def test__replaces_existing_output_fields(self) -> None:
+        line = b'{"text": "hi", "outputs": "stale", "completion_error": "CONTEXT_TOO_LONG"}'
+
+        encoded = encode_output_row(decode_input_row(line), mk_completion_outputs(), None)
+
+        self.assertEqual(encoded.count(b'"outputs"'), 1)
+        self.assertEqual(json.loads(encoded), default_serializer(json.loads(line), mk_completion_outputs(), None))
+
+    def test__falls_back_to_the_standard_library_for_what_orjson_rejects(self) -> None:
+        line = b'{"text": "hi", "score": NaN, "big": 123456789012345678901234567890}'
+
+        row = decode_input_row(line)
+        encoded_rows = encode_output_rows([encode_output_row(row, mk_completion_outputs(), None), dict(big=2**70)])
+
+        self.assertEqual(row.messages, [ChatMessage.from_text("hi")])
+        self.assertTrue(encoded_rows[0].startswith(line[:-1]))
+        self.assertEqual(encoded_rows[1], json.dumps(dict(big=2**70)).encode("utf-8"))
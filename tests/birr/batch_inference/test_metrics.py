@@ -0,0 +1,35 @@
+import unittest
+from unittest.mock import patch
+
+from ray.util.metrics import Counter, Gauge, Histogram
+
+from birr.batch_inference import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self) -> None:
+        metrics._metrics.clear()
+
+    def tearDown(self) -> None:
+        metrics._metrics.clear()
+
+    def test__recording_outside_of_ray_is_a_no_op(self) -> None:
+        with patch("birr.batch_inference.metrics.ray.is_initialized", return_value=False):
+            metrics.increment("birr_rows_processed", 3)
+            metrics.set_gauge("birr_queue_depth", 2)
+            metrics.observe_latency("decode", 0.5)
+
+        self.assertEqual(metrics._metrics, {})
+
+    def test__metrics_are_created_once_per_process_with_their_kind(self) -> None:
+        with patch("birr.batch_inference.metrics.ray.is_initialized", return_value=True):
+            metrics.increment("birr_rows_processed", 3)
+            metrics.set_gauge("birr_queue_depth", 2)
+            metrics.observe_latency("decode", 0.5)
+            histogram = metrics._metrics["birr_stage_latency_seconds"]
+            metrics.observe_latency("generate", 2.0)
+
+        self.assertIsInstance(metrics._metrics["birr_rows_processed"], Counter)
+        self.assertIsInstance(metrics._metrics["birr_queue_depth"], Gauge)
+        self.assertIsInstance(histogram, Histogram)
+        self.assertIs(metrics._metrics["birr_stage_latency_seconds"], histogram)
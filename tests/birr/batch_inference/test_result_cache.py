@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+
+from birr.batch_inference.data_models import (
+    CompletedItem,
+    CompletionError,
+    CompletionOutput,
+    PreparedBatch,
+    PreparedInputItem,
+    token_ids_to_list,
+)
+from birr.batch_inference.result_cache import (
+    ResultCache,
+    completed_item_from_json,
+    prompt_cache_keys,
+    result_cache_namespace,
+)
+from birr.core.config import GenerateConfig, LLMModelConfig
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._tmp_dir.name, "results.sqlite")
+
+    def tearDown(self) -> None:
+        self._tmp_dir.cleanup()
+
+    def test__completions_are_readable_in_later_caches(self) -> None:
+        items = [
+            CompletedItem(
+                index=3,
+                outputs=[CompletionOutput(index=0, text="ignored", token_ids=[4, 5], finish_reason="stop")],
+            ),
+            CompletedItem(index=4, outputs=[], error=CompletionError.CONTEXT_TOO_LONG),
+        ]
+        cache = ResultCache(self._path, "namespace")
+        cache.put_many([(b"a" * 16, items[0]), (b"b" * 16, items[1])])
+        cache.close()
+
+        reloaded = ResultCache(self._path, "namespace")
+        found = reloaded.get_many([b"a" * 16, b"b" * 16, b"c" * 16])
+
+        self.assertEqual(set(found), {b"a" * 16, b"b" * 16})
+        completed = completed_item_from_json(7, found[b"a" * 16])
+        self.assertEqual(completed.index, 7)
+        self.assertEqual(
+            [
+                (output.text, token_ids_to_list(output.token_ids), output.finish_reason)
+                for output in completed.outputs
+            ],
+            [("", [4, 5], "stop")],
+        )
+        self.assertEqual(completed_item_from_json(8, found[b"b" * 16]), CompletedItem(8, [], items[1].error))
+
+    def test__keys_depend_on_the_prompt_and_namespace(self) -> None:
+        batch = PreparedBatch.from_items(
+            [
+                PreparedInputItem(index=0, token_ids=[1, 2]),
+                PreparedInputItem(index=1, token_ids=[1, 2]),
+                PreparedInputItem(index=2, token_ids=[1, 2, 3]),
+            ]
+        )
+        namespace = result_cache_namespace(LLMModelConfig(), GenerateConfig())
+        other_namespace = result_cache_namespace(LLMModelConfig(), GenerateConfig(temperature=0.7))
+
+        keys = prompt_cache_keys(namespace, batch)
+
+        self.assertEqual(keys[0], keys[1])
+        self.assertNotEqual(keys[0], keys[2])
+        self.assertNotEqual(keys, prompt_cache_keys(other_namespace, batch))
+        self.assertEqual(namespace, result_cache_namespace(LLMModelConfig(), GenerateConfig()))
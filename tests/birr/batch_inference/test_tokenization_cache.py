@@ -0,0 +1,84 @@
+import os
+import tempfile
+from typing import List, Optional, Tuple
+import unittest
+
+from birr.batch_inference.data_models import RawInputItem, TokenizedItem, token_ids_to_list
+from birr.batch_inference.generate_io_processor import GenerateIOProcessor
+from birr.batch_inference.tokenization_cache import TokenizationCache, messages_cache_key
+from birr.core.config import FormatConfig, LLMModelConfig
+
+
+CUR_DIR = os.path.dirname(os.path.realpath(__file__))
+DUMMY_ARTIFACTS_DIR = os.path.join(CUR_DIR, "..", "fixtures", "dummy_model")
+
+
+def cached_list(cache: TokenizationCache, key: bytes) -> Optional[List[int]]:
+    token_ids = cache.get(key)
+    return None if token_ids is None else token_ids.tolist()
+
+
+def as_lists(items: List[TokenizedItem]) -> List[Tuple[int, List[int]]]:
+    return [(item.index, token_ids_to_list(item.token_ids)) for item in items]
+
+
+class TestTokenizationCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self._tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self._tmp_dir.cleanup()
+
+    def test__entries_are_readable_in_the_same_and_later_caches(self) -> None:
+        cache = TokenizationCache(self._tmp_dir.name, "namespace")
+        cache.put_many([(b"a" * 16, [1, 2, 3]), (b"b" * 15 + b"\x00", [])])
+        cache.put_many([(b"c" * 16, [4])])
+
+        self.assertEqual(cached_list(cache, b"a" * 16), [1, 2, 3])
+        self.assertEqual(cached_list(cache, b"c" * 16), [4])
+        cache.close()
+
+        reloaded = TokenizationCache(self._tmp_dir.name, "namespace")
+        self.assertEqual(len(reloaded), 3)
+        self.assertEqual(cached_list(reloaded, b"a" * 16), [1, 2, 3])
+        self.assertEqual(cached_list(reloaded, b"b" * 15 + b"\x00"), [])
+        self.assertEqual(cached_list(reloaded, b"c" * 16), [4])
+        self.assertIsNone(cached_list(reloaded, b"d" * 16))
+
+        other_namespace = TokenizationCache(self._tmp_dir.name, "other-namespace")
+        self.assertIsNone(cached_list(other_namespace, b"a" * 16))
+
+    def test__torn_trailing_index_entry_is_ignored(self) -> None:
+        cache = TokenizationCache(self._tmp_dir.name, "namespace")
+        cache.put_many([(b"a" * 16, [1, 2, 3]), (b"b" * 16, [4, 5])])
+        cache.close()
+
+        namespace_dir = os.path.join(self._tmp_dir.name, "namespace")
+        [index_file] = [f for f in os.listdir(namespace_dir) if f.endswith(".index")]
+        index_path = os.path.join(namespace_dir, index_file)
+        os.truncate(index_path, os.path.getsize(index_path) - 1)
+
+        reloaded = TokenizationCache(self._tmp_dir.name, "namespace")
+        self.assertEqual(cached_list(reloaded, b"a" * 16), [1, 2, 3])
+        self.assertIsNone(cached_list(reloaded, b"b" * 16))
+
+    def test__io_processor_tokenizes_only_cache_misses(self) -> None:
+        model_config = LLMModelConfig(name_or_path=DUMMY_ARTIFACTS_DIR)
+        batch = [
+            RawInputItem.from_text(index, text) for index, text in enumerate(["Hi there", "Hello", "Hi there"])
+        ]
+
+        uncached = as_lists(GenerateIOProcessor(model_config, FormatConfig()).tokenize(batch))
+
+        processor = GenerateIOProcessor(model_config, FormatConfig(), tokenization_cache_dir=self._tmp_dir.name)
+        self.assertEqual(as_lists(processor.tokenize(batch)), uncached)
+
+        rerun = GenerateIOProcessor(model_config, FormatConfig(), tokenization_cache_dir=self._tmp_dir.name)
+        rerun._tokenizer = None  # type: ignore
+        self.assertEqual(as_lists(rerun.tokenize(batch)), uncached)
+
+        other_format = GenerateIOProcessor(
+            model_config, FormatConfig(system_message="Be terse."), tokenization_cache_dir=self._tmp_dir.name
+        )
+        assert other_format._tokenization_cache is not None
+        self.assertIsNone(other_format._tokenization_cache.get(messages_cache_key(batch[0].messages)))
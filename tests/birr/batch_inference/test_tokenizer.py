@@ -1,11 +1,32 @@
+import base64
+from io import BytesIO
 import unittest
 from unittest.mock import Mock, patch
 
-from birr.batch_inference.data_models import CompletedItem, CompletionOutput
-from birr.batch_inference.generate_io_processor import GenerateIOProcessor
+import numpy as np
+from PIL import Image
+
+from birr.batch_inference.data_models import (
+    CompletedBatch,
+    CompletedItem,
+    CompletionOutput,
+    RawInputItem,
+    token_ids_to_list,
+)
+from birr.batch_inference.generate_io_processor import GenerateIOProcessor, strip_padding
+from birr.core.config import FormatConfig, LLMModelConfig
 
 
 class TestGenerateIOProcessor(unittest.TestCase):
+    def test__strip_padding_applies_the_attention_mask_per_row(self):
+        stripped = strip_padding(
+            [[0, 0, 5, 6], [7, 8, 9, 1], [0, 0, 0, 0], [3]],
+            [[0, 0, 1, 1], [1, 1, 1, 0], [0, 0, 0, 0], [1]],
+        )
+
+        self.assertEqual([ids.tolist() for ids in stripped], [[5, 6], [7, 8, 9], [], [3]])
+        self.assertTrue(all(ids.dtype == np.int32 for ids in stripped))
+
     def test__decode(self):
         with patch("birr.batch_inference.generate_io_processor.ModelTokenizer", Mock()) as MockModelTokenizer:
             mock_model_tokenizer = Mock()
@@ -52,7 +73,10 @@ class TestGenerateIOProcessor(unittest.TestCase):
                 ),
             ]
 
-            decoded_items = tokenizer.decode(batch)
+            decoded_items = tokenizer.decode(CompletedBatch.from_items(batch)).to_items()
+            for item in decoded_items:
+                for output in item.outputs:
+                    output.token_ids = token_ids_to_list(output.token_ids)
 
             self.assertEqual(
                 [
@@ -87,3 +111,62 @@ class TestGenerateIOProcessor(unittest.TestCase):
                 ],
                 decoded_items,
             )
+
+    def test__load_images_keeps_images_compressed_and_downscales_large_ones(self):
+        def data_url(size):
+            encoded = BytesIO()
+            Image.new("RGB", size, color=(10, 20, 30)).save(encoded, format="PNG")
+            return "data:image/png;base64," + base64.b64encode(encoded.getvalue()).decode("ascii")
+
+        with patch("birr.batch_inference.generate_io_processor.ModelTokenizer", Mock()):
+            processor = GenerateIOProcessor(LLMModelConfig(vlm=True, max_image_size=32), FormatConfig())
+
+        small_url, large_url = data_url((16, 8)), data_url((128, 64))
+        batch = [
+            RawInputItem.from_message_dicts(
+                0,
+                [
+                    {
+                        "role": "user",
+                        "content": [
+                            {"type": "image_url", "image_url": {"url": small_url}},
+                            {"type": "image_url", "image_url": {"url": large_url}},
+                            {"type": "text", "text": "Describe these."},
+                        ],
+                    }
+                ],
+            ),
+            RawInputItem.from_text(1, "No images here."),
+        ]
+
+        [images, no_images] = processor.load_images(batch)
+
+        self.assertIsNone(no_images)
+        assert images is not None
+        self.assertEqual(images[0].data, base64.b64decode(small_url.split(",", 1)[1]))
+        self.assertEqual([image.decode().size for image in images], [(16, 8), (32, 16)])
+
+    def test__load_images_shares_repeated_images_and_evicts_least_recently_used(self):
+        def data_url(color):
+            encoded = BytesIO()
+            Image.new("RGB", (4, 4), color=color).save(encoded, format="PNG")
+            return "data:image/png;base64," + base64.b64encode(encoded.getvalue()).decode("ascii")
+
+        def row(index, url):
+            content = [{"type": "image_url", "image_url": {"url": url}}, {"type": "text", "text": "Hi"}]
+            return RawInputItem.from_message_dicts(index, [{"role": "user", "content": content}])
+
+        with patch("birr.batch_inference.generate_io_processor.ModelTokenizer", Mock()):
+            processor = GenerateIOProcessor(LLMModelConfig(vlm=True, image_cache_size=2), FormatConfig())
+
+        red, green, blue = data_url((255, 0, 0)), data_url((0, 255, 0)), data_url((0, 0, 255))
+
+        first = processor.load_images([row(0, red), row(1, green), row(2, red)])
+        self.assertIs(first[0][0], first[2][0])
+        self.assertNotEqual(first[0][0].key, first[1][0].key)
+
+        # Red was used more recently than green, so green is the one evicted
+        processor.load_images([row(3, blue)])
+        second = processor.load_images([row(4, red), row(5, green)])
+        self.assertIs(second[0][0], first[0][0])
+        self.assertIsNot(second[1][0], first[1][0])
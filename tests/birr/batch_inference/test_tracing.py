@@ -0,0 +1,53 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from birr.batch_inference import tracing
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self) -> None:
+        tracing._tracer = None
+        tracing._tracer_loaded = False
+
+    def tearDown(self) -> None:
+        if tracing._tracer is not None:
+            tracing._tracer.close()
+        tracing._tracer = None
+        tracing._tracer_loaded = False
+
+    def test__spans_are_not_recorded_without_a_trace_dir(self) -> None:
+        with patch.dict(os.environ, clear=True):
+            with tracing.span("tokenize", "tokenizer", batch_size=3) as span_args:
+                span_args.update(num_tokens=10)
+
+        self.assertIsNone(tracing._tracer)
+        self.assertEqual(span_args, dict(batch_size=3, num_tokens=10))
+
+    def test__spans_are_merged_into_a_chrome_trace_of_their_run_only(self) -> None:
+        with tempfile.TemporaryDirectory() as trace_dir:
+            earlier_run_trace_dir = tracing.new_run_trace_dir(trace_dir)
+            with open(os.path.join(earlier_run_trace_dir, f"host-1{tracing.TRACE_FILE_SUFFIX}"), "w") as f:
+                f.write(json.dumps(dict(name="predict", ph="X", ts=0, dur=1, pid=1, tid=1)) + "\n")
+
+            run_trace_dir = tracing.new_run_trace_dir(trace_dir)
+            with patch.dict(os.environ, {tracing.TRACE_DIR_ENV_VAR: run_trace_dir}):
+                with tracing.span("message", "worker", object_key="a.jsonl"):
+                    with tracing.span("predict", "worker", lane=1, batch_size=3) as span_args:
+                        span_args.update(num_tokens=10)
+
+            with open(tracing.merge_traces(run_trace_dir), "r") as f:
+                trace = json.load(f)
+
+        metadata, predict, message = trace["traceEvents"]
+        self.assertEqual(metadata["ph"], "M")
+        self.assertTrue(metadata["args"]["name"].startswith("worker "))
+
+        self.assertEqual(predict["name"], "predict")
+        self.assertEqual(predict["tid"], 1)
+        self.assertEqual(predict["args"], dict(batch_size=3, num_tokens=10))
+
+        self.assertEqual(message["args"], dict(object_key="a.jsonl"))
+        self.assertTrue(all(event["pid"] == 0 for event in trace["traceEvents"]))
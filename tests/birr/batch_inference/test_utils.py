@@ -1,8 +1,20 @@
 import os
+import tempfile
 import unittest
 
 from birr.batch_inference import utils
-from birr.batch_inference.data_models import PreparedInputItem
+from birr.batch_inference.data_models import (
+    CompletedBatch,
+    CompletedItem,
+    CompletionOutput,
+    EncodedImage,
+    PreparedBatch,
+    PreparedInputItem,
+    RowRange,
+)
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fixtures")
 
 
 class TestUtils(unittest.TestCase):
@@ -66,6 +78,66 @@ class TestUtils(unittest.TestCase):
 
         self.assertEqual(batches, expected_batches)
 
+    def test__prediction_batches_split_prepared_batches_like_lists(self) -> None:
+        items = [PreparedInputItem(index=i, token_ids=[1] * length) for i, length in enumerate([1, 1, 1, 3, 3, 9])]
+        batch_size_config = [(1, 2), (4, 3), (8, 1)]
+
+        batches = list(utils.prediction_batches(PreparedBatch.from_items(items), batch_size_config))
+
+        expected = [[item.index for item in batch] for batch in utils.prediction_batches(items, batch_size_config)]
+        self.assertEqual([batch.indices.tolist() for batch in batches], expected)
+
+    def test__prediction_batches_count_sequences_per_prompt(self) -> None:
+        items = [PreparedInputItem(index=i, token_ids=[1] * length) for i, length in enumerate([1, 1, 1, 3, 3, 3])]
+
+        batches = list(utils.prediction_batches(items, [(1, 4), (4, 6)], sequences_per_prompt=3))
+
+        self.assertEqual([[item.index for item in batch] for batch in batches], [[0], [1], [2], [3, 4], [5]])
+
+    def test__merged_chunks_never_split_a_batch(self) -> None:
+        def completed(index: int, num_outputs: int) -> CompletedBatch:
+            outputs = [CompletionOutput(index=i, text="", token_ids=[1]) for i in range(num_outputs)]
+            return CompletedBatch.from_items([CompletedItem(index=index, outputs=outputs)])
+
+        batches = [completed(0, 2), completed(1, 1), completed(2, 3), completed(3, 1)]
+
+        merged = list(utils.merged_chunks(batches, 3))
+
+        self.assertEqual([batch.indices.tolist() for batch in merged], [[0, 0, 1], [2, 2, 2], [3]])
+
+    def test__token_budget_batches_reserve_max_tokens_per_row(self) -> None:
+        items = [
+            PreparedInputItem(index=i, token_ids=[1] * length) for i, length in enumerate([1, 1, 2, 4, 4, 20])
+        ]
+
+        batches = list(utils.token_budget_batches(items, token_budget=16, max_tokens=3))
+
+        # Costs: [1+3, 1+3, 2+3] = 13, [4+3, 4+3] = 14, and a lone row over budget
+        self.assertEqual([[item.index for item in batch] for batch in batches], [[0, 1, 2], [3, 4], [5]])
+
+    def test__token_budget_batches_reserve_the_longest_prompt_when_max_tokens_unset(self) -> None:
+        items = [PreparedInputItem(index=i, token_ids=[1] * length) for i, length in enumerate([2, 2, 3, 3])]
+
+        batches = list(utils.token_budget_batches(items, token_budget=12))
+
+        # Costs: 2 + 2 + 2 * 2 = 8, then adding a third row would cost 7 + 3 * 3 = 16
+        self.assertEqual([[item.index for item in batch] for batch in batches], [[0, 1], [2, 3]])
+
+    def test__token_budget_batches_reserve_completions_for_every_sequence(self) -> None:
+        items = [PreparedInputItem(index=i, token_ids=[1] * length) for i, length in enumerate([1, 1, 1, 1])]
+
+        batches = list(utils.token_budget_batches(items, token_budget=14, max_tokens=3, sequences_per_prompt=2))
+
+        # Costs: 1 + 1 + 2 * 2 * 3 = 14, then adding a third row would cost 3 + 3 * 2 * 3 = 21
+        self.assertEqual([[item.index for item in batch] for batch in batches], [[0, 1], [2, 3]])
+
+    def test__token_budget_batches_with_padded_cost_model(self) -> None:
+        items = [PreparedInputItem(index=i, token_ids=[1] * length) for i, length in enumerate([1, 2, 2, 3, 5])]
+
+        batches = list(utils.token_budget_batches(items, token_budget=6, cost_model="padded"))
+
+        self.assertEqual([[item.index for item in batch] for batch in batches], [[0, 1, 2], [3], [4]])
+
     def test__flatten_flattens(self) -> None:
         to_flatten = [[1, 2, 3, 4], [5, 6], [7], [8, 9, 10]]
 
@@ -89,8 +161,136 @@ class TestUtils(unittest.TestCase):
             ],
         ]
 
-        flattened_and_sorted = list(utils.flatten_and_sort(batches))
+        flattened_and_sorted = utils.flatten_and_sort([PreparedBatch.from_items(batch) for batch in batches])
 
-        indices = [item.index for item in flattened_and_sorted]
+        indices = flattened_and_sorted.indices.tolist()
 
         self.assertEqual(indices, [3, 5, 1, 0, 2, 4])
+
+    def test__flattens_and_sorts_by_prefix_within_length_buckets(self) -> None:
+        batches = [
+            [
+                PreparedInputItem(index=0, token_ids=[7, 1, 2]),
+                PreparedInputItem(index=1, token_ids=[5, 5, 5, 5, 5, 5]),
+                PreparedInputItem(index=2, token_ids=[7, 1]),
+            ],
+            [
+                PreparedInputItem(index=3, token_ids=[5, 5, 1]),
+                PreparedInputItem(index=4, token_ids=[7, 1, 9]),
+                PreparedInputItem(index=5, token_ids=[5, 5]),
+            ],
+        ]
+
+        flattened_and_sorted = utils.flatten_and_sort(
+            [PreparedBatch.from_items(batch) for batch in batches], prefix_bucket_size=4
+        )
+
+        indices = flattened_and_sorted.indices.tolist()
+
+        self.assertEqual(indices, [5, 3, 2, 0, 4, 1])
+
+    def test__deduplicate_prompts_keeps_the_first_row_of_each_prompt(self) -> None:
+        logo, scan = EncodedImage(b"logo", b"l" * 16), EncodedImage(b"scan", b"s" * 16)
+        batch = PreparedBatch.from_items(
+            [
+                PreparedInputItem(index=10, token_ids=[1, 2]),
+                PreparedInputItem(index=11, token_ids=[1, 2, 3]),
+                PreparedInputItem(index=12, token_ids=[1, 2]),
+                PreparedInputItem(index=13, token_ids=[1, 2], image_data=[logo]),
+                PreparedInputItem(index=14, token_ids=[1, 2], image_data=[scan]),
+                PreparedInputItem(index=15, token_ids=[1, 2], image_data=[logo]),
+                PreparedInputItem(index=16, token_ids=[1, 2]),
+            ]
+        )
+
+        unique, duplicate_indices = utils.deduplicate_prompts(batch)
+
+        self.assertEqual(unique.indices.tolist(), [10, 11, 13, 14])
+        self.assertEqual(duplicate_indices, {10: [12, 16], 13: [15]})
+
+    def test__partial_output_is_not_treated_as_finished(self) -> None:
+        with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+            input_file_path = os.path.join(input_dir, "file1.jsonl")
+            open(input_file_path, "w").close()
+
+            output_file_path = utils.output_file_path_for(input_file_path, output_dir)
+            open(utils.partial_output_file_path_for(output_file_path), "w").close()
+
+            self.assertEqual(utils.determine_remaining_files_to_process(input_dir, output_dir), [input_file_path])
+
+    def test__loads_zstd_compressed_instances(self) -> None:
+        plain = utils.load_instances_from_local_file(os.path.join(FIXTURES_DIR, "instances_file.json"))
+        compressed = utils.load_instances_from_local_file(os.path.join(FIXTURES_DIR, "instances_file.json.zstd"))
+
+        self.assertEqual(len(plain), 3)
+        self.assertEqual(plain, compressed)
+
+    def test__appending_to_compressed_files_reads_back_as_one_stream(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for suffix in [".zst", ".gz"]:
+                file_path = os.path.join(tmp_dir, f"file1.jsonl{suffix}")
+                compression = utils.compression_for(file_path)
+
+                with utils.open_for_writing(file_path, compression) as f:
+                    f.write(b'{"a": 1}\n')
+                with utils.open_for_writing(file_path, compression, append=True, compression_level=9) as f:
+                    f.write(b'{"a": 2}\n')
+
+                self.assertEqual(list(utils.iter_instances_from_local_file(file_path)), [dict(a=1), dict(a=2)])
+
+    def test__output_file_path_follows_input_compression_unless_overridden(self) -> None:
+        self.assertEqual(utils.output_file_path_for("/in/x.jsonl.zstd", "/out"), "/out/x.jsonl.zst")
+        self.assertEqual(utils.output_file_path_for("/in/x.jsonl.zst", "/out", "none"), "/out/x.jsonl")
+        self.assertEqual(utils.output_file_path_for("/in/x.jsonl", "/out", "gzip"), "/out/x.jsonl.gz")
+
+    def test__compressed_and_uncompressed_files_with_the_same_name_are_the_same_unit(self) -> None:
+        with tempfile.TemporaryDirectory() as input_dir, tempfile.TemporaryDirectory() as output_dir:
+            for filename in ["file1.jsonl.zst", "file2.jsonl.gz", "file3.jsonl", "notes.txt"]:
+                open(os.path.join(input_dir, filename), "w").close()
+            for filename in ["file1.jsonl", "file3.jsonl.zst"]:
+                open(os.path.join(output_dir, filename), "w").close()
+
+            self.assertEqual(
+                utils.determine_remaining_files_to_process(input_dir, output_dir),
+                [os.path.join(input_dir, "file2.jsonl.gz")],
+            )
+
+    def test__row_ranges_read_back_every_line_once(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "file1.jsonl")
+            with open(file_path, "w") as f:
+                f.write("".join(f'{{"a": {i}}}\n' for i in range(10)) + '{"a": 10}')
+
+            # A small block size, so line ends straddle blocks
+            offsets = utils.row_range_offsets(file_path, 3, block_size=7)
+            row_ranges = [
+                RowRange(part_index, len(offsets) - 1, start, end)
+                for part_index, (start, end) in enumerate(zip(offsets, offsets[1:]))
+            ]
+
+            self.assertEqual(len(row_ranges), 4)
+            self.assertEqual(
+                [[row["a"] for row in utils.iter_instances_from_local_file(file_path, r)] for r in row_ranges],
+                [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9, 10]],
+            )
+
+    def test__row_range_outputs_are_merged_in_order_once_all_are_complete(self) -> None:
+        with tempfile.TemporaryDirectory() as output_dir:
+            for input_file_path in ["/in/file1.jsonl", "/in/file2.jsonl.zst"]:
+                row_ranges = [RowRange(part_index, 3, 0, 0) for part_index in range(3)]
+                for row_range in [row_ranges[2], row_ranges[0]]:
+                    rows = [dict(a=row_range.part_index, b=b) for b in range(2)]
+                    utils.write_predictions_to_local_file(rows, input_file_path, output_dir, row_range=row_range)
+
+                self.assertFalse(utils.merge_row_range_outputs(input_file_path, output_dir, 3))
+
+                utils.write_predictions_to_local_file([], input_file_path, output_dir, row_range=row_ranges[1])
+                self.assertTrue(utils.merge_row_range_outputs(input_file_path, output_dir, 3))
+
+                output_file_path = utils.output_file_path_for(input_file_path, output_dir)
+                self.assertEqual(
+                    list(utils.iter_instances_from_local_file(output_file_path)),
+                    [dict(a=0, b=0), dict(a=0, b=1), dict(a=2, b=0), dict(a=2, b=1)],
+                )
+
+            self.assertEqual(sorted(os.listdir(output_dir)), ["file1.jsonl", "file2.jsonl.zst"])
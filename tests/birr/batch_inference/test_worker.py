@@ -0,0 +1,452 @@
+from collections import deque
+import json
+import os
+import tempfile
+import threading
+from types import SimpleNamespace
+from typing import Any, Callable, Deque, Dict, Iterable, List
+import unittest
+from unittest.mock import call, patch
+
+import numpy as np
+
+from birr.batch_inference.checkpoint import RowCheckpoint
+from birr.batch_inference.data_models import (
+    CompletedBatch,
+    CompletedItem,
+    Message,
+    PreparedBatch,
+    RawInputItem,
+    RowRange,
+)
+from birr.batch_inference.json_codec import OutputRow
+from birr.batch_inference.queue.dummy_predictor import DummyPredictor
+from birr.batch_inference.queue.base_queue import BaseQueue
+from birr.batch_inference.queue.in_memory_queue import InMemoryQueue
+from birr.batch_inference.queue.sqlite_queue import SqliteQueue
+from birr.batch_inference.settings import Settings
+from birr.batch_inference.utils import write_predictions_to_local_file
+from birr.batch_inference.worker import PreparedMessage, Worker
+from birr.core.config import GenerateConfig, LLMModelConfig, PipelineConfig
+from tests.birr.batch_inference.queue.test__sqlite_queue import FakeClock
+
+
+class FakeActor:
+    """Calls an object's methods directly where a Ray actor handle would, with `ray.get` patched out."""
+
+    def __init__(self, obj: Any) -> None:
+        self.obj = obj
+
+    def __getattr__(self, name: str) -> Any:
+        return SimpleNamespace(remote=getattr(self.obj, name))
+
+
+class FakeActorPool:
+    """
+    Stands in for an `ActorPool` of `num_actors` actors over one object. Like Ray's, it keeps results
+    pending until they are taken, and `map_unordered` discards those left over first. Results are
+    only ready once waited for, and `map_unordered` hands them back in reverse.
+    """
+
+    def __init__(self, obj: Any, num_actors: int = 2) -> None:
+        self.actor = FakeActor(obj)
+        self.num_actors = num_actors
+        self._results: Deque[Any] = deque()
+
+    def map_unordered(self, fn: Callable[[Any, Any], Any], values: Iterable[Any]) -> Iterable[Any]:
+        self._results.clear()
+        return reversed([fn(self.actor, value) for value in values])
+
+    def submit(self, fn: Callable[[Any, Any], Any], value: Any) -> None:
+        self._results.append(fn(self.actor, value))
+
+    def has_next(self) -> bool:
+        return bool(self._results)
+
+    def has_free(self) -> bool:
+        return len(self._results) < self.num_actors
+
+    def get_next_unordered(self, timeout: Any = None) -> Any:
+        if timeout == 0:
+            raise TimeoutError()
+        return self._results.popleft()
+
+
+class FakeTokenizer:
+    """Tokenizes a prompt into its bytes, so that echoed completions decode back into the prompt."""
+
+    def prepare_inputs(self, batch: List[RawInputItem]) -> PreparedBatch:
+        return PreparedBatch.from_token_ids(
+            [item.index for item in batch],
+            [np.frombuffer(str(item.messages[-1].content).encode("utf-8"), dtype=np.uint8) for item in batch],
+        )
+
+    def decode(self, batch: CompletedBatch) -> CompletedBatch:
+        for position in range(len(batch)):
+            batch.texts[position] = batch.entry_token_ids(position).astype(np.uint8).tobytes().decode("utf-8")
+        return batch
+
+
+class RecordingPredictor(DummyPredictor):
+    def __init__(self) -> None:
+        super().__init__(LLMModelConfig(), GenerateConfig())
+        self.predicted_prompts: List[str] = []
+
+    def predict(self, batch: PreparedBatch) -> CompletedBatch:
+        self.predicted_prompts.extend(
+            batch.row_token_ids(position).astype(np.uint8).tobytes().decode("utf-8")
+            for position in range(len(batch))
+        )
+        return super().predict(batch)
+
+
+class TestWorker(unittest.TestCase):
+    def setUp(self) -> None:
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.input_dir = os.path.join(self._tmp_dir.name, "input")
+        self.output_dir = os.path.join(self._tmp_dir.name, "output")
+        os.makedirs(self.input_dir)
+        os.makedirs(self.output_dir)
+
+        self.predictor = RecordingPredictor()
+        self.clock = FakeClock()
+        ray_get = patch("ray.get", side_effect=lambda refs: refs)
+        ray_get.start()
+        self.addCleanup(ray_get.stop)
+
+    def tearDown(self) -> None:
+        self._tmp_dir.cleanup()
+
+    def _write_input_file(self, filename: str, texts: List[str]) -> None:
+        with open(os.path.join(self.input_dir, filename), "w") as f:
+            for text in texts:
+                f.write(json.dumps(dict(text=text)) + "\n")
+
+    def _output_texts(self, file_path: str) -> List[str]:
+        with open(file_path, "r") as f:
+            return [json.loads(line)["outputs"][0]["text"] for line in f]
+
+    def _make_worker(self, **pipeline_overrides: Any) -> Worker:
+        pipeline_config = PipelineConfig(
+            input_file_dir=self.input_dir,
+            output_file_dir=self.output_dir,
+            num_gpus=1,
+            generation_batch_size=1,
+            tokenization_batch_size=1,
+            decoding_batch_size=1,
+            message_order="listed",
+            **pipeline_overrides,
+        )
+        self.queue: BaseQueue
+        if pipeline_config.queue_path:
+            self.queue = SqliteQueue(pipeline_config, clock=self.clock)
+            self.addCleanup(self.queue.close)
+        else:
+            self.queue = InMemoryQueue(pipeline_config)
+
+        return Worker(
+            Settings(pipeline_config=pipeline_config),
+            FakeActor(self.queue),
+            FakeActorPool(FakeTokenizer()),
+            FakeActorPool(self.predictor),
+            prefetch_tokenizers=FakeActorPool(FakeTokenizer()),
+        )
+
+    def test__streaming_writes_each_window_in_input_order_and_promotes_the_partial_file(self) -> None:
+        texts = [f"row {index}" for index in range(5)]
+        self._write_input_file("file.jsonl", texts)
+        worker = self._make_worker(streaming_window_size=2)
+
+        flushed: List[List[str]] = []
+        flush = RowCheckpoint.flush
+
+        def flush_and_read(checkpoint: RowCheckpoint) -> None:
+            flush(checkpoint)
+            flushed.append(self._output_texts(checkpoint.partial_file_path))
+
+        with patch.object(RowCheckpoint, "flush", flush_and_read):
+            worker.run()
+
+        self.assertEqual(flushed[:3], [texts[:2], texts[:4], texts])
+        self.assertEqual(self._output_texts(os.path.join(self.output_dir, "file.jsonl")), texts)
+        self.assertEqual(os.listdir(self.output_dir), ["file.jsonl"])
+
+    def test__resumes_an_interrupted_file_without_predicting_completed_rows_again(self) -> None:
+        texts = [f"row {index}" for index in range(5)]
+        self._write_input_file("file.jsonl", texts)
+        output_file_path = os.path.join(self.output_dir, "file.jsonl")
+
+        # An earlier run flushed two rows before it was interrupted
+        interrupted = RowCheckpoint(output_file_path)
+        for index in [2, 0]:
+            interrupted.add(index, dict(text=texts[index], outputs=[dict(text=f"earlier {index}")]))
+        interrupted.flush()
+
+        self._make_worker(checkpoint_interval=2).run()
+
+        self.assertEqual(sorted(self.predictor.predicted_prompts), ["row 1", "row 3", "row 4"])
+        self.assertEqual(
+            self._output_texts(output_file_path), ["earlier 0", "row 1", "earlier 2", "row 3", "row 4"]
+        )
+        self.assertEqual(os.listdir(self.output_dir), ["file.jsonl"])
+
+    def test__every_output_line_ends_in_a_newline(self) -> None:
+        self._write_input_file("file.jsonl", ["a", "b"])
+
+        self._make_worker().run()
+
+        with open(os.path.join(self.output_dir, "file.jsonl"), "rb") as f:
+            self.assertEqual(f.read().count(b"\n"), 2)
+
+    def test__prefetch_prepares_the_next_message_while_completing_the_current_one(self) -> None:
+        for filename in ["a.jsonl", "b.jsonl", "c.jsonl"]:
+            self._write_input_file(filename, [f"{filename} row {index}" for index in range(3)])
+        with open(os.path.join(self.input_dir, "broken.jsonl"), "w") as f:
+            f.write("not json\n")
+        worker = self._make_worker(prefetch_depth=1)
+
+        prepare, complete = Worker._prepare_message, Worker._complete_message
+        prepared = threading.Condition()
+        prepare_thread_names: List[str] = []
+        overlapped: List[bool] = []
+
+        def prepare_and_notify(worker: Worker, message: Message, tokenizers: Any = None) -> PreparedMessage:
+            try:
+                return prepare(worker, message, tokenizers)
+            finally:
+                with prepared:
+                    prepare_thread_names.append(threading.current_thread().name)
+                    prepared.notify_all()
+
+        def complete_once_the_next_is_prepared(worker: Worker, prepared_message: PreparedMessage) -> None:
+            # Only returns in time if the next message is prepared while this one waits to be completed
+            num_completed = len(overlapped)
+            with prepared:
+                overlapped.append(
+                    prepared.wait_for(lambda: len(prepare_thread_names) >= min(num_completed + 2, 4), timeout=10)
+                )
+            complete(worker, prepared_message)
+
+        with patch.object(Worker, "_prepare_message", prepare_and_notify), patch.object(
+            Worker, "_complete_message", complete_once_the_next_is_prepared
+        ), self.assertLogs("birr.batch_inference.worker", level="ERROR") as logs:
+            worker.run()
+
+        self.assertEqual(overlapped, [True, True, True])
+        self.assertTrue(all(name.startswith("prefetch") for name in prepare_thread_names))
+        self.assertEqual(sorted(os.listdir(self.output_dir)), ["a.jsonl", "b.jsonl", "c.jsonl"])
+        for filename in ["a.jsonl", "b.jsonl", "c.jsonl"]:
+            self.assertEqual(
+                self._output_texts(os.path.join(self.output_dir, filename)),
+                [f"{filename} row {index}" for index in range(3)],
+            )
+
+        # The failed prefetch surfaces when its result is taken, and is logged against its message
+        (record,) = logs.records
+        self.assertIn("broken.jsonl", record.getMessage())
+        assert record.exc_info is not None
+        self.assertIsInstance(record.exc_info[1], json.JSONDecodeError)
+
+    def _write_input_files(self, filenames: List[str]) -> Dict[str, List[str]]:
+        texts_by_filename = {filename: [f"{filename} row {index}" for index in range(3)] for filename in filenames}
+        for filename, texts in texts_by_filename.items():
+            self._write_input_file(filename, texts)
+        return texts_by_filename
+
+    def test__results_left_pending_by_a_failed_message_are_not_taken_for_the_next_ones(self) -> None:
+        texts_by_filename = self._write_input_files(["a.jsonl", "b.jsonl", "c.jsonl"])
+        worker = self._make_worker(prefetch_depth=1, checkpoint_interval=1)
+
+        serialize = Worker._serialize
+
+        def serialize_unless_of_b(worker: Worker, instance: Any, prediction: CompletedItem) -> OutputRow:
+            # Fails on b's first decoded row, while its other rows are still being decoded
+            if instance["text"].startswith("b.jsonl"):
+                raise ValueError("Failed to serialize")
+            return serialize(worker, instance, prediction)
+
+        with patch.object(Worker, "_serialize", serialize_unless_of_b), self.assertLogs(
+            "birr.batch_inference.worker", level="ERROR"
+        ):
+            worker.run()
+
+        self.assertNotIn("b.jsonl", os.listdir(self.output_dir))
+        for filename in ["a.jsonl", "c.jsonl"]:
+            self.assertEqual(
+                self._output_texts(os.path.join(self.output_dir, filename)), texts_by_filename[filename]
+            )
+
+    def test__predictions_left_pending_by_a_failed_message_are_neither_written_nor_cached(self) -> None:
+        texts_by_filename = self._write_input_files(["a.jsonl", "b.jsonl", "c.jsonl"])
+        overrides = dict(
+            adaptive_batch_size_bounds=(1, 1),
+            checkpoint_interval=1,
+            result_cache_path=os.path.join(self._tmp_dir.name, "results.sqlite"),
+        )
+
+        decode = FakeTokenizer.decode
+
+        def decode_unless_of_b(tokenizer: FakeTokenizer, batch: CompletedBatch) -> CompletedBatch:
+            # Fails on b's first prediction, while its next one is still being predicted
+            if decode(tokenizer, batch).texts[0].startswith("b.jsonl"):
+                raise ValueError("Failed to decode")
+            return batch
+
+        with patch.object(FakeTokenizer, "decode", decode_unless_of_b), self.assertLogs(
+            "birr.batch_inference.worker", level="ERROR"
+        ):
+            self._make_worker(**overrides).run()
+
+        self.assertNotIn("b.jsonl", os.listdir(self.output_dir))
+        for filename in ["a.jsonl", "c.jsonl"]:
+            self.assertEqual(
+                self._output_texts(os.path.join(self.output_dir, filename)), texts_by_filename[filename]
+            )
+
+        # What was cached for a's and c's rows is what they predicted
+        for filename in ["a.jsonl", "c.jsonl"]:
+            os.remove(os.path.join(self.output_dir, filename))
+        self.predictor.predicted_prompts.clear()
+        self._make_worker(**overrides).run()
+
+        self.assertLessEqual(set(self.predictor.predicted_prompts), set(texts_by_filename["b.jsonl"]))
+        for filename, texts in texts_by_filename.items():
+            self.assertEqual(self._output_texts(os.path.join(self.output_dir, filename)), texts)
+
+    def test__duplicate_prompts_are_predicted_once_and_every_row_gets_the_completion(self) -> None:
+        texts = ["x", "y", "x", "x", "y", "z"]
+        self._write_input_file("file.jsonl", texts)
+
+        with self.assertLogs("birr.batch_inference.worker", level="INFO") as logs:
+            self._make_worker(deduplicate_prompts="always").run()
+
+        # Each distinct prompt is predicted once, and the completion copied to its duplicates
+        self.assertEqual(sorted(self.predictor.predicted_prompts), ["x", "y", "z"])
+        self.assertEqual(self._output_texts(os.path.join(self.output_dir, "file.jsonl")), texts)
+        self.assertIn("Deduplicated 3 of 6 rows (50.0% fewer prompts to predict)", "\n".join(logs.output))
+
+    def test__split_files_skip_completed_parts_and_are_merged_after_the_last_part(self) -> None:
+        texts = [f"row {index}" for index in range(5)]
+        self._write_input_file("file.jsonl", texts)
+        # An earlier run completed the first part
+        write_predictions_to_local_file(
+            [dict(text=texts[index], outputs=[dict(text=f"earlier {index}")]) for index in range(2)],
+            os.path.join(self.input_dir, "file.jsonl"),
+            self.output_dir,
+            row_range=RowRange(0, 3, 0, 0),
+        )
+        worker = self._make_worker(rows_per_message=2)
+
+        with patch("birr.batch_inference.worker.increment") as increment:
+            worker.run()
+
+        self.assertEqual(sorted(self.predictor.predicted_prompts), texts[2:])
+        self.assertEqual(
+            self._output_texts(os.path.join(self.output_dir, "file.jsonl")), ["earlier 0", "earlier 1", *texts[2:]]
+        )
+        self.assertEqual(os.listdir(self.output_dir), ["file.jsonl"])
+        self.assertEqual(
+            [args for args in increment.call_args_list if args[0][0] == "birr_files_processed"],
+            [call("birr_files_processed")],
+        )
+
+    def test__only_batches_dispatched_to_a_free_predictor_count_as_in_flight(self) -> None:
+        self._write_input_file("file.jsonl", [f"row {index}" for index in range(5)])
+        worker = self._make_worker()
+
+        with patch("birr.batch_inference.worker.set_gauge") as set_gauge:
+            worker.run()
+
+        batches_in_flight = [
+            args[1] for args, _ in set_gauge.call_args_list if args[0] == "birr_batches_in_flight"
+        ]
+        self.assertEqual(len(batches_in_flight), 10)
+        self.assertEqual(max(batches_in_flight), 2)
+        self.assertEqual(batches_in_flight[-1], 0)
+
+    def _sqlite_queue_overrides(self) -> Dict[str, Any]:
+        return dict(
+            queue_path=os.path.join(self._tmp_dir.name, "queue.sqlite"),
+            queue_visibility_timeout=60,
+            queue_max_attempts=2,
+            queue_poll_interval=5,
+        )
+
+    def test__stops_without_writing_once_the_lease_is_handed_to_another_worker(self) -> None:
+        self._write_input_file("file.jsonl", ["a", "b"])
+        worker = self._make_worker(**self._sqlite_queue_overrides())
+        assert isinstance(self.queue, SqliteQueue)
+        other_leases: List[Message] = []
+
+        def predict_while_the_lease_expires(batch: PreparedBatch) -> CompletedBatch:
+            if not other_leases:
+                self.clock.now += 61
+                other_leases.extend(self.queue.get_messages(1))
+            return RecordingPredictor.predict(self.predictor, batch)
+
+        def sleep_while_the_other_worker_finishes(seconds: float) -> None:
+            self.assertEqual(os.listdir(self.output_dir), [])
+            self.assertTrue(self.queue.extend_lease(other_leases[0]))
+            self.queue.delete_message(other_leases[0])
+
+        with patch.object(self.predictor, "predict", predict_while_the_lease_expires), patch(
+            "birr.batch_inference.worker.time.sleep", side_effect=sleep_while_the_other_worker_finishes
+        ) as mock_sleep:
+            worker.run()
+
+        mock_sleep.assert_called_once()
+        self.assertEqual(os.listdir(self.output_dir), [])
+        self.assertEqual(self.queue.num_messages_by_state(), dict(done=1))
+
+    def test__keeps_the_leases_on_prefetched_messages_while_they_wait_their_turn(self) -> None:
+        texts_by_filename = self._write_input_files(["a.jsonl", "b.jsonl"])
+        worker = self._make_worker(prefetch_depth=1, checkpoint_interval=1, **self._sqlite_queue_overrides())
+        assert isinstance(self.queue, SqliteQueue)
+        handed_to_other_workers: List[Message] = []
+
+        flush = RowCheckpoint.flush
+
+        def flush_while_time_passes(checkpoint: RowCheckpoint) -> None:
+            # Completing a takes longer than the visibility timeout, while b is leased and waits
+            flush(checkpoint)
+            self.clock.now += 25
+            handed_to_other_workers.extend(self.queue.get_messages(1))
+
+        with patch.object(RowCheckpoint, "flush", flush_while_time_passes), patch(
+            "birr.batch_inference.worker.time.sleep", side_effect=AssertionError("Waited for another worker")
+        ):
+            worker.run()
+
+        self.assertEqual(handed_to_other_workers, [])
+        for filename, texts in texts_by_filename.items():
+            self.assertEqual(self._output_texts(os.path.join(self.output_dir, filename)), texts)
+        self.assertEqual(self.queue.num_messages_by_state(), dict(done=2))
+
+    def test__waits_for_messages_leased_by_other_workers(self) -> None:
+        self._write_input_file("file.jsonl", ["a", "b"])
+        worker = self._make_worker(**self._sqlite_queue_overrides())
+        assert isinstance(self.queue, SqliteQueue)
+        # Another worker, which then dies, leases the only message first
+        self.queue.get_messages(1)
+
+        def sleep(seconds: float) -> None:
+            self.clock.now += seconds * 10
+
+        with patch("birr.batch_inference.worker.time.sleep", side_effect=sleep) as mock_sleep:
+            worker.run()
+
+        self.assertEqual(mock_sleep.call_args_list, [call(5), call(5)])
+        self.assertEqual(self._output_texts(os.path.join(self.output_dir, "file.jsonl")), ["a", "b"])
+        self.assertEqual(self.queue.num_messages_by_state(), dict(done=1))
+
+    def test__messages_that_fail_are_handed_out_again_within_the_run(self) -> None:
+        with open(os.path.join(self.input_dir, "broken.jsonl"), "w") as f:
+            f.write("not json\n")
+        worker = self._make_worker(**self._sqlite_queue_overrides())
+        assert isinstance(self.queue, SqliteQueue)
+
+        with self.assertLogs("birr.batch_inference.worker", level="ERROR") as logs:
+            worker.run()
+
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(self.queue.num_messages_by_state(), dict(dead=1))
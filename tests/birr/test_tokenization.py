@@ -1,4 +1,5 @@
 import os
+from typing import List, Union
 import unittest
 
 from birr.batch_inference.data_models import ChatMessage
@@ -127,3 +128,53 @@ class TestModelTokenizer(unittest.TestCase):
         formatted = tokenizer.batch_format([user_chat_message])[0]
         expected = "\n".join(["", "[INST] Original: I am a user, short and stout. [/INST]Rewritten:", ""])
         self.assertEqual(formatted, expected)
+
+    def test__template_fast_path_matches_full_tokenization(self) -> None:
+        format_config = FormatConfig(system_message="Be brief.", instruction_prefix="Question: ")
+        slow_tokenizer = ModelTokenizer(LLMModelConfig(name_or_path=DUMMY_ARTIFACTS_DIR), format_config)
+        fast_tokenizer = ModelTokenizer(
+            LLMModelConfig(name_or_path=DUMMY_ARTIFACTS_DIR, template_fast_path=True), format_config
+        )
+        self.assertIsNotNone(fast_tokenizer._template_token_ids)
+
+        instances: List[Union[str, List[ChatMessage]]] = [
+            "How tall is the Eiffel tower?",
+            [ChatMessage.from_text("Why is the sky\nblue?")],
+            [
+                ChatMessage(role="user", content="Hi!"),
+                ChatMessage(role="assistant", content="Hello."),
+                ChatMessage(role="user", content="Bye!"),
+            ],
+        ]
+
+        self.assertEqual(
+            fast_tokenizer.batch_process(instances).input_ids, slow_tokenizer.batch_process(instances).input_ids
+        )
+
+    def test__template_fast_path_is_not_used_when_the_template_changes_content(self) -> None:
+        chat_template = "{%- for message in messages -%}{{- '[INST] ' + message['content'] | upper + ' [/INST]' -}}{%- endfor -%}"
+        tokenizer = ModelTokenizer(
+            LLMModelConfig(name_or_path=DUMMY_ARTIFACTS_DIR, template_fast_path=True),
+            FormatConfig(chat_template=chat_template),
+        )
+
+        self.assertIsNone(tokenizer._template_token_ids)
+
+    def test__template_fast_path_is_dropped_when_the_jobs_rows_tokenize_differently(self) -> None:
+        # Only rows the fixed verification sample doesn't cover are rendered differently
+        chat_template = "{%- for message in messages -%}{%- if 'urgent' in message['content'] -%}{{- '<|endoftext|>' -}}{%- endif -%}{{- '<|im_start|>' + message['content'] + '<|im_end|>' -}}{%- endfor -%}"
+        slow_tokenizer = ModelTokenizer(
+            LLMModelConfig(name_or_path=DUMMY_ARTIFACTS_DIR), FormatConfig(chat_template=chat_template)
+        )
+        fast_tokenizer = ModelTokenizer(
+            LLMModelConfig(name_or_path=DUMMY_ARTIFACTS_DIR, template_fast_path=True),
+            FormatConfig(chat_template=chat_template),
+        )
+        self.assertIsNotNone(fast_tokenizer._template_token_ids)
+
+        instances: List[Union[str, List[ChatMessage]]] = ["An urgent question", "A question"]
+
+        self.assertEqual(
+            fast_tokenizer.batch_process(instances).input_ids, slow_tokenizer.batch_process(instances).input_ids
+        )
+        self.assertIsNone(fast_tokenizer._template_token_ids)